@@ -0,0 +1,258 @@
+'''
+        GATT applications and advertisements on several Bluetooth adapters
+
+        Each adapter of an AdapterSet gets its own application and advertisement,
+        with every service (replicated) or a share of them (sharded, see shard()),
+        so the connections and airtime of several radios add up. Applications are
+        not shared between adapters: a characteristic has one acquired
+        notification socket and MTU, which bluetoothd of one adapter takes.
+        Connected devices and GATT traffic are counted per adapter.
+
+        adapters = AdapterSet(bus, ["hci0", "hci1"])
+        adapters.power_on()
+        adapters.register(lambda adapter: app, lambda adapter: advertisement)
+'''
+import logging
+from functools import partial
+
+import dbus
+import dbus.exceptions
+
+from ble import (
+    ADAPTER_IFACE,
+    BLUEZ_SERVICE_NAME,
+    DBUS_OM_IFACE,
+    DBUS_PROP_IFACE,
+    DEVICE_IFACE,
+    GATT_MANAGER_IFACE,
+    LE_ADVERTISING_MANAGER_IFACE,
+    Characteristic,
+    Descriptor,
+    DiagnosticsCharacteristic,
+    NotSupportedException,
+    find_adapters,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def shard(items, count):
+    """Split `items` round-robin into `count` lists"""
+    return [list(items[i::count]) for i in range(count)]
+
+
+class Adapter(object):
+    """One adapter: its properties, what is registered on it and its connected devices"""
+
+    def __init__(self, bus, path, properties):
+        self.path = str(path)
+        self.name = self.path.rsplit("/", 1)[-1]
+        self.properties = properties
+        adapter_obj = bus.get_object(BLUEZ_SERVICE_NAME, path)
+        self.adapter_props = dbus.Interface(adapter_obj, DBUS_PROP_IFACE)
+        self.service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
+        self.ad_manager = None
+        if properties.get("Advertising"):
+            self.ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
+        self.application = None
+        self.advertisement = None
+        self.registered = False
+        self.advertising = False
+        self.error = None
+        self.connected = set()
+        # connections since the set was created
+        self.connections = 0
+
+    def owns(self, device):
+        """Whether the device object path is one of this adapter's devices"""
+        return device is not None and str(device).startswith(self.path + "/")
+
+
+class AdapterSet(object):
+    """
+    The adapters named in `names` ("hci1" or "/org/bluez/hci1"), or all of them,
+    that have a GattManager1, at most `count` of them.
+    """
+
+    def __init__(self, bus, names=None, count=None):
+        self.bus = bus
+        found = find_adapters(bus)
+        if names:
+            by_name = dict((str(path).rsplit("/", 1)[-1], (path, properties)) for path, properties in found)
+            by_name.update((str(path), (path, properties)) for path, properties in found)
+            missing = [name for name in names if name not in by_name]
+            if missing:
+                raise ValueError("adapter %s not found" % ", ".join(missing))
+            found = [by_name[name] for name in names]
+        if count is not None:
+            found = found[:count]
+        self.adapters = [Adapter(bus, path, properties) for path, properties in found]
+        self._match = None
+
+    def __iter__(self):
+        return iter(self.adapters)
+
+    def __len__(self):
+        return len(self.adapters)
+
+    def power_on(self):
+        """Power on each adapter; failures are logged and kept in `adapter.error`"""
+        for adapter in self.adapters:
+            try:
+                adapter.adapter_props.Set(ADAPTER_IFACE, "Powered", dbus.Boolean(1))
+            except dbus.exceptions.DBusException as e:
+                adapter.error = str(e)
+                logger.error("%s: failed to power on: %s" % (adapter.name, e))
+
+    def register(self, application_for, advertisement_for=None, error_handler=None):
+        """
+        Register `application_for(adapter)` and `advertisement_for(adapter)` on
+        each adapter (None skips it) that did not fail to power on,
+        asynchronously. Failures are logged, kept in `adapter.error` and passed
+        to `error_handler(adapter, error)`.
+        """
+        for adapter in self.adapters:
+            if adapter.error is not None:
+                continue
+            application = application_for(adapter)
+            if application is not None:
+                adapter.application = application
+                adapter.service_manager.RegisterApplication(
+                    application.get_path(), {},
+                    reply_handler=partial(self._registered, adapter),
+                    error_handler=partial(self._failed, adapter, "application", error_handler),
+                )
+            advertisement = advertisement_for(adapter) if advertisement_for is not None else None
+            if advertisement is not None and adapter.ad_manager is not None:
+                adapter.advertisement = advertisement
+                adapter.ad_manager.RegisterAdvertisement(
+                    advertisement.get_path(), {},
+                    reply_handler=partial(self._advertising, adapter),
+                    error_handler=partial(self._failed, adapter, "advertisement", error_handler),
+                )
+        if self._match is None:
+            self.track_connections()
+
+    def _registered(self, adapter):
+        adapter.registered = True
+        logger.info("%s: GATT application registered" % adapter.name)
+
+    def _advertising(self, adapter):
+        adapter.advertising = True
+        logger.info("%s: advertisement registered" % adapter.name)
+
+    def _failed(self, adapter, what, error_handler, error):
+        adapter.error = str(error)
+        logger.error("%s: failed to register %s: %s" % (adapter.name, what, error))
+        if error_handler is not None:
+            error_handler(adapter, error)
+
+    def unregister(self):
+        for adapter in self.adapters:
+            try:
+                if adapter.advertising:
+                    adapter.ad_manager.UnregisterAdvertisement(adapter.advertisement.get_path())
+                if adapter.registered:
+                    adapter.service_manager.UnregisterApplication(adapter.application.get_path())
+            except dbus.exceptions.DBusException as e:
+                logger.warning("%s: unregister failed: %s" % (adapter.name, e))
+            adapter.registered = adapter.advertising = False
+        if self._match is not None:
+            self._match.remove()
+            self._match = None
+
+    def track_connections(self):
+        """Count the connected devices of each adapter, from now on from Device1 signals"""
+        remote_om = dbus.Interface(self.bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
+        for path, interfaces in remote_om.GetManagedObjects().items():
+            if interfaces.get(DEVICE_IFACE, {}).get("Connected"):
+                self._set_connected(path, True)
+        self._match = self.bus.add_signal_receiver(
+            self._properties_changed, signal_name="PropertiesChanged", dbus_interface=DBUS_PROP_IFACE,
+            bus_name=BLUEZ_SERVICE_NAME, path_keyword="path",
+        )
+
+    def _properties_changed(self, interface, changed, invalidated, path=None):
+        if interface == DEVICE_IFACE and "Connected" in changed:
+            self._set_connected(path, bool(changed["Connected"]))
+
+    def adapter_of(self, device):
+        for adapter in self.adapters:
+            if adapter.owns(device):
+                return adapter
+        return None
+
+    def _set_connected(self, device, connected):
+        adapter = self.adapter_of(device)
+        if adapter is None:
+            return
+        device = str(device)
+        if connected and device not in adapter.connected:
+            adapter.connected.add(device)
+            adapter.connections += 1
+            logger.info("%s: %s connected, %d devices" % (adapter.name, device, len(adapter.connected)))
+        elif not connected and device in adapter.connected:
+            adapter.connected.discard(device)
+            logger.info("%s: %s disconnected, %d devices" % (adapter.name, device, len(adapter.connected)))
+
+    def stats(self):
+        """
+        Per adapter name: address, registration state, connections, the reads
+        and writes of its devices on the application registered on it, and the
+        notifications sent by that application. bluetoothd sends notifications
+        to every subscribed device of every adapter the application is
+        registered on, so they are counted for each of those adapters.
+        """
+        result = {}
+        for adapter in self.adapters:
+            stats = {
+                "address": str(adapter.properties.get("Address", "")),
+                "registered": adapter.registered,
+                "advertising": adapter.advertising,
+                "error": adapter.error,
+                "connected": len(adapter.connected),
+                "connections": adapter.connections,
+                "reads": 0,
+                "writes": 0,
+                "write_bytes": 0,
+                "notifications": 0,
+                "notification_bytes": 0,
+            }
+            objects = adapter.application.objects.values() if adapter.application is not None else ()
+            for obj in objects:
+                if not isinstance(obj, (Characteristic, Descriptor)):
+                    continue
+                for device, count in obj.read_snapshots.device_reads.items():
+                    if adapter.owns(device):
+                        stats["reads"] += count
+                for device, (count, size) in obj.write_reassembly.device_writes.items():
+                    if adapter.owns(device):
+                        stats["writes"] += count
+                        stats["write_bytes"] += size
+                if isinstance(obj, Characteristic):
+                    stats["notifications"] += obj.signal_sent
+                    stats["notification_bytes"] += obj.signal_bytes
+                    if obj.socket_channel is not None:
+                        stats["notifications"] += obj.socket_channel.sent
+                        stats["notification_bytes"] += obj.socket_channel.sent_bytes
+            result[adapter.name] = stats
+        return result
+
+
+class AdapterStatsCharacteristic(DiagnosticsCharacteristic):
+    """
+    AdapterSet.stats() as compact JSON, for DiagnosticsService, read like
+    DiagnosticsCharacteristic.
+    """
+
+    UUID = "5e2d0003-6c1a-4d7e-9c5b-7a3f1e8b2c40"
+
+    def __init__(self, bus, index, service, adapters):
+        DiagnosticsCharacteristic.__init__(self, bus, index, self.UUID, service, ("read",))
+        self.adapters = adapters
+
+    def summary(self):
+        return self.adapters.stats()
+
+    def WriteValue(self, value, options):
+        raise NotSupportedException()
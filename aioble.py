@@ -0,0 +1,518 @@
+'''
+        asyncio implementation of the GATT server model of ble.py, on dbus-next
+
+        The Application / Service / Characteristic / Descriptor / Advertisement
+        classes mirror ble.py, but run in an asyncio event loop: handlers
+        (read_value, write_value, notify_tick, start_notify, stop_notify) may be
+        coroutines, so a slow handler only delays its own reply. Blocking work,
+        such as an I2C transaction, goes to an executor with run_blocking().
+
+        bus = await aioble.MessageBus(bus_type=BusType.SYSTEM).connect()
+        app.export(bus)
+        await app.register(bus, await find_adapter(bus))
+
+        Notifications are sent as PropertiesChanged signals; AcquireNotify and
+        AcquireWrite are only implemented by ble.py.
+'''
+import asyncio
+import inspect
+import logging
+from functools import partial
+
+try:
+    from dbus_next import BusType, DBusError, Message, MessageType, Variant  # noqa: F401, BusType re-exported
+    from dbus_next.aio import MessageBus as _MessageBus
+    from dbus_next.service import PropertyAccess, ServiceInterface, dbus_property, method
+except ImportError as e:
+    raise ImportError("aioble needs dbus-next (pip install dbus-next): %s" % e)
+
+from wireformat import ATT_DEFAULT_MTU
+
+DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
+
+GATT_SERVICE_IFACE = "org.bluez.GattService1"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+GATT_DESC_IFACE = "org.bluez.GattDescriptor1"
+
+LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
+LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
+
+BLUEZ_SERVICE_NAME = "org.bluez"
+GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+
+# handlers are configured by the application, see blelog.setup_logging()
+logger = logging.getLogger(__name__)
+
+
+class InvalidArgsError(DBusError):
+    def __init__(self, text="Invalid arguments"):
+        DBusError.__init__(self, "org.freedesktop.DBus.Error.InvalidArgs", text)
+
+
+class NotSupportedError(DBusError):
+    def __init__(self, text="Not supported"):
+        DBusError.__init__(self, "org.bluez.Error.NotSupported", text)
+
+
+class InvalidValueLengthError(DBusError):
+    def __init__(self, text="Invalid value length"):
+        DBusError.__init__(self, "org.bluez.Error.InvalidValueLength", text)
+
+
+class NotPermittedError(DBusError):
+    def __init__(self, text="Not permitted"):
+        DBusError.__init__(self, "org.bluez.Error.NotPermitted", text)
+
+
+class InvalidOffsetError(DBusError):
+    def __init__(self, text="Invalid offset"):
+        DBusError.__init__(self, "org.bluez.Error.InvalidOffset", text)
+
+
+class FailedError(DBusError):
+    def __init__(self, text="Failed"):
+        DBusError.__init__(self, "org.bluez.Error.Failed", text)
+
+
+class MessageBus(_MessageBus):
+    """
+    dbus-next's asyncio bus, except that a DBusError raised by a coroutine
+    method is only sent back as the error reply: dbus-next 0.2 sends it and
+    then lets it reach the loop's exception handler, which logs a traceback
+    for every rejected read or write.
+    """
+
+    def _make_method_handler(self, interface, method):
+        handler = _MessageBus._make_method_handler(self, interface, method)
+        if not asyncio.iscoroutinefunction(method.fn):
+            return handler
+
+        def quiet_handler(msg, send_reply):
+            class QuietReply(object):
+                def __call__(self, reply):
+                    send_reply(reply)
+
+                def __enter__(self):
+                    return send_reply.__enter__()
+
+                def __exit__(self, exc_type, exc_value, tb):
+                    send_reply.__exit__(exc_type, exc_value, tb)
+                    return exc_type is not None and issubclass(exc_type, DBusError)
+
+            handler(msg, QuietReply())
+
+        return quiet_handler
+
+
+async def maybe_await(result):
+    """The result of a handler that may be a plain function or a coroutine"""
+    if inspect.isawaitable(result):
+        return await result
+    return result
+
+
+def plain_options(options):
+    """BlueZ options (a{sv}) as a dict of plain values, like the dbus-python ones"""
+    return dict((key, value.value) for key, value in options.items())
+
+
+async def call(bus, destination, path, interface, member, signature="", body=()):
+    """Method call returning the reply body, raising DBusError on an error reply"""
+    reply = await bus.call(Message(destination=destination, path=path, interface=interface,
+                                   member=member, signature=signature, body=list(body)))
+    if reply.message_type == MessageType.ERROR:
+        raise DBusError(reply.error_name, reply.body[0] if reply.body else "")
+    return reply.body
+
+
+async def find_adapter(bus):
+    """
+    Returns the first object that the bluez service has that has a GattManager1 interface
+    """
+    objects, = await call(bus, BLUEZ_SERVICE_NAME, "/", DBUS_OM_IFACE, "GetManagedObjects")
+    for path, interfaces in objects.items():
+        if GATT_MANAGER_IFACE in interfaces:
+            return path
+    return None
+
+
+async def run_blocking(function, *args, executor=None):
+    """Run the blocking `function` in `executor` (the loop's default one if None) and await it"""
+    return await asyncio.get_running_loop().run_in_executor(executor, partial(function, *args))
+
+
+class Application(object):
+    """
+    The object tree of a GATT application. dbus-next answers GetManagedObjects
+    on "/" from the exported interfaces, so there is no object for it.
+    """
+
+    path = "/"
+
+    def __init__(self):
+        self.services = []
+        self.bus = None
+
+    def add_service(self, service):
+        self.services.append(service)
+        if self.bus is not None:
+            service.export(self.bus)
+
+    def export(self, bus):
+        self.bus = bus
+        for service in self.services:
+            service.export(bus)
+
+    def unexport(self):
+        for service in self.services:
+            service.unexport(self.bus)
+        self.bus = None
+
+    async def register(self, bus, adapter, options=None):
+        await call(bus, BLUEZ_SERVICE_NAME, adapter, GATT_MANAGER_IFACE, "RegisterApplication",
+                   "oa{sv}", (self.path, options or {}))
+
+    async def unregister(self, bus, adapter):
+        await call(bus, BLUEZ_SERVICE_NAME, adapter, GATT_MANAGER_IFACE, "UnregisterApplication",
+                   "o", (self.path,))
+
+
+class Service(ServiceInterface):
+    """
+    org.bluez.GattService1 interface implementation
+    """
+
+    PATH_BASE = "/org/bluez/example/service"
+
+    def __init__(self, index, uuid, primary):
+        ServiceInterface.__init__(self, GATT_SERVICE_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.uuid = uuid
+        self.primary = primary
+        self.characteristics = []
+        self.bus = None
+
+    def add_characteristic(self, characteristic):
+        self.characteristics.append(characteristic)
+        if self.bus is not None:
+            characteristic.export(self.bus)
+
+    def export(self, bus):
+        self.bus = bus
+        bus.export(self.path, self)
+        for characteristic in self.characteristics:
+            characteristic.export(bus)
+
+    def unexport(self, bus):
+        for characteristic in self.characteristics:
+            characteristic.unexport(bus)
+        bus.unexport(self.path, self)
+        self.bus = None
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Primary(self) -> "b":
+        return self.primary
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristics(self) -> "ao":
+        return [characteristic.path for characteristic in self.characteristics]
+
+
+class _Attribute(object):
+    """read_value/write_value dispatch shared by characteristics and descriptors"""
+
+    # executor of run_blocking(), None for the loop's default one
+    executor = None
+
+    def _init_attribute(self):
+        # device -> value read at offset 0, for the reads at the next offsets
+        self.read_snapshots = {}
+
+    async def _read(self, options):
+        options = plain_options(options)
+        offset = int(options.get("offset", 0))
+        device = options.get("device")
+        value = self.read_snapshots.get(device) if offset else None
+        if value is None:
+            value = bytes(await maybe_await(self.read_value(options)))
+        if offset > len(value):
+            self.read_snapshots.pop(device, None)
+            raise InvalidOffsetError()
+        # a value longer than one read response is fetched at increasing offsets,
+        # until a response is shorter than MTU - 1 bytes (empty at the end)
+        if offset + int(options.get("mtu", ATT_DEFAULT_MTU)) - 1 <= len(value):
+            self.read_snapshots[device] = value
+        else:
+            self.read_snapshots.pop(device, None)
+        return value[offset:]
+
+    async def _write(self, value, options):
+        await maybe_await(self.write_value(bytes(value), plain_options(options)))
+
+    def read_value(self, options):
+        """Return the whole value (bytes-like), override to make the attribute readable"""
+        logger.info("%s: default %s called, returning error", self.path, "ReadValue")
+        raise NotSupportedError()
+
+    def write_value(self, value, options):
+        """Called with each written value, override to make the attribute writable"""
+        logger.info("%s: default %s called, returning error", self.path, "WriteValue")
+        raise NotSupportedError()
+
+    async def run_blocking(self, function, *args):
+        return await run_blocking(function, *args, executor=self.executor)
+
+
+class Characteristic(_Attribute, ServiceInterface):
+    """
+    org.bluez.GattCharacteristic1 interface implementation
+
+    Subclasses implement read_value(options) and write_value(value, options),
+    as functions or coroutines. StartNotify calls start_notify(), which by
+    default calls notify_tick() every 1 / `notify_rate` seconds from a task
+    until StopNotify; notify_tick sends values with `await notify_value(value)`.
+    """
+
+    notify_rate = 1.0
+
+    def __init__(self, index, uuid, flags, service):
+        ServiceInterface.__init__(self, GATT_CHRC_IFACE)
+        self._init_attribute()
+        self.path = service.path + "/char" + str(index)
+        self.uuid = uuid
+        self.service = service
+        self.flags = flags
+        self.descriptors = []
+        self.notifying = False
+        self.value = b""
+        self.notify_count = 0
+        self._notify_task = None
+        self.bus = None
+
+    def add_descriptor(self, descriptor):
+        self.descriptors.append(descriptor)
+        if self.bus is not None:
+            descriptor.export(self.bus)
+
+    def export(self, bus):
+        self.bus = bus
+        bus.export(self.path, self)
+        for descriptor in self.descriptors:
+            descriptor.export(bus)
+
+    def unexport(self, bus):
+        self.stop_notifying()
+        for descriptor in self.descriptors:
+            descriptor.unexport(bus)
+        bus.unexport(self.path, self)
+        self.bus = None
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Service(self) -> "o":
+        return self.service.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "as":
+        return self.flags
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Descriptors(self) -> "ao":
+        return [descriptor.path for descriptor in self.descriptors]
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Value(self) -> "ay":
+        # the last value notified; PropertiesChanged of this property is the notification
+        return self.value
+
+    @method()
+    async def ReadValue(self, options: "a{sv}") -> "ay":
+        return await self._read(options)
+
+    @method()
+    async def WriteValue(self, value: "ay", options: "a{sv}"):
+        await self._write(value, options)
+
+    @method()
+    async def StartNotify(self):
+        if "notify" not in self.flags and "indicate" not in self.flags:
+            raise NotSupportedError()
+        await maybe_await(self.start_notify())
+
+    @method()
+    async def StopNotify(self):
+        await maybe_await(self.stop_notify())
+
+    def start_notify(self):
+        if not self.notifying:
+            self.start_notifying()
+
+    def stop_notify(self):
+        if self.notifying:
+            self.stop_notifying()
+
+    def start_notifying(self):
+        self.notifying = True
+        if self._notify_task is None:
+            self._notify_task = asyncio.ensure_future(self._notify_loop())
+
+    def stop_notifying(self):
+        self.notifying = False
+        if self._notify_task is not None:
+            self._notify_task.cancel()
+            self._notify_task = None
+
+    async def _notify_loop(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while self.notifying:
+            try:
+                await maybe_await(self.notify_tick())
+            except Exception:
+                logger.exception("%s: notify_tick failed", self.path)
+            period = 1.0 / self.notify_rate
+            deadline += period
+            now = loop.time()
+            if now - deadline > period:
+                # fell behind, skip the missed ticks
+                deadline = now
+            await asyncio.sleep(max(0.0, deadline - now))
+
+    def notify_tick(self):
+        """Called at `notify_rate` Hz while notifying, override to send values"""
+
+    async def notify_value(self, value):
+        """
+        Send `value` to the subscribed clients. Awaiting it yields to the loop,
+        so a burst of notifications does not hold up the other handlers.
+        """
+        self.value = bytes(value)
+        self.emit_properties_changed({"Value": self.value})
+        self.notify_count += 1
+        await asyncio.sleep(0)
+
+
+class Descriptor(_Attribute, ServiceInterface):
+    """
+    org.bluez.GattDescriptor1 interface implementation
+
+    Readable and writable subclasses implement read_value(options) and
+    write_value(value, options), as for Characteristic.
+    """
+
+    def __init__(self, index, uuid, flags, characteristic):
+        ServiceInterface.__init__(self, GATT_DESC_IFACE)
+        self._init_attribute()
+        self.path = characteristic.path + "/desc" + str(index)
+        self.uuid = uuid
+        self.flags = flags
+        self.characteristic = characteristic
+
+    def export(self, bus):
+        bus.export(self.path, self)
+
+    def unexport(self, bus):
+        bus.unexport(self.path, self)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Characteristic(self) -> "o":
+        return self.characteristic.path
+
+    @dbus_property(access=PropertyAccess.READ)
+    def UUID(self) -> "s":
+        return self.uuid
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Flags(self) -> "as":
+        return self.flags
+
+    @method()
+    async def ReadValue(self, options: "a{sv}") -> "ay":
+        return await self._read(options)
+
+    @method()
+    async def WriteValue(self, value: "ay", options: "a{sv}"):
+        await self._write(value, options)
+
+
+class Advertisement(ServiceInterface):
+    """
+    org.bluez.LEAdvertisement1 interface implementation. dbus-next exports
+    every declared property, so the lists and dictionaries are sent empty
+    when unused and the local name is required.
+    """
+
+    PATH_BASE = "/org/bluez/example/advertisement"
+
+    def __init__(self, index, advertising_type, local_name):
+        ServiceInterface.__init__(self, LE_ADVERTISEMENT_IFACE)
+        self.path = self.PATH_BASE + str(index)
+        self.ad_type = advertising_type
+        self.local_name = local_name
+        self.service_uuids = []
+        self.solicit_uuids = []
+        self.manufacturer_data = {}
+        self.service_data = {}
+        self.include_tx_power = False
+
+    def add_service_uuid(self, uuid):
+        self.service_uuids.append(uuid)
+
+    def add_solicit_uuid(self, uuid):
+        self.solicit_uuids.append(uuid)
+
+    def add_manufacturer_data(self, manuf_code, data):
+        self.manufacturer_data[manuf_code] = Variant("ay", bytes(data))
+
+    def add_service_data(self, uuid, data):
+        self.service_data[uuid] = Variant("ay", bytes(data))
+
+    async def register(self, bus, adapter, options=None):
+        bus.export(self.path, self)
+        await call(bus, BLUEZ_SERVICE_NAME, adapter, LE_ADVERTISING_MANAGER_IFACE, "RegisterAdvertisement",
+                   "oa{sv}", (self.path, options or {}))
+
+    async def unregister(self, bus, adapter):
+        await call(bus, BLUEZ_SERVICE_NAME, adapter, LE_ADVERTISING_MANAGER_IFACE, "UnregisterAdvertisement",
+                   "o", (self.path,))
+        bus.unexport(self.path, self)
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Type(self) -> "s":
+        return self.ad_type
+
+    @dbus_property(access=PropertyAccess.READ)
+    def LocalName(self) -> "s":
+        return self.local_name
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceUUIDs(self) -> "as":
+        return self.service_uuids
+
+    @dbus_property(access=PropertyAccess.READ)
+    def SolicitUUIDs(self) -> "as":
+        return self.solicit_uuids
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ManufacturerData(self) -> "a{qv}":
+        return self.manufacturer_data
+
+    @dbus_property(access=PropertyAccess.READ)
+    def ServiceData(self) -> "a{sv}":
+        return self.service_data
+
+    @dbus_property(access=PropertyAccess.READ)
+    def IncludeTxPower(self) -> "b":
+        return self.include_tx_power
+
+    @method()
+    def Release(self):
+        logger.info("%s: Released!" % self.path)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import logging
 import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
@@ -17,10 +18,13 @@ from ble import (
     Application,
     find_adapter,
     Descriptor,
-    GATT_CHRC_IFACE,
+    to_dbus_bytes,
+    NotifyRateCharacteristic,
+    StructValue,
 )
+from blelog import setup_logging
 
-import array
+logger = logging.getLogger(__name__)
 
 MainLoop = None
 try:
@@ -35,11 +39,6 @@ except ImportError:
 mainloop = None
 
 
-def str_to_dbusarray(word):
-    """Helper function to represent Python string as D-Dbus Byte array"""
-    return dbus.Array([dbus.Byte(ord(letter)) for letter in word], 'y')
-
-
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
 LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
@@ -77,55 +76,79 @@ class BLEService(Service):
 
     def __init__(self, bus, index):
         Service.__init__(self, bus, index, self.service_UUID, True)
-        self.add_characteristic(DemoCharacteristic(bus, 0, self))
+        demo = DemoCharacteristic(bus, 0, self)
+        self.add_characteristic(demo)
+        self.add_characteristic(NotifyRateCharacteristic(
+            bus, 1, "4116f8d2-9f66-4f58-a53d-fc7440e7c14f", self, demo, max_rate=100,
+        ))
+        self.add_characteristic(StreamCharacteristic(bus, 2, self))
 
 
 class DemoCharacteristic(Characteristic):
     uuid = "4116f8d2-9f66-4f58-a53d-fc7440e7c14e"
     description = b"this is a BLE demo characteristic with read and notify"
 
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, rate=1.0):
         Characteristic.__init__(
             self, bus, index, self.uuid, ["read", 'notify'], service,
         )
-        self.notifying = False
+        self.notify_rate = rate
 
         self.count = 0
         self.add_descriptor(CharacteristicUserDescriptionDescriptor(bus, 1, self))
 
-    def ReadValue(self, options):
-        value = bytearray('Read........string read from BLE--', encoding="utf8")
-        return value
-
-    def NotifyTimer_cb(self):
-        value = str_to_dbusarray('Notify........string notify from BLE, counter: ' + str(self.count))
-        self.count += 1
-        print('Notify value: ' + str(self.count))
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
-        return self.notifying
+    read_text = to_dbus_bytes('Read........string read from BLE--')
 
-    def StartNotifyTimer(self):
-        if not self.notifying:
-            return
+    def read_value(self, options):
+        return self.read_text
 
-        print('start notify timer')
-        GLib.timeout_add(1000, self.NotifyTimer_cb)
+    def notify_tick(self):
+        value = 'Notify........string notify from BLE, counter: ' + str(self.count)
+        self.count += 1
+        logger.debug("%s: notify value %d", self.path, self.count)
+        self.notify_value(value)
 
     def StartNotify(self):
         if self.notifying:
-            print('Already notifying, nothing to do')
+            logger.info("%s: already notifying, nothing to do", self.path)
             return
 
-        self.notifying = True
-        self.StartNotifyTimer()
+        logger.info("%s: start notifying", self.path)
+        self.start_notifying()
 
     def StopNotify(self):
         if not self.notifying:
-            print('Not notifying, nothing to do')
+            logger.info("%s: not notifying, nothing to do", self.path)
             return
 
-        self.notifying = False
-        self.StartNotifyTimer()
+        self.stop_notifying()
+
+
+class StreamCharacteristic(Characteristic):
+    """
+    Bulk inbound data: write commands arrive through an acquired socket when BlueZ
+    supports AcquireWrite, through WriteValue otherwise. Read returns the number of
+    bytes received as uint32.
+    """
+
+    uuid = "4116f8d2-9f66-4f58-a53d-fc7440e7c150"
+    acquire_write = True
+    received_value = StructValue("<I")
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(
+            self, bus, index, self.uuid, ["read", "write-without-response"], service,
+        )
+        self.received = 0
+
+    def write_stream(self, data):
+        self.received += len(data)
+
+    def write_value(self, value, options):
+        self.write_stream(bytes(value))
+
+    def read_value(self, options):
+        return self.received_value.encode(self.received & 0xFFFFFFFF)
 
 
 class BLEAdvertisement(Advertisement):
@@ -151,25 +174,26 @@ def register_ad_error_cb(error):
 
 class CharacteristicUserDescriptionDescriptor(Descriptor):
     """
-    Writable CUD descriptor.
+    CUD descriptor, writable (up to 512 bytes, with long writes) if `writable` is set.
     """
 
     CUD_UUID = "2901"
 
     def __init__(
-            self, bus, index, characteristic,
+            self, bus, index, characteristic, writable=False,
     ):
-        self.value = array.array("B", characteristic.description)
-        self.value = self.value.tolist()
-        Descriptor.__init__(self, bus, index, self.CUD_UUID, ["read"], characteristic)
+        self.value = to_dbus_bytes(characteristic.description)
+        self.writable = writable
+        flags = ["read", "write"] if writable else ["read"]
+        Descriptor.__init__(self, bus, index, self.CUD_UUID, flags, characteristic)
 
-    def ReadValue(self, options):
+    def read_value(self, options):
         return self.value
 
-    def WriteValue(self, value, options):
+    def write_value(self, value, options):
         if not self.writable:
             raise NotPermittedException()
-        self.value = value
+        self.value = to_dbus_bytes(bytes(value))
 
 
 def register_app_cb():
@@ -183,6 +207,7 @@ def register_app_error_cb(error):
 
 def main():
     global mainloop
+    setup_logging(logging.INFO)
 
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+'''
+        The motion sensor server on the asyncio runtime (aioble.py, dbus-next)
+
+        Sensor reads are blocking I2C transactions, so they run in a one thread
+        executor while the event loop keeps answering D-Bus calls.
+
+        python3 asyncMotionSensorApp.py [--backend synthetic]
+'''
+import argparse
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from dbus_next import Variant
+
+import aioble
+from aioble import (
+    Advertisement,
+    Application,
+    BusType,
+    Characteristic,
+    FailedError,
+    MessageBus,
+    Service,
+    call,
+    find_adapter,
+)
+from blelog import setup_logging
+from mpu6050 import ACCEL_FS_SEL, GYRO_FS_SEL
+from sensors import open_backend
+from wireformat import PackedFrameEncoder, scale_code
+
+logger = logging.getLogger(__name__)
+
+# one thread: the I2C bus serves one transaction at a time anyway
+sensor_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sensor")
+
+
+class MotionService(Service):
+    service_UUID = "42673824-33e5-4aeb-ae5c-38dc66250000"
+
+    def __init__(self, index, backend):
+        Service.__init__(self, index, self.service_UUID, True)
+        self.add_characteristic(NameCharacteristic(0, self))
+        self.add_characteristic(MotionCharacteristic(1, self, backend))
+
+
+class NameCharacteristic(Characteristic):
+    uuid = "42673824-33e5-4aeb-ae5c-38dc66250001"
+
+    def __init__(self, index, service):
+        Characteristic.__init__(self, index, self.uuid, ["read"], service)
+
+    def read_value(self, options):
+        return b"MPU6050"
+
+
+class MotionCharacteristic(Characteristic):
+    """Newest sample on read, one packed sample per notification at `notify_rate` Hz"""
+
+    uuid = "42673824-33e5-4aeb-ae5c-38dc66250002"
+    executor = sensor_executor
+
+    def __init__(self, index, service, backend, rate=10.0):
+        Characteristic.__init__(self, index, self.uuid, ["read", "notify"], service)
+        self.backend = backend
+        self.encoder = PackedFrameEncoder(scale_code(ACCEL_FS_SEL, GYRO_FS_SEL))
+        self.notify_rate = rate
+        self.sequence = 0
+
+    async def sample(self):
+        try:
+            frame = await self.run_blocking(self.backend.read_frame)
+        except OSError as e:
+            raise FailedError("sensor read failed: %s" % e)
+        self.sequence += 1
+        return self.encoder.encode(self.sequence, (asyncio.get_running_loop().time(),), frame)[0]
+
+    async def read_value(self, options):
+        return await self.sample()
+
+    async def notify_tick(self):
+        await self.notify_value(await self.sample())
+
+
+class MotionAdvertisement(Advertisement):
+    def __init__(self, index):
+        Advertisement.__init__(self, index, "peripheral", "MotionSensor")
+        self.add_manufacturer_data(0xFFFF, [0x70, 0x74])
+        self.add_service_uuid(MotionService.service_UUID)
+        self.include_tx_power = True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MPU6050 BLE GATT server on asyncio")
+    parser.add_argument("--backend", choices=("smbus", "synthetic"), default="smbus",
+                        help="sensor backend (default: smbus, the MPU6050 on I2C bus 1)")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay frames recorded with `sensors.py record` instead")
+    parser.add_argument("--verbose", action="store_true", help="log debug messages")
+    return parser.parse_args()
+
+
+async def run(backend):
+    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+    adapter = await find_adapter(bus)
+    if not adapter:
+        print("GattManager1 interface not found")
+        return
+    await call(bus, aioble.BLUEZ_SERVICE_NAME, adapter, aioble.DBUS_PROP_IFACE, "Set", "ssv",
+               ("org.bluez.Adapter1", "Powered", Variant("b", True)))
+
+    app = Application()
+    app.add_service(MotionService(2, backend))
+    app.export(bus)
+    advertisement = MotionAdvertisement(0)
+
+    print("Registering GATT application...")
+    await asyncio.gather(app.register(bus, adapter), advertisement.register(bus, adapter))
+    print("GATT application and advertisement registered")
+    await bus.wait_for_disconnect()
+
+
+def main():
+    args = parse_args()
+    setup_logging(logging.DEBUG if args.verbose else logging.INFO)
+    backend = open_backend("replay", args.replay) if args.replay else open_backend(args.backend)
+    try:
+        asyncio.run(run(backend))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+'''
+        Concurrent ReadValue latency of the asyncio runtime (aioble.py) against
+        the GLib one (ble.py), on a private dbus-daemon.
+
+        Each characteristic read spends --io-ms in blocking I/O, like an I2C
+        transaction: aioble runs it in an executor, ble.py on the main loop.
+        For each concurrency level, that many clients call ReadValue in a loop
+        on different characteristics, and the latency and calls per second are
+        reported. The clients use dbus-next; the GLib server needs dbus-python.
+
+        python3 benchmarks/bench_async.py [--concurrency 1,4,16] [--io-ms 2] [--output results.json]
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from time import monotonic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dbus_next import Message, MessageType
+from dbus_next.aio import MessageBus
+
+from benchutil import latency_stats, spawn, start_bus
+
+BENCH_BUS_NAME = "org.example.BleBench"
+SERVICE_UUID = "5c3a0000-8f4b-4c2e-9d1a-000000000000"
+CHARACTERISTICS = 16
+VALUE = b"0123456789abcdefghij"
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+
+
+def characteristic_uuid(index):
+    return "5c3a0001-8f4b-4c2e-9d1a-%012x" % index
+
+
+def serve_async(io_time):
+    import aioble
+
+    class BenchCharacteristic(aioble.Characteristic):
+        async def read_value(self, options):
+            if io_time:
+                await self.run_blocking(time.sleep, io_time)
+            return VALUE
+
+    async def serve():
+        bus = await aioble.MessageBus().connect()
+        app = aioble.Application()
+        service = aioble.Service(0, SERVICE_UUID, True)
+        for i in range(CHARACTERISTICS):
+            service.add_characteristic(BenchCharacteristic(i, characteristic_uuid(i), ["read"], service))
+        app.add_service(service)
+        app.export(bus)
+        await bus.request_name(BENCH_BUS_NAME)
+        print("ready", flush=True)
+        await bus.wait_for_disconnect()
+
+    asyncio.run(serve())
+
+
+def serve_glib(io_time):
+    import dbus
+    import dbus.mainloop.glib
+    import dbus.service
+
+    from ble import Application, Characteristic, Service
+
+    try:
+        from gi.repository import GLib  # python3
+    except ImportError:
+        import gobject as GLib  # python2
+
+    class BenchCharacteristic(Characteristic):
+        def read_value(self, options):
+            if io_time:
+                time.sleep(io_time)
+            return VALUE
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    name = dbus.service.BusName(BENCH_BUS_NAME, bus)  # noqa: F841, keeps the name
+    app = Application(bus)
+    service = Service(bus, 0, SERVICE_UUID, True)
+    for i in range(CHARACTERISTICS):
+        service.add_characteristic(BenchCharacteristic(bus, i, characteristic_uuid(i), ["read"], service))
+    app.add_service(service)
+    print("ready", flush=True)
+    GLib.MainLoop().run()
+
+
+async def read_value(bus, path):
+    reply = await bus.call(Message(destination=BENCH_BUS_NAME, path=path, interface=GATT_CHRC_IFACE,
+                                   member="ReadValue", signature="a{sv}", body=[{}]))
+    if reply.message_type == MessageType.ERROR:
+        raise RuntimeError("ReadValue failed: %s %s" % (reply.error_name, reply.body))
+    return reply.body[0]
+
+
+async def measure(address, concurrency, calls):
+    """`concurrency` clients each calling ReadValue `calls` times, on their own connection"""
+    buses = [await MessageBus(bus_address=address).connect() for _ in range(concurrency)]
+    samples = []
+
+    async def client(n, bus):
+        path = "/org/bluez/example/service0/char%d" % (n % CHARACTERISTICS)
+        await read_value(bus, path)  # warm up
+        for _ in range(calls):
+            start = monotonic()
+            await read_value(bus, path)
+            samples.append(monotonic() - start)
+
+    start = monotonic()
+    await asyncio.gather(*(client(n, bus) for n, bus in enumerate(buses)))
+    elapsed = monotonic() - start
+    for bus in buses:
+        bus.disconnect()
+    result = latency_stats(samples)
+    result["calls_per_s"] = len(samples) / elapsed
+    return result
+
+
+def run(runtimes, levels, calls, io_ms):
+    if shutil.which("dbus-daemon") is None:
+        raise SystemExit("dbus-daemon not found")
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "io_ms": io_ms,
+        "runtimes": {},
+    }
+    directory = tempfile.mkdtemp(prefix="ble-bench-")
+    daemon, address = start_bus(directory)
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    try:
+        for runtime in runtimes:
+            server = spawn(__file__, ["--serve", runtime, "--io-ms", str(io_ms)], env)
+            try:
+                if server.stdout.readline().strip() != "ready":
+                    print("%s server failed to start, skipped" % runtime, file=sys.stderr)
+                    continue
+                results["runtimes"][runtime] = {}
+                for concurrency in levels:
+                    result = asyncio.run(measure(address, concurrency, calls))
+                    results["runtimes"][runtime][str(concurrency)] = result
+                    print("%-5s %3d clients: %s" % (runtime, concurrency, json.dumps(result, sort_keys=True)),
+                          file=sys.stderr)
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runtimes", default="async,glib",
+                        help="comma separated servers to measure (default: async,glib)")
+    parser.add_argument("--concurrency", default="1,4,16",
+                        help="comma separated numbers of concurrent clients (default: 1,4,16)")
+    parser.add_argument("--calls", type=int, default=200, help="calls per client")
+    parser.add_argument("--io-ms", type=float, default=2.0,
+                        help="blocking I/O per read in milliseconds (default: 2)")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--serve", choices=("async", "glib"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve == "async":
+        return serve_async(args.io_ms / 1000.0)
+    if args.serve == "glib":
+        return serve_glib(args.io_ms / 1000.0)
+
+    results = run(args.runtimes.split(","), [int(level) for level in args.concurrency.split(",")],
+                  args.calls, args.io_ms)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,418 @@
+'''
+        End-to-end benchmark of the GATT server classes in ble.py over a real
+        D-Bus connection: a private dbus-daemon, a mock org.bluez exporting
+        GattManager1 and LEAdvertisingManager1, and the application in its own
+        process, driven from this one.
+
+        Measured for each tree size (number of characteristics):
+          registration time of the application and the advertisement
+          GetManagedObjects latency
+          ReadValue round trip latency
+          PropertiesChanged notifications received per second
+          notifications read per second from the socket returned by
+          AcquireNotify (a socketpair, as bluetoothd receives it), checking
+          that each one fits the MTU and NotifyAcquired is announced
+
+        python3 benchmarks/bench_e2e.py [--sizes 1,10,100,500] [--output results.json]
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+from time import monotonic
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dbus
+import dbus.bus
+import dbus.mainloop.glib
+import dbus.service
+
+try:
+    from gi.repository import GLib  # python3
+except ImportError:
+    import gobject as GLib  # python2
+
+from benchutil import latency_stats, spawn, start_bus
+from ble import (
+    Advertisement,
+    Application,
+    Characteristic,
+    Descriptor,
+    Service,
+    find_adapter,
+    to_dbus_bytes,
+    BLUEZ_SERVICE_NAME,
+    DBUS_OM_IFACE,
+    DBUS_PROP_IFACE,
+    GATT_CHRC_IFACE,
+    GATT_MANAGER_IFACE,
+    LE_ADVERTISEMENT_IFACE,
+    LE_ADVERTISING_MANAGER_IFACE,
+)
+from wireformat import ATT_NOTIFY_OVERHEAD
+
+BENCH_BUS_NAME = "org.example.BleBench"
+ADAPTER_PATH = "/org/bluez/hci0"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+CHARACTERISTICS_PER_SERVICE = 8
+VALUE = b"0123456789abcdefghij"  # one notification payload at the default MTU
+
+
+class MockBlueZ(dbus.service.Object):
+    """
+    The parts of bluetoothd the server talks to: an object manager listing one
+    adapter, and registration methods that fetch the registered objects the way
+    bluetoothd does before replying.
+    """
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.powered = False
+        self.applications = {}
+        self.advertisements = {}
+        dbus.service.Object.__init__(self, bus, "/")
+        self.adapter = MockAdapter(bus, self)
+
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        return {
+            dbus.ObjectPath(ADAPTER_PATH): {
+                ADAPTER_IFACE: {
+                    "Address": "00:00:00:00:00:00",
+                    "Name": "bench",
+                    "Powered": dbus.Boolean(self.powered),
+                },
+                GATT_MANAGER_IFACE: {},
+                LE_ADVERTISING_MANAGER_IFACE: {
+                    "ActiveInstances": dbus.Byte(len(self.advertisements)),
+                    "SupportedInstances": dbus.Byte(5),
+                },
+            }
+        }
+
+
+class MockAdapter(dbus.service.Object):
+    def __init__(self, bus, bluez):
+        self.bluez = bluez
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+
+    @dbus.service.method(DBUS_PROP_IFACE, in_signature="ssv")
+    def Set(self, interface, name, value):
+        if interface == ADAPTER_IFACE and name == "Powered":
+            self.bluez.powered = bool(value)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply", "error"))
+    def RegisterApplication(self, path, options, sender, reply, error):
+        om = dbus.Interface(self.bluez.bus.get_object(sender, path), DBUS_OM_IFACE)
+
+        def got_objects(objects):
+            self.bluez.applications[(sender, path)] = objects
+            reply()
+
+        om.GetManagedObjects(reply_handler=got_objects, error_handler=error)
+
+    @dbus.service.method(GATT_MANAGER_IFACE, in_signature="o", sender_keyword="sender")
+    def UnregisterApplication(self, path, sender):
+        self.bluez.applications.pop((sender, path), None)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="oa{sv}", sender_keyword="sender",
+                         async_callbacks=("reply", "error"))
+    def RegisterAdvertisement(self, path, options, sender, reply, error):
+        props = dbus.Interface(self.bluez.bus.get_object(sender, path), DBUS_PROP_IFACE)
+
+        def got_properties(properties):
+            self.bluez.advertisements[(sender, path)] = properties
+            reply()
+
+        props.GetAll(LE_ADVERTISEMENT_IFACE, reply_handler=got_properties, error_handler=error)
+
+    @dbus.service.method(LE_ADVERTISING_MANAGER_IFACE, in_signature="o", sender_keyword="sender")
+    def UnregisterAdvertisement(self, path, sender):
+        self.bluez.advertisements.pop((sender, path), None)
+
+
+class BenchCharacteristic(Characteristic):
+    """
+    Readable characteristic with a fixed value. StartNotify emits `burst`
+    notifications from idle callbacks, as fast as the loop allows: signals, or
+    packets on the acquired socket once AcquireNotify was called.
+    """
+
+    burst = 20000
+    acquire_notify = True
+
+    def __init__(self, bus, index, service):
+        Characteristic.__init__(self, bus, index, "5c3a0001-8f4b-4c2e-9d1a-%012x" % index,
+                                ["read", "notify"], service)
+        self.value = to_dbus_bytes(VALUE)
+        self.add_descriptor(BenchDescriptor(bus, 0, self))
+        self.remaining = 0
+
+    def ReadValue(self, options):
+        return self.value
+
+    def StartNotify(self):
+        self.notifying = True
+        self.remaining = self.burst
+        GLib.idle_add(self.emit_batch)
+
+    def StopNotify(self):
+        self.notifying = False
+
+    def emit_batch(self):
+        for _ in range(min(100, self.remaining)):
+            self.notify_value(self.value)
+        self.remaining -= min(100, self.remaining)
+        return self.notifying and self.remaining > 0
+
+
+class BenchDescriptor(Descriptor):
+    def __init__(self, bus, index, characteristic):
+        Descriptor.__init__(self, bus, index, "2901", ["read"], characteristic)
+        self.value = to_dbus_bytes(characteristic.path)
+
+    def ReadValue(self, options):
+        return self.value
+
+
+def build_tree(bus, characteristics):
+    app = Application(bus)
+    service = None
+    for i in range(characteristics):
+        if i % CHARACTERISTICS_PER_SERVICE == 0:
+            service = Service(bus, len(app.services), "5c3a0000-8f4b-4c2e-9d1a-%012x" % len(app.services), True)
+            app.add_service(service)
+        service.add_characteristic(BenchCharacteristic(bus, i, service))
+    return app
+
+
+def serve(characteristics):
+    """GATT server process: register with the mock bluez and report the time it took"""
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    name = dbus.service.BusName(BENCH_BUS_NAME, bus)  # noqa: F841, keeps the name
+    mainloop = GLib.MainLoop()
+
+    adapter = find_adapter(bus)
+    adapter_obj = bus.get_object(BLUEZ_SERVICE_NAME, adapter)
+    dbus.Interface(adapter_obj, DBUS_PROP_IFACE).Set(ADAPTER_IFACE, "Powered", dbus.Boolean(1))
+    service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
+    ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
+
+    start = monotonic()
+    app = build_tree(bus, characteristics)
+    build_time = monotonic() - start
+    advertisement = Advertisement(bus, 0, "peripheral")
+    advertisement.add_local_name("bench")
+    advertisement.add_service_uuid(app.services[0].uuid)
+    times = {"build_ms": build_time * 1e3, "objects": len(app.get_managed_objects())}
+
+    def registered(key, start):
+        times[key] = (monotonic() - start) * 1e3
+        if "register_application_ms" in times and "register_advertisement_ms" in times:
+            print(json.dumps(times), flush=True)
+
+    def failed(error):
+        print(json.dumps({"error": str(error)}), flush=True)
+        mainloop.quit()
+
+    start = monotonic()
+    ad_manager.RegisterAdvertisement(advertisement.get_path(), {},
+                                     reply_handler=lambda: registered("register_advertisement_ms", start),
+                                     error_handler=failed)
+    start_app = monotonic()
+    service_manager.RegisterApplication(app.get_path(), {},
+                                        reply_handler=lambda: registered("register_application_ms", start_app),
+                                        error_handler=failed)
+    mainloop.run()
+
+
+def mock_bluez():
+    """org.bluez stand-in process"""
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.SessionBus()
+    name = dbus.service.BusName(BLUEZ_SERVICE_NAME, bus)  # noqa: F841, keeps the name
+    bluez = MockBlueZ(bus)  # noqa: F841
+    print("ready", flush=True)
+    GLib.MainLoop().run()
+
+
+def time_calls(call, count):
+    call()  # warm up: introspection, proxy caches
+    samples = []
+    for _ in range(count):
+        start = monotonic()
+        call()
+        samples.append(monotonic() - start)
+    return latency_stats(samples)
+
+
+def measure_notifications(bus, path, timeout=30.0):
+    """StartNotify on `path` and count the PropertiesChanged signals of one burst"""
+    received = [0, 0.0, 0.0]  # count, first, last
+    mainloop = GLib.MainLoop()
+
+    def changed(interface, changed, invalidated):
+        now = monotonic()
+        if not received[0]:
+            received[1] = now
+        received[0] += 1
+        received[2] = now
+        if received[0] == BenchCharacteristic.burst:
+            mainloop.quit()
+
+    match = bus.add_signal_receiver(changed, signal_name="PropertiesChanged",
+                                    dbus_interface=DBUS_PROP_IFACE, bus_name=BENCH_BUS_NAME, path=path)
+    chrc = dbus.Interface(bus.get_object(BENCH_BUS_NAME, path), GATT_CHRC_IFACE)
+    start = monotonic()
+    chrc.StartNotify()
+    GLib.timeout_add(int(timeout * 1000), mainloop.quit)
+    mainloop.run()
+    chrc.StopNotify()
+    match.remove()
+    elapsed = received[2] - start
+    return {
+        "sent": BenchCharacteristic.burst,
+        "received": received[0],
+        "notifications_per_s": received[0] / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def measure_socket_notifications(bus, path, mtu=185, timeout=2.0):
+    """
+    AcquireNotify on `path` as bluetoothd calls it and count the packets of one
+    burst read from the returned socket; none may exceed MTU - 3 bytes
+    """
+    acquired = []
+    mainloop = GLib.MainLoop()
+
+    def changed(interface, changed, invalidated):
+        if "NotifyAcquired" in changed:
+            acquired.append(bool(changed["NotifyAcquired"]))
+            if len(acquired) == 2:
+                mainloop.quit()
+
+    match = bus.add_signal_receiver(changed, signal_name="PropertiesChanged",
+                                    dbus_interface=DBUS_PROP_IFACE, bus_name=BENCH_BUS_NAME, path=path)
+    chrc = dbus.Interface(bus.get_object(BENCH_BUS_NAME, path), GATT_CHRC_IFACE)
+    start = monotonic()
+    fd, acquired_mtu = chrc.AcquireNotify({"mtu": dbus.UInt16(mtu)})
+    notify_socket = socket.socket(fileno=fd.take())
+    notify_socket.settimeout(timeout)
+    received = 0
+    oversized = 0
+    last = start
+    try:
+        while received < BenchCharacteristic.burst:
+            packet = notify_socket.recv(512)
+            if not packet:
+                break
+            if len(packet) > int(acquired_mtu) - ATT_NOTIFY_OVERHEAD:
+                oversized += 1
+            received += 1
+            last = monotonic()
+    except socket.timeout:
+        # values dropped by the bounded queue of the channel never arrive
+        pass
+    finally:
+        # the server sees the hang up and releases the socket, as on unsubscribe
+        notify_socket.close()
+    # wait for the NotifyAcquired signals of the acquisition and the release
+    if len(acquired) < 2:
+        GLib.timeout_add(int(timeout * 1000), mainloop.quit)
+        mainloop.run()
+    match.remove()
+    elapsed = last - start
+    return {
+        "mtu": int(acquired_mtu),
+        "sent": BenchCharacteristic.burst,
+        "received": received,
+        "oversized": oversized,
+        "notify_acquired": acquired,
+        "notifications_per_s": received / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def run(sizes, calls):
+    if shutil.which("dbus-daemon") is None:
+        raise SystemExit("dbus-daemon not found")
+    results = {
+        "python": platform.python_version(),
+        "dbus_python": getattr(dbus, "__version__", "unknown"),
+        "platform": platform.platform(),
+        "sizes": {},
+    }
+    directory = tempfile.mkdtemp(prefix="ble-bench-")
+    daemon, address = start_bus(directory)
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address)
+    bluez = spawn(__file__, ["--mock-bluez"], env)
+    try:
+        if bluez.stdout.readline().strip() != "ready":
+            raise SystemExit("mock bluez failed to start")
+        dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+        bus = dbus.bus.BusConnection(address)
+
+        for size in sizes:
+            server = spawn(__file__, ["--serve", str(size)], env)
+            try:
+                line = server.stdout.readline()
+                if not line:
+                    raise SystemExit("server with %d characteristics exited" % size)
+                result = json.loads(line)
+                if "error" in result:
+                    raise SystemExit("registration failed: %s" % result["error"])
+
+                om = dbus.Interface(bus.get_object(BENCH_BUS_NAME, "/"), DBUS_OM_IFACE)
+                result["get_managed_objects"] = time_calls(om.GetManagedObjects, calls)
+                path = "/org/bluez/example/service0/char0"
+                chrc = dbus.Interface(bus.get_object(BENCH_BUS_NAME, path), GATT_CHRC_IFACE)
+                result["read_value"] = time_calls(lambda: chrc.ReadValue({}), calls)
+                result["notify"] = measure_notifications(bus, path)
+                acquired = result["notify_socket"] = measure_socket_notifications(bus, path)
+                if acquired["oversized"] or acquired["notify_acquired"] != [True, False]:
+                    raise SystemExit("acquired notifications are broken: %s" % json.dumps(acquired))
+            finally:
+                server.terminate()
+                server.wait()
+            results["sizes"][str(size)] = result
+            print("%5d characteristics: %s" % (size, json.dumps(result, sort_keys=True)), file=sys.stderr)
+    finally:
+        bluez.terminate()
+        bluez.wait()
+        daemon.terminate()
+        daemon.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", default="1,10,100,500",
+                        help="comma separated numbers of characteristics (default: 1,10,100,500)")
+    parser.add_argument("--calls", type=int, default=500, help="calls per latency measurement")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--mock-bluez", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mock_bluez:
+        return mock_bluez()
+    if args.serve is not None:
+        return serve(args.serve)
+
+    results = run([int(size) for size in args.sizes.split(",")], args.calls)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    else:
+        print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+'''
+        Microbenchmark of notification value marshalling: the per-byte
+        dbus.Array helpers the demo apps used against the bytes-backed
+        encoders in ble.py.
+
+        python3 benchmarks/bench_marshalling.py [--json]
+'''
+import json
+import math
+import os
+import sys
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import dbus
+import dbus.lowlevel
+
+from ble import DBUS_PROP_IFACE, GATT_CHRC_IFACE, StructValue, to_dbus_bytes
+from wireformat import PackedFrameEncoder
+
+NOTIFY_STRING = "Notify........string notify from BLE, counter: 12345"
+FRAME = (812, -403, 16190, -3920, 1290, 640, -20)
+
+
+def legacy_str_to_dbusarray(word):
+    """the former app.py / motionSensorApp.py helper"""
+    return dbus.Array([dbus.Byte(ord(letter)) for letter in word], 'y')
+
+
+def legacy_sensor_value(frame):
+    """the former readSensorData() encoding: integer part and micro-units per axis"""
+    values = [a / 16384.0 * 9.8 for a in frame[:3]] + [g / 131.0 for g in frame[4:]]
+    data = b""
+    for v in values:
+        data += math.floor(v).to_bytes(4, 'little', signed=True)
+        data += math.floor((v % 1) * 1000000).to_bytes(4, 'little', signed=True)
+    return dbus.Array([dbus.Byte(b) for b in data], 'y')
+
+
+def properties_changed(value):
+    """marshal the value the way Characteristic.PropertiesChanged does"""
+    message = dbus.lowlevel.SignalMessage("/bench", DBUS_PROP_IFACE, "PropertiesChanged")
+    message.append(GATT_CHRC_IFACE, {"Value": value}, [], signature="sa{sv}as")
+    return message
+
+
+def allocated_blocks(encode, count=1000):
+    """memory blocks still held per encoded value, i.e. objects alive until it is sent"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    values = [encode() for _ in range(count)]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, "filename"))
+    del values
+    return blocks / count
+
+
+def measure(encode, number=20000):
+    us = min(timeit.repeat(lambda: properties_changed(encode()), number=number, repeat=3)) / number * 1e6
+    return {"us_per_notification": round(us, 3), "blocks_per_value": round(allocated_blocks(encode), 1)}
+
+
+def main():
+    encoder = PackedFrameEncoder(0, packet_type=dbus.ByteArray, epoch=0.0)
+    sample = StructValue("<6h")
+    axes = FRAME[:3] + FRAME[4:]
+    cases = {
+        "string/legacy_dbus_array": lambda: legacy_str_to_dbusarray(NOTIFY_STRING),
+        "string/to_dbus_bytes": lambda: to_dbus_bytes(NOTIFY_STRING),
+        "sensor/legacy_48_bytes": lambda: legacy_sensor_value(FRAME),
+        "sensor/packed_frame_encoder": lambda: encoder.encode(0, (1.0,), FRAME)[0],
+        "sensor/struct_value": lambda: sample.encode(*axes),
+    }
+    results = dict((name, measure(encode)) for name, encode in cases.items())
+
+    if "--json" in sys.argv:
+        print(json.dumps(results, indent=2, sort_keys=True))
+        return
+    print("%-30s %12s %10s" % ("case", "us/notify", "blocks"))
+    for name, result in sorted(results.items()):
+        print("%-30s %12.3f %10.1f" % (name, result["us_per_notification"], result["blocks_per_value"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+'''
+        Helpers shared by the benchmarks: a private dbus-daemon, spawning the
+        benchmark script itself in a role, and latency summaries
+'''
+import os
+import subprocess
+import sys
+
+BUS_CONFIG = """<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:dir=%s</listen>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+"""
+
+
+def latency_stats(samples):
+    """Summary of latencies in seconds, reported in microseconds"""
+    samples = sorted(samples)
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(p / 100.0 * len(samples)))] * 1e6
+
+    return {
+        "count": len(samples),
+        "mean_us": sum(samples) / len(samples) * 1e6,
+        "p50_us": percentile(50),
+        "p90_us": percentile(90),
+        "p99_us": percentile(99),
+        "max_us": samples[-1] * 1e6,
+    }
+
+
+def spawn(script, args, env):
+    """Run `script` with `args` in a new process, its stdout piped"""
+    return subprocess.Popen([sys.executable, os.path.abspath(script)] + args, env=env,
+                            stdout=subprocess.PIPE, universal_newlines=True)
+
+
+def start_bus(directory):
+    """Private dbus-daemon, returns (process, address)"""
+    config = os.path.join(directory, "bus.conf")
+    with open(config, "w") as f:
+        f.write(BUS_CONFIG % directory)
+    daemon = subprocess.Popen(["dbus-daemon", "--config-file=" + config, "--nofork", "--print-address=1"],
+                              stdout=subprocess.PIPE, universal_newlines=True)
+    return daemon, daemon.stdout.readline().strip()
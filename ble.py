@@ -1,8 +1,25 @@
 
 import dbus
+import dbus.exceptions
+import dbus.service
+import dbus.types
 
+import errno
+import json
 import logging
-import sys
+import socket
+import struct
+from collections import deque
+from functools import partial
+from time import monotonic
+
+try:
+    from gi.repository import GLib  # python3
+except ImportError:
+    import gobject as GLib  # python2
+
+from metrics import Instrumented, metrics
+from wireformat import ATT_DEFAULT_MTU, ATT_NOTIFY_OVERHEAD
 
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
@@ -16,62 +33,506 @@ LE_ADVERTISEMENT_IFACE = "org.bluez.LEAdvertisement1"
 
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
+ADAPTER_IFACE = "org.bluez.Adapter1"
+DEVICE_IFACE = "org.bluez.Device1"
+
 
+# handlers are configured by the application, see blelog.setup_logging()
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-logHandler = logging.StreamHandler()
-formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
-logHandler.setFormatter(formatter)
-logger.addHandler(logHandler)
 
-logger.setLevel(logging.DEBUG)
 
-def find_adapter(bus):
+class InvalidArgsException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.freedesktop.DBus.Error.InvalidArgs"
+
+
+class NotSupportedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.NotSupported"
+
+
+class InvalidValueLengthException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidValueLength"
+
+
+class NotPermittedException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.NotPermitted"
+
+
+class InvalidOffsetException(dbus.exceptions.DBusException):
+    _dbus_error_name = "org.bluez.Error.InvalidOffset"
+
+
+def to_dbus_bytes(value):
     """
-    Returns the first object that the bluez service has that has a GattManager1 interface
+    Represent bytes, bytearray, memoryview or str as a D-Bus byte array ("ay").
+
+    dbus.ByteArray is a single bytes-backed object, unlike dbus.Array([dbus.Byte(b) ...])
+    which allocates one Python object per byte and is marshalled byte by byte.
+    """
+    if isinstance(value, dbus.ByteArray):
+        return value
+    if isinstance(value, str):
+        value = value.encode("utf8")
+    return dbus.ByteArray(value)
+
+
+class StructValue(object):
+    """
+    Value encoder for a fixed binary layout.
+
+    The struct.Struct is compiled once and values are packed into a reused buffer,
+    so encoding allocates only the returned dbus.ByteArray.
+    """
+
+    def __init__(self, fmt):
+        self.struct = struct.Struct(fmt)
+        self.size = self.struct.size
+        self.buffer = bytearray(self.size)
+
+    def encode(self, *values):
+        self.struct.pack_into(self.buffer, 0, *values)
+        return dbus.ByteArray(self.buffer)
+
+    def decode(self, value):
+        return self.struct.unpack(bytes(value))
+
+
+class ReadSnapshots(object):
+    """
+    Long read support for ReadValue.
+
+    A value longer than one ATT read response (MTU - 1 bytes) is fetched by the
+    client with further reads at increasing offsets. The value produced at
+    offset 0 is kept per device and the following offsets are sliced from it
+    through a memoryview, so the pieces belong to the same value and it is
+    produced once. A snapshot is dropped when a piece shorter than MTU - 1
+    bytes is served (a full-size piece makes the client read again, at the
+    end of the value, which gets an empty response), when the device starts
+    a new read, or after `timeout` seconds.
+    """
+
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        # device -> (memoryview of the value, time of the offset 0 read)
+        self.snapshots = {}
+        # device -> reads started
+        self.device_reads = {}
+        self.reads = 0
+        self.long_reads = 0
+        self.expired = 0
+
+    def read(self, options, read_value):
+        offset = int(options.get("offset", 0))
+        device = options.get("device")
+        mtu = int(options.get("mtu", ATT_DEFAULT_MTU))
+        now = monotonic()
+        snapshot = self.snapshots.get(device)
+        if offset == 0 or snapshot is None or now - snapshot[1] > self.timeout:
+            if offset == 0:
+                self.reads += 1
+                self.device_reads[device] = self.device_reads.get(device, 0) + 1
+                # a new read, whatever its length, ends an interrupted long read
+                self.snapshots.pop(device, None)
+                self.expire(now)
+            value = to_dbus_bytes(read_value(options))
+            if offset == 0 and len(value) < mtu - 1:
+                return value
+            snapshot = (memoryview(value), now)
+            self.snapshots[device] = snapshot
+            if offset == 0:
+                self.long_reads += 1
+                return value
+
+        view = snapshot[0]
+        if offset > len(view):
+            raise InvalidOffsetException()
+        if offset + mtu - 1 > len(view):
+            # the response carries the rest of the value and is short, the
+            # client reads no further (empty at offset == len(view))
+            del self.snapshots[device]
+        return dbus.ByteArray(view[offset:])
+
+    def expire(self, now):
+        for device, snapshot in tuple(self.snapshots.items()):
+            if now - snapshot[1] > self.timeout:
+                del self.snapshots[device]
+                self.expired += 1
+
+    def clear(self):
+        self.snapshots.clear()
+
+
+class WriteReassembly(object):
+    """
+    Long (prepared) write support for WriteValue.
+
+    A value longer than one write request is sent by the client as prepared
+    fragments, which BlueZ passes on execution as writes of type "reliable" at
+    their offsets. The fragments are copied into a bytearray of `max_length`
+    bytes allocated once per device, and the handler is called once with the
+    complete value when `expected_length` bytes were written, else at the
+    next boundary: a prepare authorization request ("prepare-authorize", sent
+    for characteristics with the "authorize" flag) or any write at offset 0
+    starts a new value, so the pending one was executed. No fragment
+    for `timeout` seconds completes it too. A handler error is raised to the
+    write that completed it; one raised after the execution (at a timeout or
+    a boundary) cannot reach the client and is logged and counted in
+    `handler_errors`.
+    """
+
+    def __init__(self, max_length=512, expected_length=None, timeout=0.05):
+        self.max_length = max_length
+        self.expected_length = expected_length
+        self.timeout = timeout
+        self.buffers = {}  # device -> bytearray(max_length)
+        # device -> [length, fragments, first and last fragment time, GLib source, handler, options]
+        self.pending = {}
+        # device -> [write requests, bytes written]
+        self.device_writes = {}
+        self.writes = 0
+        self.long_writes = 0
+        self.fragments = 0
+        self.rejected = 0
+        self.handler_errors = 0
+        self.reassembly_time_last = 0.0
+        self.reassembly_time_max = 0.0
+        self._reassembly_time_total = 0.0
+
+    def write(self, value, options, write_value):
+        offset = int(options.get("offset", 0))
+        device = options.get("device")
+        if offset > self.max_length:
+            self.rejected += 1
+            raise InvalidOffsetException()
+        if offset + len(value) > self.max_length:
+            self.rejected += 1
+            raise InvalidValueLengthException()
+        if options.get("prepare-authorize"):
+            if offset == 0:
+                self._complete_executed(device)
+            return
+        counts = self.device_writes.get(device)
+        if counts is None:
+            counts = self.device_writes[device] = [0, 0]
+        counts[0] += 1
+        counts[1] += len(value)
+        if offset == 0 and options.get("type") != "reliable":
+            self._complete_executed(device)
+            self.writes += 1
+            write_value(value, options)
+            return
+
+        if offset == 0:
+            self._complete_executed(device)
+        pending = self.pending.get(device)
+        if pending is None:
+            if offset != 0:
+                # the start of this write was not seen, or it timed out
+                self.rejected += 1
+                raise InvalidOffsetException()
+            options = dict(options)
+            options.pop("offset", None)
+            now = monotonic()
+            pending = self.pending[device] = [0, 0, now, now, None, write_value, options]
+        elif pending[4] is not None:
+            GLib.source_remove(pending[4])
+            pending[4] = None
+
+        buffer = self.buffers.get(device)
+        if buffer is None:
+            buffer = self.buffers[device] = bytearray(self.max_length)
+        buffer[offset:offset + len(value)] = bytes(value)
+        pending[0] = max(pending[0], offset + len(value))
+        pending[1] += 1
+        pending[3] = monotonic()
+        self.fragments += 1
+        if self.expected_length is not None and pending[0] >= self.expected_length:
+            try:
+                self.complete(device)
+            except Exception:
+                self.handler_errors += 1
+                raise
+        else:
+            pending[4] = GLib.timeout_add(int(self.timeout * 1000), self._timed_out, device)
+
+    def complete(self, device):
+        """Call the handler with the value reassembled for `device`"""
+        length, fragments, first, last, source, write_value, options = self.pending.pop(device)
+        if source is not None:
+            GLib.source_remove(source)
+        self.long_writes += 1
+        # first to last fragment, not including the completion timeout
+        self.reassembly_time_last = last - first
+        if self.reassembly_time_last > self.reassembly_time_max:
+            self.reassembly_time_max = self.reassembly_time_last
+        self._reassembly_time_total += self.reassembly_time_last
+        write_value(dbus.ByteArray(memoryview(self.buffers[device])[:length]), options)
+
+    def _complete_executed(self, device):
+        """Complete the value pending for `device`, whose write was already answered"""
+        if device not in self.pending:
+            return
+        try:
+            self.complete(device)
+        except Exception:
+            self.handler_errors += 1
+            logger.exception("long write from %s failed" % device)
+
+    def _timed_out(self, device):
+        # one-shot source, destroyed when this returns
+        self.pending[device][4] = None
+        self._complete_executed(device)
+        return False
+
+    def discard(self, device):
+        pending = self.pending.pop(device, None)
+        if pending is not None and pending[4] is not None:
+            GLib.source_remove(pending[4])
+
+    def stats(self):
+        return {
+            "writes": self.writes,
+            "long_writes": self.long_writes,
+            "fragments": self.fragments,
+            "fragments_per_long_write": self.fragments / self.long_writes if self.long_writes else 0.0,
+            "rejected": self.rejected,
+            "handler_errors": self.handler_errors,
+            "pending": len(self.pending),
+            "reassembly_time_last": self.reassembly_time_last,
+            "reassembly_time_max": self.reassembly_time_max,
+            "reassembly_time_mean": self._reassembly_time_total / self.long_writes if self.long_writes else 0.0,
+        }
+
+
+class NotifyTimer(object):
+    """
+    Periodic GLib timer for notifications at `rate` Hz.
+
+    Every tick is scheduled as a one-shot timeout towards an absolute deadline, so
+    the callback run time does not add up to drift like a plain timeout_add(period)
+    does. Ticks more than a period late are skipped rather than fired in a burst.
+    The achieved rate and the lateness (jitter) of each tick are recorded.
+    """
+
+    def __init__(self, callback, rate=1.0):
+        self.callback = callback
+        self.period = 1.0 / rate
+        self.running = False
+        self.source_id = None
+        self._deadline = 0.0
+        self.reset_stats()
+
+    @property
+    def rate(self):
+        return 1.0 / self.period
+
+    def set_rate(self, rate):
+        self.period = 1.0 / rate
+        if self.running:
+            self.stop()
+            self.start()
+
+    def reset_stats(self):
+        self.ticks = 0
+        self.skipped = 0
+        self.started = monotonic()
+        self.jitter_max = 0.0
+        self._jitter_total = 0.0
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.reset_stats()
+        self._deadline = monotonic() + self.period
+        self._schedule(monotonic())
+
+    def stop(self):
+        self.running = False
+        if self.source_id is not None:
+            GLib.source_remove(self.source_id)
+            self.source_id = None
+
+    def _schedule(self, now):
+        delay_ms = max(0, int((self._deadline - now) * 1000 + 0.5))
+        self.source_id = GLib.timeout_add(delay_ms, self._fire)
+
+    def _fire(self):
+        # one-shot source, it is destroyed when this returns
+        self.source_id = None
+        now = monotonic()
+        jitter = now - self._deadline
+        if jitter > self.jitter_max:
+            self.jitter_max = jitter
+        self._jitter_total += abs(jitter)
+        self.ticks += 1
+
+        self._deadline += self.period
+        if now - self._deadline > self.period:
+            missed = int((now - self._deadline) / self.period)
+            self.skipped += missed
+            self._deadline += missed * self.period
+
+        self.callback()
+        # the callback may have stopped or restarted the timer
+        if self.running and self.source_id is None:
+            self._schedule(monotonic())
+        return False
+
+    def stats(self):
+        elapsed = monotonic() - self.started
+        return {
+            "rate": self.rate,
+            "achieved_rate": self.ticks / elapsed if elapsed > 0 else 0.0,
+            "jitter_mean": self._jitter_total / self.ticks if self.ticks else 0.0,
+            "jitter_max": self.jitter_max,
+            "skipped": self.skipped,
+        }
+
+
+class NotificationScheduler(object):
+    """
+    Owns the periodic sources of all notifying characteristics.
+
+    Characteristics notifying at the same rate share one NotifyTimer, whose tick
+    calls notify_tick() on each of them, so the number of timers (and main loop
+    wakeups) depends on the number of distinct rates, not of characteristics.
+    Unsubscribing the last characteristic of a rate removes its GLib source.
+    """
+
+    def __init__(self):
+        self.timers = {}  # rate -> NotifyTimer
+        self.groups = {}  # rate -> [characteristic]
+        self.rates = {}  # characteristic -> rate
+
+    def subscribe(self, characteristic, rate):
+        rate = float(rate)
+        if self.rates.get(characteristic) == rate:
+            return
+        self.unsubscribe(characteristic)
+        self.rates[characteristic] = rate
+        self.groups.setdefault(rate, []).append(characteristic)
+        if rate not in self.timers:
+            timer = NotifyTimer(partial(self._tick, rate), rate)
+            self.timers[rate] = timer
+            timer.start()
+
+    def unsubscribe(self, characteristic):
+        rate = self.rates.pop(characteristic, None)
+        if rate is None:
+            return
+        group = self.groups[rate]
+        group.remove(characteristic)
+        if not group:
+            del self.groups[rate]
+            self.timers.pop(rate).stop()
+
+    def _tick(self, rate):
+        # copy, a characteristic may unsubscribe from its own tick
+        for characteristic in tuple(self.groups.get(rate, ())):
+            characteristic.notify_tick()
+
+    def active_timers(self):
+        return len(self.timers)
+
+    def stats(self, characteristic):
+        rate = self.rates.get(characteristic)
+        if rate is None:
+            return None
+        return self.timers[rate].stats()
+
+
+notification_scheduler = NotificationScheduler()
+
+
+def find_adapters(bus):
+    """
+    Returns (path, properties) of every object that the bluez service has that has a
+    GattManager1 interface, sorted by path. `properties` are the org.bluez.Adapter1
+    properties (Address, Name, Powered, ...) plus "Advertising", whether the adapter
+    has an LEAdvertisingManager1.
     """
     remote_om = dbus.Interface(bus.get_object(BLUEZ_SERVICE_NAME, "/"), DBUS_OM_IFACE)
     objects = remote_om.GetManagedObjects()
 
+    adapters = []
     for o, props in objects.items():
         if GATT_MANAGER_IFACE in props.keys():
-            return o
+            properties = dict(props.get(ADAPTER_IFACE, {}))
+            properties["Advertising"] = LE_ADVERTISING_MANAGER_IFACE in props
+            adapters.append((o, properties))
+    return sorted(adapters)
 
-    return None
 
-class Application(dbus.service.Object):
+def find_adapter(bus):
+    """
+    Returns the first object that the bluez service has that has a GattManager1 interface
+    """
+    adapters = find_adapters(bus)
+    return adapters[0][0] if adapters else None
+
+class Application(Instrumented, dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
+
+    The managed object tree is built once and cached. Adding a service, characteristic
+    or descriptor, or calling invalidate() on an object whose properties changed,
+    drops the cache so the next GetManagedObjects rebuilds it.
     """
 
-    def __init__(self, bus):
-        self.path = "/"
+    # timed by metrics when enabled, in this class and in subclasses
+    instrumented_methods = ("GetManagedObjects",)
+
+    def __init__(self, bus, path="/"):
+        # BlueZ only looks for the services below the registered path
+        self.path = path
         self.services = []
+        # object path -> Service, Characteristic or Descriptor
+        self.objects = {}
+        self._managed_objects = None
         dbus.service.Object.__init__(self, bus, self.path)
 
-        
-
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.index_object(service)
+
+    def index_object(self, obj):
+        """Add `obj` and the objects below it to the path index"""
+        self.objects[obj.path] = obj
+        if isinstance(obj, Service):
+            for chrc in obj.characteristics:
+                self.index_object(chrc)
+        elif isinstance(obj, Characteristic):
+            for desc in obj.descriptors:
+                self.index_object(desc)
+        self.invalidate()
+
+    def get_object(self, path):
+        return self.objects.get(path)
+
+    def invalidate(self):
+        self._managed_objects = None
+
+    def get_managed_objects(self):
+        if self._managed_objects is None:
+            response = {}
+            for service in self.services:
+                response[service.get_path()] = service.get_properties()
+                for chrc in service.get_characteristics():
+                    response[chrc.get_path()] = chrc.get_properties()
+                    for desc in chrc.get_descriptors():
+                        response[desc.get_path()] = desc.get_properties()
+            self._managed_objects = response
+
+        return self._managed_objects
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
     def GetManagedObjects(self):
-        response = {}
         logger.info("GetManagedObjects")
-
-        for service in self.services:
-            response[service.get_path()] = service.get_properties()
-            chrcs = service.get_characteristics()
-            for chrc in chrcs:
-                response[chrc.get_path()] = chrc.get_properties()
-                descs = chrc.get_descriptors()
-                for desc in descs:
-                    response[desc.get_path()] = desc.get_properties()
-
-        return response
+        return self.get_managed_objects()
 
 
 class Service(dbus.service.Object):
@@ -81,30 +542,47 @@ class Service(dbus.service.Object):
 
     PATH_BASE = "/org/bluez/example/service"
 
-    def __init__(self, bus, index, uuid, primary):
-        self.path = self.PATH_BASE + str(index)
+    def __init__(self, bus, index, uuid, primary, path_base=None):
+        # another path_base puts the service below the path of another application
+        self.path = (path_base or self.PATH_BASE) + str(index)
         self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.application = None
+        self._properties = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_SERVICE_IFACE: {
-                "UUID": self.uuid,
-                "Primary": self.primary,
-                "Characteristics": dbus.Array(
-                    self.get_characteristic_paths(), signature="o"
-                ),
+        if self._properties is None:
+            self._properties = {
+                GATT_SERVICE_IFACE: {
+                    "UUID": self.uuid,
+                    "Primary": self.primary,
+                    "Characteristics": dbus.Array(
+                        self.get_characteristic_paths(), signature="o"
+                    ),
+                }
             }
-        }
+        return self._properties
+
+    def get_application(self):
+        return self.application
+
+    def invalidate(self):
+        """Drop the cached properties, call after changing one of them"""
+        self._properties = None
+        if self.application is not None:
+            self.application.invalidate()
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
+        if self.application is not None:
+            self.application.index_object(characteristic)
 
     def get_characteristic_paths(self):
         result = []
@@ -123,11 +601,112 @@ class Service(dbus.service.Object):
         return self.get_properties()[GATT_SERVICE_IFACE]
 
 
-class Characteristic(dbus.service.Object):
+class NotifyChannel(object):
+    """
+    Notification state of an acquired notification socket.
+
+    Values are queued in a bounded queue that drops the oldest value when the
+    socket falls behind, and `send(value)` is called as long as it accepts them
+    (returns True) and the `rate` cap (notifications per second, None for no
+    cap) allows. Sent values and bytes and dropped values are counted.
+    """
+
+    def __init__(self, send, rate=None, queue_size=16):
+        self.send = send
+        self.rate = rate
+        self.queue = deque(maxlen=queue_size)
+        self.sent = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.started = monotonic()
+        self._next_send = 0.0
+
+    def push(self, value):
+        """Queue `value`, returns False if the oldest queued value was dropped for it"""
+        dropped = len(self.queue) == self.queue.maxlen
+        if dropped:
+            self.dropped += 1
+        self.queue.append(value)
+        return not dropped
+
+    def flush(self, now):
+        queue = self.queue
+        while queue:
+            if self.rate is not None and now < self._next_send:
+                return
+            if not self.send(queue[0]):
+                # the channel is full, retry on the next flush
+                return
+            value = queue.popleft()
+            self.sent += 1
+            self.sent_bytes += len(value)
+            if self.rate is not None:
+                period = 1.0 / self.rate
+                # no credit for idle time, at most one notification per period
+                self._next_send = max(self._next_send, now - period) + period
+
+    def stats(self):
+        elapsed = monotonic() - self.started
+        return {
+            "rate_cap": self.rate,
+            "sent": self.sent,
+            "sent_per_s": self.sent / elapsed if elapsed > 0 else 0.0,
+            "bytes_per_s": self.sent_bytes / elapsed if elapsed > 0 else 0.0,
+            "dropped": self.dropped,
+            "queued": len(self.queue),
+        }
+
+
+class Characteristic(Instrumented, dbus.service.Object):
     """
     org.bluez.GattCharacteristic1 interface implementation
+
+    Subclasses that notify periodically call start_notifying()/stop_notifying()
+    from StartNotify/StopNotify and send their value from notify_tick(), which the
+    shared NotificationScheduler calls at `notify_rate` Hz.
+
+    With `acquire_notify` set, BlueZ may call AcquireNotify instead of StartNotify
+    and notify_value() then writes straight to the returned socket, bypassing the
+    PropertiesChanged signal and its unmarshalling in bluetoothd.
+
+    With `acquire_write` set (and the "write-without-response" flag), BlueZ may
+    call AcquireWrite and forward every write command through a socket; each
+    packet is passed to write_stream() without a D-Bus call per write.
+
+    Readable subclasses implement read_value(options) returning the whole value;
+    ReadValue serves it, long values through ReadSnapshots. Writable subclasses
+    implement write_value(value, options), called once per value, long writes
+    being reassembled by WriteReassembly. Overriding ReadValue or WriteValue
+    itself still works for values that always fit in one request.
+
+    Notifications are not per client. StartNotify carries no device, and
+    bluetoothd acquires one socket per characteristic whatever the number of
+    subscribers; it sends each signal or socket write to every subscribed
+    device. So subscriptions, rate caps, queues and counters cannot be kept
+    per device here, and a slow link holds back all of them. PropertiesChanged
+    is emitted directly and counted (`signal_sent`, `signal_bytes`). An
+    acquired socket can push back, so it gets a NotifyChannel in
+    `socket_channel`, with a bounded queue, a rate cap (`set_socket_rate()`)
+    and counters.
     """
 
+    scheduler = notification_scheduler
+    notify_rate = 1.0
+    acquire_notify = False
+    acquire_write = False
+    # rate cap (notifications per second) and queue length of an acquired socket
+    socket_rate = None
+    socket_queue_size = 16
+    # seconds a long read snapshot is kept, see ReadSnapshots
+    read_snapshot_timeout = 5.0
+    # longest value accepted by long writes and, for fixed size values, the
+    # length completing it; see WriteReassembly
+    max_write_length = 512
+    write_length = None
+    # timed by metrics when enabled, in this class and in subclasses
+    instrumented_methods = ("GetAll", "ReadValue", "WriteValue", "StartNotify", "StopNotify",
+                            "AcquireNotify", "AcquireWrite", "notify_value")
+
     def __init__(self, bus, index, uuid, flags, service):
         self.path = service.path + "/char" + str(index)
         self.bus = bus
@@ -135,23 +714,69 @@ class Characteristic(dbus.service.Object):
         self.service = service
         self.flags = flags
         self.descriptors = []
+        self.notifying = False
+        # MTUs passed to AcquireNotify and AcquireWrite; notifications are sized
+        # to notify_mtu, the default MTU every device supports when not acquired
+        self.notify_mtu = ATT_DEFAULT_MTU
+        self.write_mtu = ATT_DEFAULT_MTU
+        # reused for every PropertiesChanged emitted by notify_value()
+        self._changed = {}
+        self._properties = None
+        self.notify_socket = None
+        self._notify_watch = None
+        # values dropped by the socket channel
+        self.notify_dropped = 0
+        self.socket_channel = None
+        self.signal_sent = 0
+        self.signal_bytes = 0
+        self.read_snapshots = ReadSnapshots(self.read_snapshot_timeout)
+        self.write_reassembly = WriteReassembly(self.max_write_length, self.write_length)
+        self.write_socket = None
+        self._write_watch = None
+        self._write_buffer = None
+        self.write_packets = 0
+        self.write_bytes = 0
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_CHRC_IFACE: {
+        if self._properties is None:
+            properties = {
                 "Service": self.service.get_path(),
                 "UUID": self.uuid,
                 "Flags": self.flags,
                 "Descriptors": dbus.Array(self.get_descriptor_paths(), signature="o"),
             }
-        }
+            if self.acquire_notify:
+                # the presence of the property tells BlueZ AcquireNotify is supported
+                properties["NotifyAcquired"] = dbus.Boolean(self.notify_socket is not None)
+            if self.acquire_write:
+                properties["WriteAcquired"] = dbus.Boolean(self.write_socket is not None)
+            self._properties = {GATT_CHRC_IFACE: properties}
+        return self._properties
+
+    def get_application(self):
+        return self.service.get_application()
+
+    def invalidate(self):
+        """Drop the cached properties, call after changing one of them"""
+        self._properties = None
+        application = self.get_application()
+        if application is not None:
+            application.invalidate()
+
+    def set_flags(self, flags):
+        self.flags = flags
+        self.invalidate()
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.invalidate()
+        application = self.get_application()
+        if application is not None:
+            application.index_object(descriptor)
 
     def get_descriptor_paths(self):
         result = []
@@ -171,50 +796,298 @@ class Characteristic(dbus.service.Object):
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="ay")
     def ReadValue(self, options):
-        logger.info("Default ReadValue called, returning error")
+        return self.read_snapshots.read(options, self.read_value)
+
+    def read_value(self, options):
+        """Return the whole value (bytes-like or str), override to make the characteristic readable"""
+        logger.info("%s: default %s called, returning error", self.path, "ReadValue")
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE, in_signature="aya{sv}")
     def WriteValue(self, value, options):
-        logger.info("Default WriteValue called, returning error")
+        self.write_reassembly.write(value, options, self.write_value)
+
+    def write_value(self, value, options):
+        """Called with each complete written value, override to make the characteristic writable"""
+        logger.info("%s: default %s called, returning error", self.path, "WriteValue")
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StartNotify(self):
-        logger.info("Default StartNotify called, returning error")
+        logger.info("%s: default %s called, returning error", self.path, "StartNotify")
         raise NotSupportedException()
 
     @dbus.service.method(GATT_CHRC_IFACE)
     def StopNotify(self):
-        logger.info("Default StopNotify called, returning error")
+        logger.info("%s: default %s called, returning error", self.path, "StopNotify")
         raise NotSupportedException()
 
     @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
 
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="hq")
+    def AcquireNotify(self, options):
+        if not self.acquire_notify:
+            raise NotSupportedException()
+        if self.notify_socket is not None:
+            raise NotPermittedException()
+
+        self.notify_mtu = int(options.get("mtu", ATT_DEFAULT_MTU))
+        ours, theirs = self.acquire_socketpair()
+        ours.setblocking(False)
+        self.notify_socket = ours
+        self._notify_watch = GLib.io_add_watch(
+            ours.fileno(), GLib.IO_HUP | GLib.IO_ERR, self._notify_socket_closed
+        )
+        self.socket_channel = NotifyChannel(self._send_socket, self.socket_rate, self.socket_queue_size)
+        self.acquired_changed("NotifyAcquired", True)
+        # the socket serves every device that subscribes while it is open,
+        # not only the one that made bluetoothd acquire it
+        logger.info("%s: notifications acquired (first subscriber %s), mtu %d"
+                    % (self.path, options.get("device", "unknown"), self.notify_mtu))
+
+        # UnixFd duplicates the descriptor, BlueZ owns the copy
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        try:
+            self.StartNotify()
+        except Exception:
+            self.release_notify()
+            raise
+        return fd, dbus.UInt16(self.notify_mtu)
+
+    def acquired_changed(self, name, acquired):
+        """Announce a change of NotifyAcquired or WriteAcquired"""
+        self.invalidate()
+        self.PropertiesChanged(GATT_CHRC_IFACE, {name: dbus.Boolean(acquired)}, [])
+
+    def acquire_socketpair(self):
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    def release_notify(self):
+        if self.notify_socket is None:
+            return
+        if self._notify_watch is not None:
+            GLib.source_remove(self._notify_watch)
+            self._notify_watch = None
+        self.notify_socket.close()
+        self.notify_socket = None
+        self.notify_mtu = ATT_DEFAULT_MTU
+        self.socket_channel = None
+        self.acquired_changed("NotifyAcquired", False)
+        logger.info("%s: acquired notifications released" % self.path)
+        if self.notifying:
+            self.StopNotify()
+
+    def _notify_socket_closed(self, fd, condition):
+        # the remote end hung up: the client unsubscribed or disconnected
+        self._notify_watch = None
+        self.release_notify()
+        return False
+
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="hq")
+    def AcquireWrite(self, options):
+        if not self.acquire_write:
+            raise NotSupportedException()
+        if self.write_socket is not None:
+            raise NotPermittedException()
+
+        self.write_mtu = int(options.get("mtu", ATT_DEFAULT_MTU))
+        ours, theirs = self.acquire_socketpair()
+        ours.setblocking(False)
+        self.write_socket = ours
+        # one write command carries at most MTU - 3 bytes, received into a reused buffer
+        self._write_buffer = bytearray(self.write_mtu)
+        self._write_watch = GLib.io_add_watch(
+            ours.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._write_socket_ready
+        )
+        self.acquired_changed("WriteAcquired", True)
+        logger.info("%s: writes acquired, mtu %d" % (self.path, self.write_mtu))
+
+        fd = dbus.types.UnixFd(theirs)
+        theirs.close()
+        return fd, dbus.UInt16(self.write_mtu)
+
+    def release_write(self):
+        if self.write_socket is None:
+            return
+        if self._write_watch is not None:
+            GLib.source_remove(self._write_watch)
+            self._write_watch = None
+        self.write_socket.close()
+        self.write_socket = None
+        self.acquired_changed("WriteAcquired", False)
+        logger.info("%s: acquired writes released" % self.path)
+
+    def _write_socket_ready(self, fd, condition):
+        view = memoryview(self._write_buffer)
+        while True:
+            try:
+                length = self.write_socket.recv_into(self._write_buffer)
+            except BlockingIOError:
+                return True
+            except OSError:
+                break
+            if not length:
+                # remote end closed
+                break
+            self.write_packets += 1
+            self.write_bytes += length
+            try:
+                self.write_stream(view[:length])
+            except Exception:
+                logger.exception("%s: write_stream failed" % self.path)
+
+        self._write_watch = None
+        self.release_write()
+        return False
+
+    def write_stream(self, data):
+        """
+        Called with a memoryview of each packet written through an acquired socket.
+        The view is only valid during the call, copy what has to be kept.
+        """
+        pass
+
+    def notify_value(self, value):
+        """
+        Send `value` (bytes-like or str) to subscribed devices as a notification.
+
+        With an acquired socket the value is queued on its channel and the queue
+        is flushed as far as the socket and its rate cap allow; what is left is
+        retried on the next call. Otherwise PropertiesChanged is emitted.
+        """
+        channel = self.socket_channel
+        if channel is None:
+            self._send_signal(value)
+            return
+        if not channel.push(value):
+            self.notify_dropped += 1
+        channel.flush(monotonic())
+
+    def _send_signal(self, value):
+        self._changed["Value"] = to_dbus_bytes(value)
+        self.PropertiesChanged(GATT_CHRC_IFACE, self._changed, [])
+        self.signal_sent += 1
+        self.signal_bytes += len(value)
+
+    def _send_socket(self, value):
+        """
+        Write `value` to the acquired socket. Each write is one notification, so
+        values longer than MTU - 3 are split into several.
+        """
+        if self.notify_socket is None:
+            return False
+        if isinstance(value, str):
+            value = value.encode("utf8")
+        view = memoryview(value)
+        chunk = self.notify_mtu - ATT_NOTIFY_OVERHEAD
+        offset = 0
+        try:
+            for offset in range(0, len(view), chunk):
+                self.notify_socket.send(view[offset:offset + chunk])
+        except BlockingIOError:
+            # bluetoothd is not keeping up with the link: keep the value queued
+            # unless part of it went out already
+            return offset > 0
+        except OSError as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN):
+                raise
+            self.release_notify()
+            return False
+        return True
+
+    def set_socket_rate(self, rate):
+        """Cap the notifications per second written to an acquired socket (None removes the cap)"""
+        self.socket_rate = rate
+        if self.socket_channel is not None:
+            self.socket_channel.rate = rate
+
+    def notify_counters(self):
+        """Notifications sent as signals and, while acquired, the socket channel stats"""
+        counters = {"signal": {"sent": self.signal_sent, "sent_bytes": self.signal_bytes}}
+        if self.socket_channel is not None:
+            counters["socket"] = self.socket_channel.stats()
+        return counters
+
+    def start_notifying(self):
+        self.notifying = True
+        self.scheduler.subscribe(self, self.notify_rate)
+
+    def stop_notifying(self):
+        self.notifying = False
+        self.scheduler.unsubscribe(self)
+
+    def set_notify_rate(self, rate):
+        self.notify_rate = rate
+        if self.notifying:
+            self.scheduler.subscribe(self, rate)
+
+    def notify_stats(self):
+        """Achieved rate and jitter of the timer driving this characteristic"""
+        stats = self.scheduler.stats(self)
+        if stats is None:
+            stats = {"rate": self.notify_rate, "achieved_rate": 0.0, "jitter_mean": 0.0,
+                     "jitter_max": 0.0, "skipped": 0}
+        return stats
+
+    def notify_tick(self):
+        """Called by the scheduler while notifying, override to send the current value"""
+        pass
+
 
-class Descriptor(dbus.service.Object):
+class Descriptor(Instrumented, dbus.service.Object):
     """
     org.bluez.GattDescriptor1 interface implementation
+
+    Readable and writable subclasses implement read_value(options) and
+    write_value(value, options), as for Characteristic.
     """
 
+    # timed by metrics when enabled, in this class and in subclasses
+    instrumented_methods = ("GetAll", "ReadValue", "WriteValue")
+    # seconds a long read snapshot is kept, see ReadSnapshots
+    read_snapshot_timeout = 5.0
+    # longest value accepted by long writes, see WriteReassembly
+    max_write_length = 512
+    write_length = None
+
     def __init__(self, bus, index, uuid, flags, characteristic):
         self.path = characteristic.path + "/desc" + str(index)
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
         self.chrc = characteristic
+        self._properties = None
+        self.read_snapshots = ReadSnapshots(self.read_snapshot_timeout)
+        self.write_reassembly = WriteReassembly(self.max_write_length, self.write_length)
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
-        return {
-            GATT_DESC_IFACE: {
-                "Characteristic": self.chrc.get_path(),
-                "UUID": self.uuid,
-                "Flags": self.flags,
+        if self._properties is None:
+            self._properties = {
+                GATT_DESC_IFACE: {
+                    "Characteristic": self.chrc.get_path(),
+                    "UUID": self.uuid,
+                    "Flags": self.flags,
+                }
             }
-        }
+        return self._properties
+
+    def get_application(self):
+        return self.chrc.get_application()
+
+    def invalidate(self):
+        """Drop the cached properties, call after changing one of them"""
+        self._properties = None
+        application = self.get_application()
+        if application is not None:
+            application.invalidate()
+
+    def set_flags(self, flags):
+        self.flags = flags
+        self.invalidate()
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
@@ -228,15 +1101,183 @@ class Descriptor(dbus.service.Object):
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature="a{sv}", out_signature="ay")
     def ReadValue(self, options):
-        logger.info("Default ReadValue called, returning error")
+        return self.read_snapshots.read(options, self.read_value)
+
+    def read_value(self, options):
+        """Return the whole value (bytes-like or str), override to make the descriptor readable"""
+        logger.info("%s: default %s called, returning error", self.path, "ReadValue")
         raise NotSupportedException()
 
     @dbus.service.method(GATT_DESC_IFACE, in_signature="aya{sv}")
     def WriteValue(self, value, options):
-        logger.info("Default WriteValue called, returning error")
+        self.write_reassembly.write(value, options, self.write_value)
+
+    def write_value(self, value, options):
+        """Called with each complete written value, override to make the descriptor writable"""
+        logger.info("%s: default %s called, returning error", self.path, "WriteValue")
+        raise NotSupportedException()
+
+
+class NotifyRateCharacteristic(Characteristic):
+    """
+    Control point for the notification rate of `target`.
+
+    Write a little endian uint16 rate in Hz between `min_rate` and `max_rate`
+    to change the rate of the target's timer, for every subscribed device.
+    Read returns the configured rate (uint16 Hz), the achieved rate (float32 Hz)
+    and the mean and maximum tick jitter (uint32 us each).
+    """
+
+    rate_value = StructValue("<H")
+    stats_value = StructValue("<HfII")
+
+    def __init__(self, bus, index, uuid, service, target, min_rate=1, max_rate=100):
+        Characteristic.__init__(self, bus, index, uuid, ["read", "write"], service)
+        self.target = target
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+
+    def ReadValue(self, options):
+        stats = self.target.notify_stats()
+        return self.stats_value.encode(
+            int(round(stats["rate"])),
+            stats["achieved_rate"],
+            min(int(stats["jitter_mean"] * 1e6), 0xFFFFFFFF),
+            min(int(stats["jitter_max"] * 1e6), 0xFFFFFFFF),
+        )
+
+    def WriteValue(self, value, options):
+        if len(value) != self.rate_value.size:
+            raise InvalidValueLengthException()
+        rate, = self.rate_value.decode(value)
+        if not self.min_rate <= rate <= self.max_rate:
+            raise InvalidArgsException("rate must be %d..%d Hz" % (self.min_rate, self.max_rate))
+        self.target.set_notify_rate(rate)
+
+
+class DiagnosticsCharacteristic(Characteristic):
+    """
+    Summary of the metrics as compact JSON:
+    {path: {operation: {count, errors, mean_us, p50_us, p99_us, max_us}}}.
+
+    The summary is taken when a read starts at offset 0 and the following long
+    read requests are served from it. Writing one byte disables (0), enables (1)
+    or resets (2) the metrics.
+    """
+
+    def __init__(self, bus, index, uuid, service, flags=("read", "write")):
+        Characteristic.__init__(self, bus, index, uuid, list(flags), service)
+
+    def summary(self):
+        return metrics.summary()
+
+    def read_value(self, options):
+        return json.dumps(self.summary(), separators=(",", ":"), sort_keys=True)
+
+    def WriteValue(self, value, options):
+        if len(value) != 1:
+            raise InvalidValueLengthException()
+        command = int(value[0])
+        if command == 0:
+            metrics.enable(False)
+        elif command == 1:
+            metrics.enable()
+        elif command == 2:
+            metrics.reset()
+        else:
+            raise InvalidArgsException("unknown command %d" % command)
+
+
+class ChannelStatsCharacteristic(DiagnosticsCharacteristic):
+    """
+    Notification counters of every characteristic of the application that
+    notified, as compact JSON: {characteristic path: {"signal": {sent,
+    sent_bytes}, "socket": {rate_cap, sent, sent_per_s, bytes_per_s, dropped,
+    queued}}}, "socket" while acquired, read like DiagnosticsCharacteristic.
+    """
+
+    def __init__(self, bus, index, uuid, service):
+        DiagnosticsCharacteristic.__init__(self, bus, index, uuid, service, ("read",))
+
+    def summary(self):
+        result = {}
+        application = self.get_application()
+        for obj in (application.objects.values() if application is not None else ()):
+            if isinstance(obj, Characteristic) and (obj.signal_sent or obj.socket_channel is not None):
+                result[obj.path] = obj.notify_counters()
+        return result
+
+    def WriteValue(self, value, options):
         raise NotSupportedException()
 
+
+class WriteStatsCharacteristic(DiagnosticsCharacteristic):
+    """
+    WriteReassembly.stats() of every characteristic and descriptor of the
+    application that was written to, as compact JSON {path: stats}, read like
+    DiagnosticsCharacteristic.
+    """
+
+    def __init__(self, bus, index, uuid, service):
+        DiagnosticsCharacteristic.__init__(self, bus, index, uuid, service, ("read",))
+
+    def summary(self):
+        result = {}
+        application = self.get_application()
+        for obj in (application.objects.values() if application is not None else ()):
+            if isinstance(obj, (Characteristic, Descriptor)) and obj.write_reassembly.device_writes:
+                result[obj.path] = obj.write_reassembly.stats()
+        return result
+
+    def WriteValue(self, value, options):
+        raise NotSupportedException()
+
+
+class DiagnosticsService(Service):
+    """Optional service exposing the metrics, notification channels and long writes of the GATT server"""
+
+    UUID = "5e2d0000-6c1a-4d7e-9c5b-7a3f1e8b2c40"
+    SUMMARY_UUID = "5e2d0001-6c1a-4d7e-9c5b-7a3f1e8b2c40"
+    CHANNELS_UUID = "5e2d0002-6c1a-4d7e-9c5b-7a3f1e8b2c40"
+    WRITES_UUID = "5e2d0004-6c1a-4d7e-9c5b-7a3f1e8b2c40"
+
+    def __init__(self, bus, index, path_base=None):
+        Service.__init__(self, bus, index, self.UUID, True, path_base)
+        self.add_characteristic(DiagnosticsCharacteristic(bus, 0, self.SUMMARY_UUID, self))
+        self.add_characteristic(ChannelStatsCharacteristic(bus, 1, self.CHANNELS_UUID, self))
+        self.add_characteristic(WriteStatsCharacteristic(bus, 2, self.WRITES_UUID, self))
+
+
+# advertising data bytes: a legacy advertising PDU carries 31, an extended
+# advertising set 251 (one HCI command, what bluetoothd supports)
+ADV_LEGACY_MAX_LENGTH = 31
+ADV_EXTENDED_MAX_LENGTH = 251
+# AD structure header: length and AD type
+AD_HEADER_LENGTH = 2
+BLUETOOTH_BASE_UUID = "-0000-1000-8000-00805f9b34fb"
+
+
+def uuid_length(uuid):
+    """Bytes of `uuid` in advertising data: 2 and 4 for SIG assigned ones, else 16"""
+    uuid = str(uuid).lower()
+    if len(uuid) in (4, 8):
+        return len(uuid) // 2
+    if uuid.endswith(BLUETOOTH_BASE_UUID):
+        return 2 if uuid.startswith("0000") else 4
+    return 16
+
+
 class Advertisement(dbus.service.Object):
+    """
+    org.bluez.LEAdvertisement1 interface implementation
+
+    data_length() is the size of the advertising data bluetoothd builds from the
+    properties, check_length() raises ValueError when it does not fit into a
+    legacy or, with a secondary channel set, an extended advertisement. After a
+    property changed, properties_changed() tells bluetoothd, which updates the
+    advertising data without the advertisement being registered again.
+    """
+
     PATH_BASE = "/org/bluez/example/advertisement"
 
     def __init__(self, bus, index, advertising_type):
@@ -250,6 +1291,8 @@ class Advertisement(dbus.service.Object):
         self.local_name = None
         self.include_tx_power = None
         self.data = None
+        # "1M", "2M" or "Coded": advertise with extended advertising PDUs
+        self.secondary_channel = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -274,8 +1317,60 @@ class Advertisement(dbus.service.Object):
 
         if self.data is not None:
             properties["Data"] = dbus.Dictionary(self.data, signature="yv")
+        if self.secondary_channel is not None:
+            properties["SecondaryChannel"] = dbus.String(self.secondary_channel)
         return {LE_ADVERTISEMENT_IFACE: properties}
 
+    def max_length(self):
+        return ADV_EXTENDED_MAX_LENGTH if self.secondary_channel is not None else ADV_LEGACY_MAX_LENGTH
+
+    def data_length(self):
+        """
+        Bytes of advertising data: the flags bluetoothd adds, then an AD structure
+        per UUID list, service data, manufacturer data, TX power and raw data
+        entry. The local name goes into the scan response.
+        """
+        length = AD_HEADER_LENGTH + 1
+        for uuids in (self.service_uuids, self.solicit_uuids):
+            sizes = {}
+            for uuid in uuids or ():
+                size = uuid_length(uuid)
+                sizes[size] = sizes.get(size, 0) + size
+            length += sum(AD_HEADER_LENGTH + total for total in sizes.values())
+        for uuid, data in (self.service_data or {}).items():
+            length += AD_HEADER_LENGTH + uuid_length(uuid) + len(data)
+        for data in (self.manufacturer_data or {}).values():
+            length += AD_HEADER_LENGTH + 2 + len(data)
+        if self.include_tx_power:
+            length += AD_HEADER_LENGTH + 1
+        for data in (self.data or {}).values():
+            length += AD_HEADER_LENGTH + len(data)
+        return length
+
+    def scan_response_length(self):
+        if not self.local_name:
+            return 0
+        return AD_HEADER_LENGTH + len(self.local_name.encode("utf-8"))
+
+    def check_length(self):
+        kind = "an extended" if self.secondary_channel is not None else "a legacy"
+        for what, length in (("advertising data", self.data_length()),
+                             ("scan response", self.scan_response_length())):
+            if length > self.max_length():
+                raise ValueError("%s: %d bytes of %s, at most %d fit into %s advertisement" % (
+                    self.path, length, what, self.max_length(), kind))
+        return self.data_length()
+
+    def properties_changed(self, *names):
+        properties = self.get_properties()[LE_ADVERTISEMENT_IFACE]
+        changed = dict((name, properties[name]) for name in names if name in properties)
+        invalidated = [name for name in names if name not in properties]
+        self.PropertiesChanged(LE_ADVERTISEMENT_IFACE, changed, invalidated)
+
+    @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
@@ -292,12 +1387,12 @@ class Advertisement(dbus.service.Object):
     def add_manufacturer_data(self, manuf_code, data):
         if not self.manufacturer_data:
             self.manufacturer_data = dbus.Dictionary({}, signature="qv")
-        self.manufacturer_data[manuf_code] = dbus.Array(data, signature="y")
+        self.manufacturer_data[manuf_code] = to_dbus_bytes(bytes(data))
 
     def add_service_data(self, uuid, data):
         if not self.service_data:
             self.service_data = dbus.Dictionary({}, signature="sv")
-        self.service_data[uuid] = dbus.Array(data, signature="y")
+        self.service_data[uuid] = to_dbus_bytes(bytes(data))
 
     def add_local_name(self, name):
         if not self.local_name:
@@ -307,14 +1402,13 @@ class Advertisement(dbus.service.Object):
     def add_data(self, ad_type, data):
         if not self.data:
             self.data = dbus.Dictionary({}, signature="yv")
-        self.data[ad_type] = dbus.Array(data, signature="y")
+        self.data[ad_type] = to_dbus_bytes(bytes(data))
 
     @dbus.service.method(DBUS_PROP_IFACE, in_signature="s", out_signature="a{sv}")
     def GetAll(self, interface):
-        logger.info("GetAll")
+        logger.info("%s: GetAll", self.path)
         if interface != LE_ADVERTISEMENT_IFACE:
             raise InvalidArgsException()
-        logger.info("returning props")
         return self.get_properties()[LE_ADVERTISEMENT_IFACE]
 
     @dbus.service.method(LE_ADVERTISEMENT_IFACE, in_signature="", out_signature="")
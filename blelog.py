@@ -0,0 +1,110 @@
+'''
+        Logging for the GATT server that does not block the GLib main loop
+
+        Library modules only create their loggers. The application calls
+        setup_logging() once: records are then put on a queue and written by a
+        background thread, and events logged on every D-Bus call are sampled
+        and rate limited.
+
+        listener = setup_logging(logging.INFO, limits={"%s: GetAll": (1.0, 5, 1)})
+'''
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from time import monotonic
+
+FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through one record in `sample` and at most `rate` records per second
+    (in bursts of up to `burst`) for each event. An event is a format string,
+    so log hot-path events with arguments rather than preformatted messages.
+    Warnings and errors always pass. The number of records dropped is appended
+    to the next record of the event that passes.
+
+    `limits` maps format strings to their own (rate, burst, sample), events not
+    listed get `default`; a default of None lets them through unlimited.
+    """
+
+    def __init__(self, limits=None, default=None):
+        logging.Filter.__init__(self)
+        self.limits = dict(limits or {})
+        self.default = default
+        # format string -> [tokens, last refill, seen, suppressed]
+        self.events = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        limit = self.limits.get(record.msg, self.default)
+        if limit is None:
+            return True
+        rate, burst, sample = limit
+        now = monotonic()
+        with self.lock:
+            state = self.events.get(record.msg)
+            if state is None:
+                state = self.events[record.msg] = [burst, now, 0, 0]
+            state[2] += 1
+            state[0] = min(burst, state[0] + (now - state[1]) * rate)
+            state[1] = now
+            if (state[2] - 1) % sample or state[0] < 1:
+                state[3] += 1
+                return False
+            state[0] -= 1
+            suppressed, state[3] = state[3], 0
+        if suppressed:
+            record.msg = "%s [%d similar suppressed]" % (record.msg, suppressed)
+        return True
+
+    def suppressed(self):
+        """Records dropped per event since the event last passed"""
+        with self.lock:
+            return dict((event, state[3]) for event, state in self.events.items())
+
+
+class QueueListener(logging.handlers.QueueListener):
+    """QueueListener that can be stopped more than once (by the app and at exit)"""
+
+    def stop(self):
+        if self._thread is not None:
+            logging.handlers.QueueListener.stop(self)
+
+
+# events logged by ble.py on every call, limited unless overridden
+HOT_PATH_LIMITS = {
+    "GetManagedObjects": (1.0, 5, 1),
+    "%s: GetAll": (1.0, 5, 1),
+    "%s: default %s called, returning error": (1.0, 5, 1),
+}
+
+
+def setup_logging(level=logging.INFO, handler=None, limits=None, default=None, logger=None):
+    """
+    Route the records of `logger` (the root logger by default) through a queue
+    to `handler` (a StreamHandler on stderr by default), written by a
+    QueueListener thread that is stopped at exit. Hot-path events are limited
+    by HOT_PATH_LIMITS updated with `limits`. Returns the started listener.
+    """
+    if handler is None:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(FORMAT))
+    records = queue.Queue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    event_limits = dict(HOT_PATH_LIMITS)
+    event_limits.update(limits or {})
+    queue_handler.addFilter(RateLimitFilter(event_limits, default))
+
+    logger = logging.getLogger(logger)
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+
+    listener = QueueListener(records, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,174 @@
+'''
+        Connectionless broadcast of the newest sensor samples in advertisements
+
+        A Broadcaster puts the newest samples of a FrameRing, as many as fit (see
+        wireformat.BroadcastEncoder), into the manufacturer or service data of a
+        non-connectable advertisement and refreshes them `rate` times a second,
+        so any number of passive scanners receive them without connecting.
+
+        A legacy advertisement fits one sample into manufacturer data, none into
+        service data under a 128 bit UUID; an extended one (`extended=True`)
+        about 20. The size is checked when the advertisement is built.
+
+        Refreshing either emits PropertiesChanged on the registered advertisement
+        ("signal", bluetoothd updates the advertising data in place), or
+        unregisters and registers it again ("reregister", for bluetoothd versions
+        that ignore the signal), one re-registration per adapter in flight.
+
+        broadcaster = Broadcaster(BroadcastAdvertisement(bus, 100, 0xFFFF), ring, encoder)
+        broadcaster.register([ad_manager])
+        broadcaster.start()
+'''
+import logging
+from functools import partial
+
+import dbus.exceptions
+
+from ble import Advertisement, NotifyTimer, to_dbus_bytes
+
+logger = logging.getLogger(__name__)
+
+REFRESH_MODES = ("signal", "reregister")
+
+
+class BroadcastAdvertisement(Advertisement):
+    """
+    Non-connectable advertisement carrying a payload as the manufacturer data
+    of company `key`, or with `service` as the service data of UUID `key`.
+    """
+
+    def __init__(self, bus, index, key, service=False, extended=False, local_name=None):
+        Advertisement.__init__(self, bus, index, "broadcast")
+        self.key = key
+        self.service = service
+        if extended:
+            self.secondary_channel = "1M"
+        if local_name is not None:
+            self.add_local_name(local_name)
+        if service:
+            self.add_service_data(key, b"")
+        else:
+            self.add_manufacturer_data(key, b"")
+
+    @property
+    def payload_property(self):
+        return "ServiceData" if self.service else "ManufacturerData"
+
+    def payload_size(self):
+        """Bytes left for the payload in the advertising data"""
+        payload = (self.service_data if self.service else self.manufacturer_data)[self.key]
+        return self.max_length() - self.data_length() + len(payload)
+
+    def set_payload(self, payload):
+        if self.service:
+            self.service_data[self.key] = to_dbus_bytes(payload)
+        else:
+            self.manufacturer_data[self.key] = to_dbus_bytes(payload)
+
+
+class Broadcaster(object):
+    """Refreshes `advertisement` with the newest samples of `ring` at `rate` Hz"""
+
+    def __init__(self, advertisement, ring, encoder, rate=10.0, refresh="signal"):
+        if refresh not in REFRESH_MODES:
+            raise ValueError("unknown refresh mode %r" % refresh)
+        self.advertisement = advertisement
+        self.ring = ring
+        self.encoder = encoder
+        self.refresh_mode = refresh
+        self.samples = encoder.samples_per_payload(advertisement.payload_size())
+        if self.samples < 1:
+            raise ValueError("%s: no sample fits into the %d bytes of advertising data left" % (
+                advertisement.path, advertisement.payload_size()))
+        advertisement.set_payload(encoder.encode(0, [0] * (self.samples * encoder.fields)))
+        advertisement.check_length()
+        self.timer = NotifyTimer(self.refresh, rate)
+        self.managers = []
+        self._pending = set()
+        self._last = None
+        self.updates = 0
+        self.unchanged = 0
+        self.reregistrations = 0
+
+    def register(self, ad_managers, error_handler=None):
+        """Register the advertisement with each LEAdvertisingManager1 interface"""
+        for manager in ad_managers:
+            self._register(manager, error_handler)
+
+    def _register(self, manager, error_handler=None):
+        self._pending.add(manager)
+        manager.RegisterAdvertisement(
+            self.advertisement.get_path(), {},
+            reply_handler=partial(self._registered, manager),
+            error_handler=partial(self._failed, manager, error_handler),
+        )
+
+    def _registered(self, manager):
+        self._pending.discard(manager)
+        if manager not in self.managers:
+            self.managers.append(manager)
+            logger.info("%s: broadcast registered, %d samples per advertisement",
+                        self.advertisement.path, self.samples)
+
+    def _failed(self, manager, error_handler, error):
+        self._pending.discard(manager)
+        if manager in self.managers:
+            self.managers.remove(manager)
+        logger.error("%s: failed to register broadcast: %s" % (self.advertisement.path, error))
+        if error_handler is not None:
+            error_handler(error)
+
+    def unregister(self):
+        self.stop()
+        for manager in self.managers:
+            try:
+                manager.UnregisterAdvertisement(self.advertisement.get_path())
+            except dbus.exceptions.DBusException as e:
+                logger.warning("%s: unregister failed: %s" % (self.advertisement.path, e))
+        self.managers = []
+
+    def start(self):
+        self.timer.start()
+
+    def stop(self):
+        self.timer.stop()
+
+    def set_rate(self, rate):
+        self.timer.set_rate(rate)
+
+    def refresh(self):
+        sequence, timestamps, frames = self.ring.window(self.samples)
+        last = sequence + len(timestamps)
+        if not timestamps or last == self._last:
+            self.unchanged += 1
+            return
+        self._last = last
+        self.advertisement.set_payload(self.encoder.encode(sequence, frames))
+        self.updates += 1
+        if self.refresh_mode == "signal":
+            if self.managers:
+                self.advertisement.properties_changed(self.advertisement.payload_property)
+            return
+        # bluetoothd reads the properties again when the advertisement registers
+        for manager in tuple(self.managers):
+            if manager in self._pending:
+                continue
+            self._pending.add(manager)
+            self.reregistrations += 1
+            manager.UnregisterAdvertisement(
+                self.advertisement.get_path(),
+                reply_handler=partial(self._register, manager),
+                error_handler=partial(self._failed, manager, None),
+            )
+
+    def stats(self):
+        stats = self.timer.stats()
+        stats.update({
+            "samples_per_advertisement": self.samples,
+            "advertising_data_length": self.advertisement.data_length(),
+            "max_length": self.advertisement.max_length(),
+            "updates": self.updates,
+            "unchanged": self.unchanged,
+            "reregistrations": self.reregistrations,
+        })
+        return stats
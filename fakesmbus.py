@@ -0,0 +1,220 @@
+'''
+        Fake smbus backend emulating MPU6050 registers and FIFO, for running and
+        benchmarking the sensor code without I2C hardware.
+
+        python3 fakesmbus.py
+'''
+import errno
+import math
+import struct
+import sys
+from time import monotonic, sleep
+
+# subset of the MPU6050 register map the emulation implements
+SMPLRT_DIV = 0x19
+CONFIG = 0x1A
+FIFO_EN = 0x23
+INT_STATUS = 0x3A
+ACCEL_XOUT_H = 0x3B
+USER_CTRL = 0x6A
+PWR_MGMT_1 = 0x6B
+FIFO_COUNTH = 0x72
+FIFO_COUNTL = 0x73
+FIFO_R_W = 0x74
+WHO_AM_I = 0x75
+
+FIFO_SIZE = 1024
+INT_FIFO_OFLOW = 0x10
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+
+SAMPLE_STRUCT = struct.Struct(">7h")
+WORD_STRUCT = struct.Struct(">h")
+
+# FIFO_EN bits in the order the sensor writes the corresponding words into the FIFO
+# (index into the acc_x, acc_y, acc_z, temp, gyro_x, gyro_y, gyro_z sample)
+FIFO_EN_WORDS = (
+    (0x08, (0, 1, 2)),  # ACCEL_FIFO_EN
+    (0x80, (3,)),  # TEMP_FIFO_EN
+    (0x40, (4,)),  # XG_FIFO_EN
+    (0x20, (5,)),  # YG_FIFO_EN
+    (0x10, (6,)),  # ZG_FIFO_EN
+)
+
+
+def synthetic_sample(n, rate):
+    """Device lying flat with a slow wobble: ~1g on z and small sinusoidal rotation"""
+    t = n / rate
+    wobble = math.sin(2 * math.pi * 0.5 * t)
+    return (
+        int(800 * wobble),
+        int(400 * math.cos(2 * math.pi * 0.5 * t)),
+        16384 - int(200 * wobble),
+        int((25.0 - 36.53) * 340),
+        int(1310 * math.cos(2 * math.pi * 0.5 * t)),
+        int(655 * wobble),
+        -20,
+    )
+
+
+class FakeMPU6050(object):
+    """
+    Register file of one MPU6050. Samples are produced lazily from `clock` at the
+    configured sample rate whenever the device is accessed.
+    """
+
+    def __init__(self, clock=monotonic, generator=synthetic_sample):
+        self.clock = clock
+        self.generator = generator
+        self.registers = bytearray(128)
+        self.registers[WHO_AM_I] = 0x68
+        self.registers[PWR_MGMT_1] = 0x40
+        self.fifo = bytearray()
+        self.produced = 0
+        self._restart_clock()
+
+    def sample_rate(self):
+        gyro_rate = 8000.0 if self.registers[CONFIG] & 0x07 in (0, 7) else 1000.0
+        return gyro_rate / (1 + self.registers[SMPLRT_DIV])
+
+    def _restart_clock(self):
+        self._epoch = self.clock()
+        self._epoch_sample = self.produced
+
+    def _advance(self):
+        rate = self.sample_rate()
+        due = int((self.clock() - self._epoch) * rate) + self._epoch_sample - self.produced
+        if due <= 0:
+            return
+        # a full FIFO only keeps the newest samples (at least one word each),
+        # don't generate the rest
+        keep = FIFO_SIZE // 2 + 1
+        if due > keep:
+            self.produced += due - keep
+            self.fifo.clear()
+            if self.registers[USER_CTRL] & USER_CTRL_FIFO_EN:
+                self.registers[INT_STATUS] |= INT_FIFO_OFLOW
+            due = keep
+        for _ in range(due):
+            self._push(self.generator(self.produced, rate))
+            self.produced += 1
+
+    def _push(self, sample):
+        registers = self.registers
+        SAMPLE_STRUCT.pack_into(registers, ACCEL_XOUT_H, *sample)
+        registers[INT_STATUS] |= 0x01
+        if not registers[USER_CTRL] & USER_CTRL_FIFO_EN:
+            return
+        enabled = registers[FIFO_EN]
+        fifo = self.fifo
+        for bit, words in FIFO_EN_WORDS:
+            if enabled & bit:
+                for i in words:
+                    fifo += WORD_STRUCT.pack(sample[i])
+        if len(fifo) > FIFO_SIZE:
+            # the oldest bytes are overwritten, the FIFO loses sample alignment
+            del fifo[:len(fifo) - FIFO_SIZE]
+            registers[INT_STATUS] |= INT_FIFO_OFLOW
+
+    def read(self, register, length=1):
+        self._advance()
+        if register == FIFO_R_W:
+            data = bytes(self.fifo[:length])
+            del self.fifo[:length]
+            return list(data) + [0] * (length - len(data))
+        result = []
+        for reg in range(register, register + length):
+            if reg == FIFO_COUNTH:
+                result.append(len(self.fifo) >> 8)
+            elif reg == FIFO_COUNTL:
+                result.append(len(self.fifo) & 0xFF)
+            else:
+                result.append(self.registers[reg & 0x7F])
+            if reg == INT_STATUS:
+                self.registers[INT_STATUS] = 0
+        return result
+
+    def write(self, register, value):
+        self._advance()
+        if register == USER_CTRL and value & USER_CTRL_FIFO_RESET:
+            self.fifo.clear()
+            value &= ~USER_CTRL_FIFO_RESET
+        self.registers[register] = value
+        if register in (SMPLRT_DIV, CONFIG):
+            self._restart_clock()
+
+
+class SMBus(object):
+    """
+    Drop-in replacement for smbus.SMBus backed by FakeMPU6050 devices.
+
+    With `transaction_time` each transaction sleeps that long, like the ioctl
+    of a real bus (a 14 byte block read takes about 0.4 ms at 400 kHz).
+    """
+
+    def __init__(self, bus=1, devices=None, clock=monotonic, transaction_time=0.0):
+        self.bus = bus
+        if devices is None:
+            devices = {0x68: FakeMPU6050(clock)}
+        self.devices = devices
+        self.transaction_time = transaction_time
+        self.transactions = 0
+
+    def _device(self, address):
+        self.transactions += 1
+        if self.transaction_time:
+            sleep(self.transaction_time)
+        try:
+            return self.devices[address]
+        except KeyError:
+            raise OSError(errno.EREMOTEIO, "Remote I/O error")
+
+    def read_byte_data(self, address, register):
+        return self._device(address).read(register)[0]
+
+    def write_byte_data(self, address, register, value):
+        self._device(address).write(register, value)
+
+    def read_i2c_block_data(self, address, register, length=32):
+        if length > 32:
+            raise OSError(errno.EINVAL, "Invalid argument")
+        return self._device(address).read(register, length)
+
+    def close(self):
+        pass
+
+
+def benchmark_fifo(duration=2.0, poll_interval=0.05):
+    """Drain the emulated FIFO like the application would and report throughput"""
+    import mpu6050
+
+    mpu6050.bus = SMBus(1)
+    mpu6050.MPU_Init()
+    mpu6050.FIFO_Init()
+    mpu6050.bus.transactions = 0
+    samples = batches = overflows = 0
+    busy = 0.0
+    start = monotonic()
+    while monotonic() - start < duration:
+        sleep(poll_interval)
+        t = monotonic()
+        batch = mpu6050.read_fifo_batch()
+        busy += monotonic() - t
+        samples += batch.count
+        batches += 1
+        overflows += batch.overflow
+    elapsed = monotonic() - start
+    return {
+        "samples_per_s": samples / elapsed,
+        "batches": batches,
+        "overflows": overflows,
+        "us_per_sample": busy / samples * 1e6 if samples else 0.0,
+        "transactions_per_sample": mpu6050.bus.transactions / samples if samples else 0.0,
+    }
+
+
+if __name__ == "__main__":
+    # let `import smbus` in mpu6050 resolve to this module
+    sys.modules.setdefault("smbus", sys.modules[__name__])
+    for key, value in sorted(benchmark_fifo().items()):
+        print(" %s: %s" % (key, value))
@@ -0,0 +1,343 @@
+'''
+        Signal processing and orientation fusion of sampler frames, on batches
+        with NumPy (optional: without it only the raw characteristics are served)
+
+        frames ─ scale ─ low-pass acc, high-pass gyro ─ gyro bias ─ fusion ─ output ring
+
+        Fusion is a complementary filter or Madgwick's IMU filter. There is no
+        magnetometer, so yaw is integrated gyro and drifts slowly. Results are
+        pushed as frames of seven int16 into a FrameRing:
+
+        qw, qx, qy, qz   orientation quaternion, Q14 (16384 is 1.0)
+        roll, pitch, yaw Euler angles (ZYX) in centidegrees
+'''
+import math
+import threading
+from time import monotonic
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from metrics import metrics
+from sampler import FRAME_FIELDS
+
+QUATERNION_ONE = 16384.0
+CENTIDEGREES = 18000.0 / math.pi
+
+# longest batch filtered with one matrix product, longer batches are split
+MAX_BATCH = 256
+
+
+def _require_numpy():
+    if np is None:
+        raise RuntimeError("the processing stage needs NumPy (pip install numpy)")
+
+
+class _Recursion(object):
+    """
+    y[n] = a * y[n-1] + u[n] for a batch at once: y = T u + a**(n+1) y[-1],
+    with T the lower triangular matrix of the powers of `a`. T[i, j] only
+    depends on i - j, so one MAX_BATCH matrix serves every length: a shorter
+    batch uses its top left corner, a longer one is split.
+    """
+
+    def __init__(self, a):
+        self.a = a
+        n = np.arange(MAX_BATCH)
+        exponents = n[:, None] - n[None, :]
+        self.matrix = np.where(exponents >= 0, a ** np.maximum(exponents, 0), 0.0)
+        self.decay = a ** (n + 1.0)
+
+    def __call__(self, u, state):
+        if len(u) > MAX_BATCH:
+            parts = []
+            for first in range(0, len(u), MAX_BATCH):
+                parts.append(self(u[first:first + MAX_BATCH], state))
+                state = parts[-1][-1]
+            return np.concatenate(parts)
+        count = len(u)
+        return self.matrix[:count, :count] @ u + self.decay[:count, None] * state
+
+
+class LowPass(object):
+    """First order low-pass filter of `cutoff` Hz on the columns of (n, axes) batches"""
+
+    def __init__(self, cutoff, rate):
+        self.cutoff = cutoff
+        a = math.exp(-2.0 * math.pi * cutoff / rate)
+        self.gain = 1.0 - a
+        self.recursion = _Recursion(a)
+        self.state = None
+
+    def __call__(self, x):
+        if self.state is None:
+            self.state = x[0].copy()
+        y = self.recursion(self.gain * x, self.state)
+        self.state = y[-1].copy()
+        return y
+
+
+class HighPass(LowPass):
+    """First order high-pass filter of `cutoff` Hz, the input minus its low-pass"""
+
+    def __call__(self, x):
+        return x - LowPass.__call__(self, x)
+
+
+class GyroBias(object):
+    """
+    Gyro offset, averaged over stationary samples: gyro within `threshold`
+    degree/s of the current bias and acceleration within `tolerance` g of 1 g.
+    The first `calibration` stationary samples are averaged, after that the
+    estimate follows with time constant `tau` seconds.
+    """
+
+    def __init__(self, threshold=3.0, tolerance=0.05, calibration=100, tau=10.0):
+        self.threshold = threshold
+        self.tolerance = tolerance
+        self.calibration = calibration
+        self.tau = tau
+        self.bias = np.zeros(3)
+        self.samples = 0
+
+    def __call__(self, acc, gyro, dt):
+        stationary = ((np.abs(np.linalg.norm(acc, axis=1) - 1.0) < self.tolerance)
+                      & (np.linalg.norm(gyro - self.bias, axis=1) < self.threshold))
+        count = int(stationary.sum())
+        if count:
+            mean = gyro[stationary].mean(axis=0)
+            if self.samples < self.calibration:
+                weight = count / float(self.samples + count)
+            else:
+                weight = 1.0 - math.exp(-dt[stationary].sum() / self.tau)
+            self.bias += weight * (mean - self.bias)
+            self.samples += count
+        return gyro - self.bias
+
+
+def euler_to_quaternion(roll, pitch, yaw):
+    """(n, 4) quaternions w, x, y, z of ZYX Euler angles in radians"""
+    cr, sr = np.cos(roll / 2), np.sin(roll / 2)
+    cp, sp = np.cos(pitch / 2), np.sin(pitch / 2)
+    cy, sy = np.cos(yaw / 2), np.sin(yaw / 2)
+    return np.stack((
+        cr * cp * cy + sr * sp * sy,
+        sr * cp * cy - cr * sp * sy,
+        cr * sp * cy + sr * cp * sy,
+        cr * cp * sy - sr * sp * cy,
+    ), axis=1)
+
+
+def quaternion_to_euler(q):
+    """roll, pitch, yaw in radians of (n, 4) quaternions w, x, y, z"""
+    w, x, y, z = q[:, 0], q[:, 1], q[:, 2], q[:, 3]
+    roll = np.arctan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+    pitch = np.arcsin(np.clip(2 * (w * y - z * x), -1.0, 1.0))
+    yaw = np.arctan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+    return roll, pitch, yaw
+
+
+class ComplementaryFilter(object):
+    """
+    angle = alpha * (angle + rate * dt) + (1 - alpha) * accelerometer angle,
+    for roll and pitch; yaw only integrates the gyro. Body rates are taken as
+    Euler angle rates, which holds for small roll and pitch.
+    """
+
+    def __init__(self, rate, alpha=0.98):
+        self.alpha = alpha
+        self.recursion = _Recursion(alpha)
+        self.angles = None
+
+    def __call__(self, acc, gyro, dt):
+        gyro = np.radians(gyro)
+        roll_acc = np.arctan2(acc[:, 1], acc[:, 2])
+        pitch_acc = np.arctan2(-acc[:, 0], np.hypot(acc[:, 1], acc[:, 2]))
+        if self.angles is None:
+            self.angles = np.array([roll_acc[0], pitch_acc[0], 0.0])
+        u = np.empty((len(acc), 2))
+        u[:, 0] = self.alpha * gyro[:, 0] * dt + (1.0 - self.alpha) * roll_acc
+        u[:, 1] = self.alpha * gyro[:, 1] * dt + (1.0 - self.alpha) * pitch_acc
+        roll_pitch = self.recursion(u, self.angles[:2])
+        yaw = self.angles[2] + np.cumsum(gyro[:, 2] * dt)
+        self.angles = np.array([roll_pitch[-1, 0], roll_pitch[-1, 1], yaw[-1]])
+        return euler_to_quaternion(roll_pitch[:, 0], roll_pitch[:, 1], yaw)
+
+
+class MadgwickFilter(object):
+    """
+    Madgwick's gradient descent IMU filter (accelerometer and gyro) with gain
+    `beta`. The update is sequential, so it runs per sample on Python floats,
+    which is faster than NumPy on vectors of four.
+    """
+
+    def __init__(self, rate, beta=0.1):
+        self.beta = beta
+        self.q = (1.0, 0.0, 0.0, 0.0)
+
+    def __call__(self, acc, gyro, dt):
+        beta = self.beta
+        q0, q1, q2, q3 = self.q
+        result = np.empty((len(acc), 4))
+        for n, ((ax, ay, az), (gx, gy, gz), h) in enumerate(zip(acc.tolist(), np.radians(gyro).tolist(),
+                                                              dt.tolist())):
+            qd0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+            qd1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+            qd2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+            qd3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+            norm = math.sqrt(ax * ax + ay * ay + az * az)
+            if norm:
+                ax, ay, az = ax / norm, ay / norm, az / norm
+                f0 = 2 * (q1 * q3 - q0 * q2) - ax
+                f1 = 2 * (q0 * q1 + q2 * q3) - ay
+                f2 = 2 * (0.5 - q1 * q1 - q2 * q2) - az
+                s0 = -2 * q2 * f0 + 2 * q1 * f1
+                s1 = 2 * q3 * f0 + 2 * q0 * f1 - 4 * q1 * f2
+                s2 = -2 * q0 * f0 + 2 * q3 * f1 - 4 * q2 * f2
+                s3 = 2 * q1 * f0 + 2 * q2 * f1
+                norm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+                if norm:
+                    qd0 -= beta * s0 / norm
+                    qd1 -= beta * s1 / norm
+                    qd2 -= beta * s2 / norm
+                    qd3 -= beta * s3 / norm
+            q0, q1, q2, q3 = q0 + qd0 * h, q1 + qd1 * h, q2 + qd2 * h, q3 + qd3 * h
+            norm = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+            q0, q1, q2, q3 = q0 / norm, q1 / norm, q2 / norm, q3 / norm
+            result[n] = q0, q1, q2, q3
+        self.q = (q0, q1, q2, q3)
+        return result
+
+
+FUSION_FILTERS = {
+    "complementary": ComplementaryFilter,
+    "madgwick": MadgwickFilter,
+}
+
+
+class Processor(object):
+    """
+    Filters and fuses batches of sampler frames into orientation frames.
+
+    `accel_lsb_per_g` and `gyro_lsb_per_dps` convert the raw values; the
+    accelerometer is low-passed at `accel_lowpass` Hz and the gyro high-passed
+    at `gyro_highpass` Hz (None for no filter). `gain` is the complementary
+    filter alpha or the Madgwick beta.
+    """
+
+    def __init__(self, rate, accel_lsb_per_g, gyro_lsb_per_dps, fusion="complementary",
+                 accel_lowpass=5.0, gyro_highpass=None, gain=None, bias=True):
+        _require_numpy()
+        if fusion not in FUSION_FILTERS:
+            raise ValueError("unknown fusion %r, expected one of %s" % (fusion, ", ".join(sorted(FUSION_FILTERS))))
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.accel_scale = 1.0 / accel_lsb_per_g
+        self.gyro_scale = 1.0 / gyro_lsb_per_dps
+        self.accel_filter = LowPass(accel_lowpass, rate) if accel_lowpass else None
+        self.gyro_filter = HighPass(gyro_highpass, rate) if gyro_highpass else None
+        self.bias = GyroBias() if bias else None
+        if gain is None:
+            self.fusion = FUSION_FILTERS[fusion](rate)
+        else:
+            self.fusion = FUSION_FILTERS[fusion](rate, gain)
+        self.last_timestamp = None
+
+    def process(self, timestamps, frames):
+        """
+        Orientation frames (an (n, 7) int16 array, see the module docstring)
+        of `timestamps` and the flat `frames` array from the sampler ring.
+        """
+        raw = np.frombuffer(frames, dtype=np.int16).reshape(-1, FRAME_FIELDS)
+        times = np.frombuffer(timestamps, dtype=np.float64)
+        output = np.empty((len(raw), FRAME_FIELDS), dtype=np.int16)
+        for first in range(0, len(raw), MAX_BATCH):
+            last = first + MAX_BATCH
+            output[first:last] = self._process(times[first:last], raw[first:last])
+        return output
+
+    def _process(self, times, raw):
+        acc = raw[:, 0:3] * self.accel_scale
+        gyro = raw[:, 4:7] * self.gyro_scale
+        # gaps (skipped reads, a late batch) are clamped so they do not jerk the angles
+        previous = times[0] - self.period if self.last_timestamp is None else self.last_timestamp
+        dt = np.clip(np.diff(times, prepend=previous), 0.0, 5 * self.period)
+        self.last_timestamp = times[-1]
+
+        if self.accel_filter is not None:
+            acc = self.accel_filter(acc)
+        if self.gyro_filter is not None:
+            gyro = self.gyro_filter(gyro)
+        if self.bias is not None:
+            gyro = self.bias(acc, gyro, dt)
+        q = self.fusion(acc, gyro, dt)
+
+        output = np.empty((len(q), FRAME_FIELDS))
+        output[:, 0:4] = q * QUATERNION_ONE
+        output[:, 4:7] = np.stack(quaternion_to_euler(q), axis=1) * CENTIDEGREES
+        return np.clip(np.rint(output), -32768, 32767)
+
+
+class ProcessingStage(threading.Thread):
+    """
+    Daemon thread running `processor` every `interval` seconds on the frames
+    the sampler pushed into `ring` since the previous batch, and pushing the
+    results into `output` (a FrameRing) with the timestamps of their frames.
+    The D-Bus handlers only read `output`, like the raw ring.
+    """
+
+    def __init__(self, processor, ring, output, interval=0.05):
+        threading.Thread.__init__(self, name="fusion", daemon=True)
+        self.processor = processor
+        self.ring = ring
+        self.output = output
+        self.interval = interval
+        self.batches = 0
+        self.frames = 0
+        self.skipped = 0
+        self.process_time_last = 0.0
+        self.process_time_max = 0.0
+        self._next = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.process_new()
+
+    def process_new(self):
+        """Process the frames written since the previous call, return how many"""
+        if self._next is None:
+            self._next = self.ring.written
+        sequence, timestamps, frames = self.ring.read_from(self._next)
+        self.skipped += sequence - self._next
+        count = len(timestamps)
+        self._next = sequence + count
+        if not count:
+            return 0
+        start = monotonic()
+        result = self.processor.process(timestamps, frames)
+        for timestamp, frame in zip(timestamps, result.tolist()):
+            self.output.push(frame, timestamp)
+        self.process_time_last = monotonic() - start
+        if self.process_time_last > self.process_time_max:
+            self.process_time_max = self.process_time_last
+        if metrics.enabled:
+            metrics.observe("fusion", self.name, self.process_time_last)
+        self.batches += 1
+        self.frames += count
+        return count
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "frames": self.frames,
+            "skipped": self.skipped,
+            "process_time_last": self.process_time_last,
+            "process_time_max": self.process_time_max,
+        }
@@ -0,0 +1,346 @@
+'''
+        Build a GATT Application from a declarative JSON (or TOML) schema
+
+        {
+          "services": [{
+            "uuid": "12634d89-d598-4874-8e86-7d042ee07ba7",
+            "characteristics": [{
+              "uuid": "4116f8d2-9f66-4f58-a53d-fc7440e7c14e",
+              "flags": ["read", "write", "notify"],
+              "encoding": "struct:<hI",
+              "value": [0, 0],
+              "write": "gattschema:store_value",
+              "notify": "mymodule:current_value",
+              "notify_rate": 10,
+              "descriptors": [{"uuid": "2901", "flags": ["read"], "value": "Counter"}]
+            }]
+          }]
+        }
+
+        `encoding` is "utf8" (default), "hex", "bytes" (list of ints) or
+        "struct:<format>". Handlers are "module:function" references:
+        read(obj, options) and notify(obj) return the value to encode,
+        write(obj, value, options) receives the decoded value.
+
+        python3 gattschema.py schema.json    validates a schema
+'''
+import importlib
+import json
+import sys
+from time import monotonic
+
+from ble import (
+    Application,
+    Characteristic,
+    Descriptor,
+    Service,
+    StructValue,
+    NotSupportedException,
+    to_dbus_bytes,
+)
+
+try:
+    import tomllib  # python 3.11+
+except ImportError:
+    tomllib = None
+
+CHARACTERISTIC_FLAGS = frozenset((
+    "broadcast", "read", "write-without-response", "write", "notify", "indicate",
+    "authenticated-signed-writes", "extended-properties", "reliable-write",
+    "writable-auxiliaries", "encrypt-read", "encrypt-write", "encrypt-notify",
+    "encrypt-indicate", "encrypt-authenticated-read", "encrypt-authenticated-write",
+    "encrypt-authenticated-notify", "encrypt-authenticated-indicate", "secure-read",
+    "secure-write", "secure-notify", "secure-indicate", "authorize",
+))
+DESCRIPTOR_FLAGS = frozenset((
+    "read", "write", "encrypt-read", "encrypt-write", "encrypt-authenticated-read",
+    "encrypt-authenticated-write", "secure-read", "secure-write", "authorize",
+))
+
+
+class SchemaError(ValueError):
+    pass
+
+
+class Utf8Codec(object):
+    def encode(self, value):
+        return to_dbus_bytes(value)
+
+    def decode(self, value):
+        return bytes(value).decode("utf8")
+
+
+class BytesCodec(object):
+    def encode(self, value):
+        return to_dbus_bytes(bytes(value))
+
+    def decode(self, value):
+        return bytes(value)
+
+
+class HexCodec(BytesCodec):
+    def encode(self, value):
+        if isinstance(value, str):
+            value = bytes.fromhex(value)
+        return to_dbus_bytes(bytes(value))
+
+
+class StructCodec(object):
+    def __init__(self, fmt):
+        self.value = StructValue(fmt)
+
+    def encode(self, value):
+        if isinstance(value, (tuple, list)):
+            return self.value.encode(*value)
+        return self.value.encode(value)
+
+    def decode(self, value):
+        values = self.value.decode(value)
+        return values[0] if len(values) == 1 else values
+
+
+def make_codec(encoding):
+    if encoding == "utf8":
+        return Utf8Codec()
+    if encoding == "bytes":
+        return BytesCodec()
+    if encoding == "hex":
+        return HexCodec()
+    if encoding.startswith("struct:"):
+        return StructCodec(encoding[len("struct:"):])
+    raise SchemaError("unknown encoding %r" % encoding)
+
+
+_handlers = {}
+
+
+def resolve_handler(reference):
+    """Import the callable named by a "module:function" reference, once"""
+    handler = _handlers.get(reference)
+    if handler is None:
+        module_name, _, name = reference.partition(":")
+        try:
+            handler = getattr(importlib.import_module(module_name), name)
+        except (ImportError, AttributeError) as e:
+            raise SchemaError("cannot resolve handler %r: %s" % (reference, e))
+        if not callable(handler):
+            raise SchemaError("handler %r is not callable" % reference)
+        _handlers[reference] = handler
+    return handler
+
+
+def store_value(obj, value, options):
+    """Write handler making the written value the new read value"""
+    obj.value = obj.codec.encode(value)
+
+
+def _check_uuid(uuid, where, errors):
+    if not isinstance(uuid, str):
+        errors.append("%s: uuid must be a string" % where)
+        return
+    digits = uuid.replace("-", "")
+    if len(digits) not in (4, 8, 32) or any(c not in "0123456789abcdefABCDEF" for c in digits):
+        errors.append("%s: invalid uuid %r" % (where, uuid))
+
+
+def _check_attribute(spec, where, known_flags, handlers, errors):
+    _check_uuid(spec.get("uuid"), where, errors)
+    flags = spec.get("flags")
+    if not isinstance(flags, list) or not flags:
+        errors.append("%s: flags must be a non-empty list" % where)
+        flags = []
+    for flag in flags:
+        if flag not in known_flags:
+            errors.append("%s: unknown flag %r" % (where, flag))
+
+    encoding = spec.get("encoding", "utf8")
+    try:
+        codec = make_codec(encoding)
+    except Exception as e:
+        errors.append("%s: %s" % (where, e))
+        codec = None
+    if codec is not None and "value" in spec:
+        try:
+            codec.encode(spec["value"])
+        except Exception as e:
+            errors.append("%s: value does not match encoding %r: %s" % (where, encoding, e))
+
+    for key in handlers:
+        if key in spec:
+            try:
+                resolve_handler(spec[key])
+            except SchemaError as e:
+                errors.append("%s: %s" % (where, e))
+
+    if "read" in flags and "value" not in spec and "read" not in spec:
+        errors.append("%s: readable but has neither value nor read handler" % where)
+    if "write" not in spec:
+        if "write" in flags or "write-without-response" in flags:
+            errors.append("%s: writable but has no write handler" % where)
+        elif spec.get("acquire_write"):
+            errors.append("%s: acquires writes but has no write handler" % where)
+    return flags
+
+
+def _entries(spec, key, where, errors):
+    """The list of dicts under `key`, reporting anything else"""
+    entries = spec.get(key, [])
+    if not isinstance(entries, list):
+        errors.append("%s: %s must be a list" % (where, key))
+        return []
+    prefix = "%s.%s" % (where, key) if where else key
+    result = []
+    for i, entry in enumerate(entries):
+        if isinstance(entry, dict):
+            result.append((i, entry))
+        else:
+            errors.append("%s[%d]: must be a table of attributes" % (prefix, i))
+    return result
+
+
+def validate_schema(schema):
+    """Check the whole schema once, raising SchemaError listing every problem"""
+    errors = []
+    services = schema.get("services") if isinstance(schema, dict) else None
+    if not isinstance(services, list):
+        raise SchemaError("schema must have a list of services")
+    for i, service in _entries(schema, "services", "", errors):
+        where = "services[%d]" % i
+        _check_uuid(service.get("uuid"), where, errors)
+        for j, chrc in _entries(service, "characteristics", where, errors):
+            chrc_where = "%s.characteristics[%d]" % (where, j)
+            flags = _check_attribute(chrc, chrc_where, CHARACTERISTIC_FLAGS,
+                                     ("read", "write", "notify"), errors)
+            if ("notify" in flags or "indicate" in flags) and "notify" not in chrc:
+                errors.append("%s: notifies but has no notify handler" % chrc_where)
+            rate = chrc.get("notify_rate", 1.0)
+            if not isinstance(rate, (int, float)) or rate <= 0:
+                errors.append("%s: notify_rate must be a positive number" % chrc_where)
+            for k, desc in _entries(chrc, "descriptors", chrc_where, errors):
+                _check_attribute(desc, "%s.descriptors[%d]" % (chrc_where, k), DESCRIPTOR_FLAGS,
+                                 ("read", "write"), errors)
+    if errors:
+        raise SchemaError("invalid GATT schema:\n  " + "\n  ".join(errors))
+
+
+class SchemaCharacteristic(Characteristic):
+    """Characteristic whose value and behavior come from a schema entry"""
+
+    def __init__(self, bus, index, service, spec):
+        Characteristic.__init__(self, bus, index, spec["uuid"], spec["flags"], service)
+        self.codec = make_codec(spec.get("encoding", "utf8"))
+        self.value = self.codec.encode(spec["value"]) if "value" in spec else None
+        self.read_handler = resolve_handler(spec["read"]) if "read" in spec else None
+        self.write_handler = resolve_handler(spec["write"]) if "write" in spec else None
+        self.notify_handler = resolve_handler(spec["notify"]) if "notify" in spec else None
+        self.notify_rate = spec.get("notify_rate", 1.0)
+        self.acquire_notify = spec.get("acquire_notify", False)
+        self.acquire_write = spec.get("acquire_write", False)
+
+    def read_value(self, options):
+        if self.read_handler is not None:
+            return self.codec.encode(self.read_handler(self, options))
+        if self.value is None:
+            raise NotSupportedException()
+        return self.value
+
+    def write_value(self, value, options):
+        if self.write_handler is None:
+            raise NotSupportedException()
+        self.write_handler(self, self.codec.decode(value), options)
+
+    def write_stream(self, data):
+        # each packet on the acquired write socket is one complete write
+        self.write_handler(self, self.codec.decode(bytes(data)), {})
+
+    def StartNotify(self):
+        if self.notify_handler is None:
+            raise NotSupportedException()
+        if not self.notifying:
+            self.start_notifying()
+
+    def StopNotify(self):
+        if self.notifying:
+            self.stop_notifying()
+
+    def notify_tick(self):
+        self.notify_value(self.codec.encode(self.notify_handler(self)))
+
+
+class SchemaDescriptor(Descriptor):
+    """Descriptor whose value and behavior come from a schema entry"""
+
+    def __init__(self, bus, index, characteristic, spec):
+        Descriptor.__init__(self, bus, index, spec["uuid"], spec["flags"], characteristic)
+        self.codec = make_codec(spec.get("encoding", "utf8"))
+        self.value = self.codec.encode(spec["value"]) if "value" in spec else None
+        self.read_handler = resolve_handler(spec["read"]) if "read" in spec else None
+        self.write_handler = resolve_handler(spec["write"]) if "write" in spec else None
+
+    def read_value(self, options):
+        if self.read_handler is not None:
+            return self.codec.encode(self.read_handler(self, options))
+        if self.value is None:
+            raise NotSupportedException()
+        return self.value
+
+    def write_value(self, value, options):
+        if self.write_handler is None:
+            raise NotSupportedException()
+        self.write_handler(self, self.codec.decode(value), options)
+
+
+def load_schema(path):
+    """Read a .json or .toml schema file"""
+    if path.endswith(".toml"):
+        if tomllib is None:
+            raise SchemaError("TOML schemas need python 3.11 (tomllib)")
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    with open(path) as f:
+        return json.load(f)
+
+
+def build_application(bus, schema, first_index=0):
+    """
+    Validate `schema` and build the Application tree it describes.
+
+    Every property dict and the managed object tree are computed here, so the
+    GetManagedObjects issued by RegisterApplication is served from the cache.
+    The time taken is stored in the application's `load_time` (seconds).
+    """
+    start = monotonic()
+    validate_schema(schema)
+    app = Application(bus)
+    for i, service_spec in enumerate(schema["services"]):
+        service = Service(bus, first_index + i, service_spec["uuid"], service_spec.get("primary", True))
+        for j, chrc_spec in enumerate(service_spec.get("characteristics", [])):
+            chrc = SchemaCharacteristic(bus, j, service, chrc_spec)
+            for k, desc_spec in enumerate(chrc_spec.get("descriptors", [])):
+                chrc.add_descriptor(SchemaDescriptor(bus, k, chrc, desc_spec))
+            service.add_characteristic(chrc)
+        app.add_service(service)
+    app.get_managed_objects()
+    app.load_time = monotonic() - start
+    return app
+
+
+def load_application(bus, path, first_index=0):
+    return build_application(bus, load_schema(path), first_index)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python3 gattschema.py schema.json")
+        sys.exit(2)
+    schema = load_schema(sys.argv[1])
+    try:
+        validate_schema(schema)
+    except SchemaError as e:
+        print(e)
+        sys.exit(1)
+    services = schema["services"]
+    chrcs = [c for s in services for c in s.get("characteristics", [])]
+    descs = [d for c in chrcs for d in c.get("descriptors", [])]
+    print("schema OK: %d services, %d characteristics, %d descriptors" % (
+        len(services), len(chrcs), len(descs)))
@@ -0,0 +1,188 @@
+'''
+        Fixed-memory history of motion frames with downsampled tiers, so a client
+        can fetch the last N seconds at a coarse resolution after a disconnect
+
+        raw     every frame, `raw_seconds` long (a FrameRing)
+        tiers   per bucket of `resolution` seconds: min, max and mean of the six
+                axes, `capacity` buckets each (1 s for an hour, 1 min for a day)
+'''
+import threading
+from array import array
+from collections import namedtuple
+
+from sampler import FRAME_FIELDS, FrameRing
+from wireformat import AXES
+
+AXIS_COUNT = len(AXES)
+
+# one downsampled interval; mins, maxs and means are tuples of the six axes
+Bucket = namedtuple("Bucket", "timestamp count mins maxs means")
+
+
+class Tier(object):
+    """Circular store of finished buckets of `resolution` seconds, plus the one being filled"""
+
+    def __init__(self, resolution, capacity):
+        self.resolution = resolution
+        self.capacity = capacity
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.counts = array("I", bytes(4 * capacity))
+        self.mins = array("h", bytes(2 * AXIS_COUNT * capacity))
+        self.maxs = array("h", bytes(2 * AXIS_COUNT * capacity))
+        self.means = array("h", bytes(2 * AXIS_COUNT * capacity))
+        self.written = 0
+        # bucket being filled
+        self._bucket = None
+        self._count = 0
+        self._min = [0] * AXIS_COUNT
+        self._max = [0] * AXIS_COUNT
+        self._sum = [0] * AXIS_COUNT
+
+    def add(self, timestamp, frame):
+        bucket = int(timestamp // self.resolution)
+        if bucket != self._bucket:
+            if self._count:
+                self._finish()
+            self._bucket = bucket
+            self._count = 0
+        mins, maxs, sums = self._min, self._max, self._sum
+        if not self._count:
+            for i, axis in enumerate(AXES):
+                mins[i] = maxs[i] = sums[i] = frame[axis]
+        else:
+            for i, axis in enumerate(AXES):
+                value = frame[axis]
+                if value < mins[i]:
+                    mins[i] = value
+                elif value > maxs[i]:
+                    maxs[i] = value
+                sums[i] += value
+        self._count += 1
+
+    def _finish(self):
+        index = self.written % self.capacity
+        count = self._count
+        self.timestamps[index] = self._bucket * self.resolution
+        self.counts[index] = count
+        base = index * AXIS_COUNT
+        for i in range(AXIS_COUNT):
+            self.mins[base + i] = self._min[i]
+            self.maxs[base + i] = self._max[i]
+            self.means[base + i] = int(round(self._sum[i] / count))
+        self.written += 1
+
+    def buckets(self, start):
+        """Finished buckets starting at or after `start`, oldest first"""
+        first = max(0, self.written - self.capacity)
+        result = []
+        for n in range(first, self.written):
+            index = n % self.capacity
+            if self.timestamps[index] < start:
+                continue
+            base = index * AXIS_COUNT
+            result.append(Bucket(
+                self.timestamps[index],
+                self.counts[index],
+                tuple(self.mins[base:base + AXIS_COUNT]),
+                tuple(self.maxs[base:base + AXIS_COUNT]),
+                tuple(self.means[base:base + AXIS_COUNT]),
+            ))
+        return result
+
+    def span(self):
+        return self.resolution * self.capacity
+
+
+class HistoryStore(object):
+    """
+    Frames pushed by the sampler thread (same interface as FrameRing.push) are
+    kept at full rate in a ring and folded into every tier as they arrive.
+    All memory is allocated up front.
+    """
+
+    def __init__(self, sample_rate, raw_seconds=60, tiers=((1.0, 3600), (60.0, 1440))):
+        self.sample_rate = sample_rate
+        self.raw = FrameRing(int(raw_seconds * sample_rate))
+        self.tiers = [Tier(resolution, capacity) for resolution, capacity in tiers]
+        self.lock = threading.Lock()
+        self.latest = 0.0
+
+    def push(self, frame, timestamp):
+        self.raw.push(frame, timestamp)
+        with self.lock:
+            for tier in self.tiers:
+                tier.add(timestamp, frame)
+            self.latest = timestamp
+
+    def _raw_buckets(self, start):
+        sequence, timestamps, frames = self.raw.window(self.raw.capacity)
+        result = []
+        for n, timestamp in enumerate(timestamps):
+            if timestamp < start:
+                continue
+            base = n * FRAME_FIELDS
+            values = tuple(frames[base + axis] for axis in AXES)
+            result.append(Bucket(timestamp, 1, values, values, values))
+        return result
+
+    def query(self, seconds, resolution=0.0):
+        """
+        Buckets covering the last `seconds` seconds, `resolution` seconds wide
+        (0 or less than a sample period for every frame), oldest first.
+
+        They are merged from the finest store whose span covers `seconds` (the
+        raw ring, then the tiers from fine to coarse, else the coarsest tier);
+        a store coarser than `resolution` is returned as is. Tier buckets still
+        being filled are not included.
+        """
+        start = self.latest - seconds
+        with self.lock:
+            source = None
+            if self.raw_span() < seconds:
+                source = self.tiers[-1] if self.tiers else None
+                for tier in reversed(self.tiers):
+                    if tier.span() >= seconds:
+                        source = tier
+            if source is None:
+                buckets = None
+                step = 1.0 / self.sample_rate
+            else:
+                buckets = source.buckets(start)
+                step = source.resolution
+        if buckets is None:
+            buckets = self._raw_buckets(start)
+        if resolution <= step:
+            return buckets
+        return merge(buckets, resolution)
+
+    def raw_span(self):
+        return self.raw.capacity / self.sample_rate
+
+
+def merge(buckets, resolution):
+    """Merge time ordered buckets into buckets of `resolution` seconds"""
+    result = []
+    current = None
+    for bucket in buckets:
+        key = int(bucket.timestamp // resolution)
+        if current is None or key != current[0]:
+            if current is not None:
+                result.append(_finish(current, resolution))
+            current = [key, 0, list(bucket.mins), list(bucket.maxs), [0] * AXIS_COUNT]
+        mins, maxs, sums = current[2], current[3], current[4]
+        for i in range(AXIS_COUNT):
+            if bucket.mins[i] < mins[i]:
+                mins[i] = bucket.mins[i]
+            if bucket.maxs[i] > maxs[i]:
+                maxs[i] = bucket.maxs[i]
+            sums[i] += bucket.means[i] * bucket.count
+        current[1] += bucket.count
+    if current is not None:
+        result.append(_finish(current, resolution))
+    return result
+
+
+def _finish(current, resolution):
+    key, count, mins, maxs, sums = current
+    return Bucket(key * resolution, count, tuple(mins), tuple(maxs),
+                  tuple(int(round(s / count)) for s in sums))
@@ -0,0 +1,232 @@
+'''
+        Call counts, error counts and latency histograms for the GATT hot paths,
+        exported in the Prometheus text format to a file or a UNIX socket.
+
+        Disabled by default; the instrumented methods then only check a flag.
+
+        metrics.enable()
+        MetricsExporter(textfile="/var/lib/node_exporter/ble.prom").start()
+        socat - UNIX-CONNECT:/run/ble-metrics.sock    with socket_path set
+'''
+import os
+import socket
+from bisect import bisect_left
+from functools import wraps
+from time import monotonic
+
+# histogram bucket upper bounds in seconds, the last bucket is +Inf
+BUCKETS = (25e-6, 50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3, 50e-3,
+           100e-3, 250e-3, 1.0)
+
+
+class Histogram(object):
+    __slots__ = ("counts", "count", "sum", "max", "errors")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.errors = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-quantile (max for the +Inf bucket)"""
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            total += count
+            if total >= rank and total:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "mean_us": self.sum / self.count * 1e6 if self.count else 0.0,
+            "p50_us": self.quantile(0.5) * 1e6,
+            "p99_us": self.quantile(0.99) * 1e6,
+            "max_us": self.max * 1e6,
+        }
+
+
+class Metrics(object):
+    """
+    Histograms keyed by (operation, object path). Operations are the names of
+    the instrumented methods: the D-Bus methods and "notify_value" (one
+    notification sent), plus "sensor_read" and "fusion" (one batch of the
+    processing stage).
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.started = monotonic()
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def reset(self):
+        self.histograms = {}
+        self.started = monotonic()
+
+    def histogram(self, name, path):
+        histogram = self.histograms.get((name, path))
+        if histogram is None:
+            histogram = self.histograms.setdefault((name, path), Histogram())
+        return histogram
+
+    def observe(self, name, path, seconds):
+        self.histogram(name, path).observe(seconds)
+
+    def error(self, name, path):
+        self.histogram(name, path).errors += 1
+
+    def summary(self):
+        """{path: {operation: summary dict}}"""
+        result = {}
+        for (name, path), histogram in sorted(self.histograms.items()):
+            result.setdefault(path, {})[name] = histogram.summary()
+        return result
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP ble_call_duration_seconds Time spent in GATT server operations.",
+            "# TYPE ble_call_duration_seconds histogram",
+        ]
+        errors = []
+        for (name, path), histogram in sorted(self.histograms.items()):
+            labels = 'operation="%s",path="%s"' % (name, path)
+            total = 0
+            for bound, count in zip(BUCKETS, histogram.counts):
+                total += count
+                lines.append('ble_call_duration_seconds_bucket{%s,le="%g"} %d' % (labels, bound, total))
+            lines.append('ble_call_duration_seconds_bucket{%s,le="+Inf"} %d' % (labels, histogram.count))
+            lines.append("ble_call_duration_seconds_sum{%s} %.9f" % (labels, histogram.sum))
+            lines.append("ble_call_duration_seconds_count{%s} %d" % (labels, histogram.count))
+            errors.append("ble_call_errors_total{%s} %d" % (labels, histogram.errors))
+        lines.append("# HELP ble_call_errors_total GATT server operations that raised.")
+        lines.append("# TYPE ble_call_errors_total counter")
+        lines.extend(errors)
+        lines.append("# HELP ble_metrics_uptime_seconds Time since the metrics were reset.")
+        lines.append("# TYPE ble_metrics_uptime_seconds gauge")
+        lines.append("ble_metrics_uptime_seconds %.3f" % (monotonic() - self.started))
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def instrument(function, name):
+    """Wrap a method of an object with a `path` to record its latency and errors"""
+    @wraps(function)
+    def wrapper(self, *args, **kwargs):
+        if not metrics.enabled:
+            return function(self, *args, **kwargs)
+        start = monotonic()
+        try:
+            result = function(self, *args, **kwargs)
+        except Exception:
+            histogram = metrics.histogram(name, self.path)
+            histogram.observe(monotonic() - start)
+            histogram.errors += 1
+            raise
+        metrics.observe(name, self.path, monotonic() - start)
+        return result
+
+    wrapper._instrumented = True
+    return wrapper
+
+
+def _import_glib():
+    # only the exporter needs the main loop; the sampler, fusion and multisensor
+    # modules import metrics without GLib installed
+    try:
+        from gi.repository import GLib  # python3
+    except ImportError:
+        import gobject as GLib  # python2
+    return GLib
+
+
+def instrument_class(cls, names):
+    """
+    Instrument the methods in `names` defined by `cls` itself. The D-Bus
+    decorator attributes are copied by wraps(), so dispatch and introspection
+    see the same method.
+    """
+    for name in names:
+        function = cls.__dict__.get(name)
+        if function is not None and not getattr(function, "_instrumented", False):
+            setattr(cls, name, instrument(function, name))
+
+
+class Instrumented(object):
+    """Mixin instrumenting the `instrumented_methods` of the class and of each subclass"""
+
+    instrumented_methods = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        instrument_class(cls, cls.instrumented_methods)
+
+
+class MetricsExporter(object):
+    """
+    Publishes metrics.prometheus_text() from the GLib main loop: rewritten to
+    `textfile` (atomically) every `interval` seconds, and/or served to every
+    client connecting to the UNIX socket `socket_path`.
+    """
+
+    def __init__(self, textfile=None, socket_path=None, interval=10.0):
+        self.textfile = textfile
+        self.socket_path = socket_path
+        self.interval = interval
+        self.server = None
+        self._sources = []
+        self.glib = _import_glib()
+
+    def start(self):
+        GLib = self.glib
+        if self.textfile:
+            self.write_textfile()
+            self._sources.append(GLib.timeout_add(int(self.interval * 1000), self.write_textfile))
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.socket_path)
+            self.server.listen(4)
+            self._sources.append(GLib.io_add_watch(self.server.fileno(), GLib.IO_IN, self._accept))
+
+    def stop(self):
+        for source in self._sources:
+            self.glib.source_remove(source)
+        self._sources = []
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+            os.unlink(self.socket_path)
+
+    def write_textfile(self):
+        temporary = self.textfile + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(metrics.prometheus_text())
+        os.rename(temporary, self.textfile)
+        return True
+
+    def _accept(self, fd, condition):
+        client, _ = self.server.accept()
+        try:
+            client.sendall(metrics.prometheus_text().encode("utf8"))
+        except OSError:
+            pass
+        finally:
+            client.close()
+        return True
@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
-import math
+import argparse
+import json
+import logging
 
 import dbus
 import dbus.exceptions
@@ -17,21 +19,47 @@ from ble import (
     Characteristic,
     Service,
     Application,
-    find_adapter,
-    GATT_CHRC_IFACE,
+    Descriptor,
+    to_dbus_bytes,
+    NotifyRateCharacteristic,
+    DiagnosticsService,
 )
 
-from mpu6050 import (
-    MPU_Init,
-    read_raw_data,
-    ACCEL_XOUT_H,
-    ACCEL_YOUT_H,
-    ACCEL_ZOUT_H,
-    GYRO_XOUT_H,
-    GYRO_YOUT_H,
-    GYRO_ZOUT_H,
+import fusion
+from adapters import AdapterSet, AdapterStatsCharacteristic, shard
+from blelog import setup_logging
+from broadcast import REFRESH_MODES, BroadcastAdvertisement, Broadcaster
+from history import HistoryStore
+from metrics import MetricsExporter, metrics
+from mpu6050 import ACCEL_FS_SEL, ACCEL_LSB_PER_G, GYRO_FS_SEL, GYRO_LSB_PER_DPS
+from multisensor import SensorManager, fake_bus, open_bus, parse_sensors
+from sampler import FrameRing, Sampler
+from sensors import open_backend
+from wireformat import (
+    ATT_DEFAULT_MTU,
+    ATT_NOTIFY_OVERHEAD,
+    BroadcastEncoder,
+    DEADBAND,
+    DELTA_REQUEST_KEYFRAME,
+    DELTA_SET_DEADBAND,
+    DeltaFrameEncoder,
+    HISTORY_BUCKETS,
+    HISTORY_REQUEST,
+    HISTORY_STATUS,
+    HistoryEncoder,
+    ORIENTATION_EULER,
+    ORIENTATION_QUATERNION,
+    OrientationEncoder,
+    PackedFrameEncoder,
+    describe,
+    describe_delta,
+    scale_code,
 )
 
+SAMPLE_RATE = 100.0  # Hz, rate of the background sampler thread
+
+logger = logging.getLogger(__name__)
+
 MainLoop = None
 try:
     from gi.repository import GLib
@@ -45,50 +73,14 @@ except ImportError:
 mainloop = None
 
 
-def readSensorData():
-    # Read Accelerometer raw value
-    acc_x = read_raw_data(ACCEL_XOUT_H)
-    acc_y = read_raw_data(ACCEL_YOUT_H)
-    acc_z = read_raw_data(ACCEL_ZOUT_H)
-
-    # Read Gyroscope raw value
-    gyro_x = read_raw_data(GYRO_XOUT_H)
-    gyro_y = read_raw_data(GYRO_YOUT_H)
-    gyro_z = read_raw_data(GYRO_ZOUT_H)
-
-    # Full scale range +/- 250 degree/C as per sensitivity scale factor
-    Ax = acc_x / 16384.0 * 9.8
-    Ay = acc_y / 16384.0 * 9.8
-    Az = acc_z / 16384.0 * 9.8
-
-    Gx = gyro_x / 131.0
-    Gy = gyro_y / 131.0
-    Gz = gyro_z / 131.0
-
-    return dbus.Array([dbus.Byte(b) for b in (
-            math.floor(Ax).to_bytes(4, 'little', signed=True) + math.floor((Ax % 1) * 1000000).to_bytes(4, 'little',
-                                                                                                        signed=True)
-            + math.floor(Ay).to_bytes(4, 'little', signed=True) + math.floor((Ay % 1) * 1000000).to_bytes(4,
-                                                                                                          'little',
-                                                                                                          signed=True)
-            + math.floor(Az).to_bytes(4, 'little', signed=True) + math.floor((Az % 1) * 1000000).to_bytes(4,
-                                                                                                          'little',
-                                                                                                          signed=True)
-            + math.floor(Gx).to_bytes(4, 'little', signed=True) + math.floor((Gx % 1) * 1000000).to_bytes(4,
-                                                                                                          'little',
-                                                                                                          signed=True)
-            + math.floor(Gy).to_bytes(4, 'little', signed=True) + math.floor((Gy % 1) * 1000000).to_bytes(4,
-                                                                                                          'little',
-                                                                                                          signed=True)
-            + math.floor(Gz).to_bytes(4, 'little', signed=True) + math.floor((Gz % 1) * 1000000).to_bytes(4,
-                                                                                                          'little',
-                                                                                                          signed=True))],
-                      'y')
-
-
-def str_to_dbusarray(word):
-    """Helper function to represent Python string as D-Dbus Byte array"""
-    return dbus.Array([dbus.Byte(ord(letter)) for letter in word], 'y')
+def readSensorData(ring, encoder, mtu):
+    # Latest raw Accelerometer and Gyroscope values from the sampler as one packed
+    # sample, the I2C bus is never touched on the main loop
+    latest = ring.latest()
+    if latest is None:
+        raise FailedException("no sensor sample yet")
+    sequence, timestamp, frame = latest
+    return encoder.encode(sequence, (timestamp,), frame, mtu)[0]
 
 
 BLUEZ_SERVICE_NAME = "org.bluez"
@@ -126,152 +118,566 @@ class BLEService(Service):
 
     service_UUID = "42673824-33e5-4aeb-ae5c-38dc66250000"
 
-    def __init__(self, bus, index):
-        Service.__init__(self, bus, index, self.service_UUID, True)
+    def __init__(self, bus, index, ring, history, orientation=None, orientation_mode=ORIENTATION_QUATERNION,
+                 delta=None, path_base=None, sensors=None, sensor_characteristics=True):
+        Service.__init__(self, bus, index, self.service_UUID, True, path_base)
         self.add_characteristic(NameCharacteristic(bus, 0, self))
-        self.add_characteristic(DemoCharacteristic(bus, 1, self))
+        demo = DemoCharacteristic(bus, 1, self, ring, delta=delta)
+        self.add_characteristic(demo)
+        self.add_characteristic(NotifyRateCharacteristic(
+            bus, 2, "42673824-33e5-4aeb-ae5c-38dc66250003", self, demo, max_rate=int(SAMPLE_RATE),
+        ))
+        result = HistoryResultCharacteristic(bus, 4, self, demo.encoder.epoch)
+        self.add_characteristic(HistoryControlCharacteristic(bus, 3, self, history, result))
+        self.add_characteristic(result)
+        if orientation is not None:
+            self.add_characteristic(OrientationCharacteristic(
+                bus, 5, self, orientation, orientation_mode, demo.encoder.epoch,
+            ))
+        if sensors is not None:
+            # the first sensor is the one of the characteristics above
+            self.add_characteristic(SensorStatsCharacteristic(bus, 6, self, sensors))
+            # else each other sensor has its own SensorService
+            if sensor_characteristics:
+                for channel in sensors.channels[1:]:
+                    self.add_characteristic(SensorCharacteristic(bus, 6 + channel.index, self, channel, delta))
+
+
+class SensorService(Service):
+    """
+    One more sensor of a SensorManager in its own service, so the sensors can
+    be spread over several adapters; the UUID ends in 02 and the sensor index.
+    """
+
+    def __init__(self, bus, index, channel, delta=None, path_base=None):
+        self.uuid = "42673824-33e5-4aeb-ae5c-38dc662502%02x" % channel.index
+        Service.__init__(self, bus, index, self.uuid, True, path_base)
+        self.add_characteristic(SensorCharacteristic(bus, 0, self, channel, delta))
 
 
 class NameCharacteristic(Characteristic):
     uuid = "42673824-33e5-4aeb-ae5c-38dc66250001"
     description = b"service name"
+    value = to_dbus_bytes('MPU6050')
 
     def __init__(self, bus, index, service):
         Characteristic.__init__(
             self, bus, index, self.uuid, ["read"], service,
         )
 
-    def ReadValue(self, options):
-        value = bytearray('MPU6050', encoding="utf8")
-        return value
+    def read_value(self, options):
+        return self.value
 
 
 class DemoCharacteristic(Characteristic):
+    """
+    Reads return the newest sample, notifications every sample since the last
+    tick. With `delta` (keyframe interval, deadband) notifications are delta
+    encoded, and the client writes DELTA_REQUEST_KEYFRAME after a lost packet
+    or DELTA_SET_DEADBAND with new deadbands (see wireformat.py).
+    """
+
     uuid = "42673824-33e5-4aeb-ae5c-38dc66250002"
     description = b"Motion sensor data"
+    acquire_notify = True
 
-    def __init__(self, bus, index, service):
+    def __init__(self, bus, index, service, ring, rate=1.0, delta=None):
+        flags = ["read", "notify", "write-without-response"] if delta else ["read", "notify"]
         Characteristic.__init__(
-            self, bus, index, self.uuid, ["read", 'notify'], service,
+            self, bus, index, self.uuid, flags, service,
         )
-        self.notifying = False
-
-        self.count = 0
+        self.ring = ring
+        # own position in the ring, the characteristics of every adapter read it
+        self.position = 0
+        self.encoder = PackedFrameEncoder(scale_code(ACCEL_FS_SEL, GYRO_FS_SEL), packet_type=dbus.ByteArray)
+        self.stream_encoder = self.encoder
+        if delta:
+            keyframe_interval, deadband = delta
+            self.stream_encoder = DeltaFrameEncoder(self.encoder.scale, keyframe_interval, deadband,
+                                                    epoch=self.encoder.epoch, packet_type=dbus.ByteArray)
+        self.notify_rate = rate
+
+        self.add_descriptor(PackedFormatDescriptor(bus, 0, self))
+
+    def read_value(self, options):
+        # the MTU of the reading device, notifications use notify_mtu
+        return readSensorData(self.ring, self.encoder, int(options.get("mtu", ATT_DEFAULT_MTU)))
+
+    def notify_tick(self):
+        # every sample since the last tick, as many per notification as the MTU allows
+        sequence, timestamps, frames = self.ring.read_from(self.position)
+        self.position = sequence + len(timestamps)
+        for packet in self.stream_encoder.encode(sequence, timestamps, frames, self.notify_mtu):
+            self.notify_value(packet)
+
+    def write_value(self, value, options):
+        if self.stream_encoder is self.encoder:
+            raise NotSupportedException()
+        value = bytes(value)
+        if value == bytes((DELTA_REQUEST_KEYFRAME,)):
+            self.stream_encoder.request_keyframe()
+        elif len(value) == 1 + DEADBAND.size and value[0] == DELTA_SET_DEADBAND:
+            self.stream_encoder.deadband = DEADBAND.unpack_from(value, 1)
+        else:
+            raise InvalidArgsException("unknown command")
 
-    def ReadValue(self, options):
-        return readSensorData()
+    def StartNotify(self):
+        if self.notifying:
+            logger.info("%s: already notifying, nothing to do", self.path)
+            return
 
-    def NotifyTimer_cb(self):
-        self.PropertiesChanged(GATT_CHRC_IFACE, {'Value': readSensorData()}, [])
-        return self.notifying
+        self.position = self.ring.written
+        if self.stream_encoder is not self.encoder:
+            self.stream_encoder.reset()
+        logger.info("%s: start notifying", self.path)
+        self.start_notifying()
 
-    def StartNotifyTimer(self):
+    def StopNotify(self):
         if not self.notifying:
+            logger.info("%s: not notifying, nothing to do", self.path)
             return
 
-        print('start notify timer')
-        GLib.timeout_add(1000, self.NotifyTimer_cb)
+        self.stop_notifying()
+
+
+class SensorCharacteristic(DemoCharacteristic):
+    """
+    Samples of one more sensor of a SensorManager (see multisensor.py), like
+    DemoCharacteristic; the UUID ends in 01 and the sensor index, the user
+    description is the bus and address of the sensor.
+    """
+
+    def __init__(self, bus, index, service, channel, delta=None):
+        self.uuid = "42673824-33e5-4aeb-ae5c-38dc662501%02x" % channel.index
+        self.description = ("MPU6050 %s" % channel.name).encode()
+        DemoCharacteristic.__init__(self, bus, index, service, channel.ring, delta=delta)
+        self.channel = channel
+        self.add_descriptor(SensorDescriptionDescriptor(bus, 1, self))
+
+
+class SensorDescriptionDescriptor(Descriptor):
+    """Characteristic user description, read-only"""
+
+    CUD_UUID = "2901"
+
+    def __init__(self, bus, index, characteristic):
+        self.value = to_dbus_bytes(characteristic.description)
+        Descriptor.__init__(self, bus, index, self.CUD_UUID, ["read"], characteristic)
+
+    def read_value(self, options):
+        return self.value
+
+
+class SensorStatsCharacteristic(Characteristic):
+    """SensorManager.stats() as compact JSON: samples per second of each sensor and in total"""
+
+    uuid = "42673824-33e5-4aeb-ae5c-38dc66250007"
+
+    def __init__(self, bus, index, service, sensors):
+        Characteristic.__init__(self, bus, index, self.uuid, ["read"], service)
+        self.sensors = sensors
+
+    def read_value(self, options):
+        return json.dumps(self.sensors.stats(), separators=(",", ":"), sort_keys=True)
+
+
+class PackedFormatDescriptor(Descriptor):
+    """
+    Read-only descriptor publishing the packed layout of the characteristic value.
+    """
+
+    FORMAT_UUID = "42673824-33e5-4aeb-ae5c-38dc66250f01"
+
+    def __init__(self, bus, index, characteristic):
+        encoder = characteristic.stream_encoder
+        if isinstance(encoder, DeltaFrameEncoder):
+            self.value = to_dbus_bytes(describe_delta(SAMPLE_RATE, encoder.scale, encoder.keyframe_interval))
+        else:
+            self.value = to_dbus_bytes(describe(SAMPLE_RATE, encoder.scale))
+        Descriptor.__init__(self, bus, index, self.FORMAT_UUID, ["read"], characteristic)
+
+    def read_value(self, options):
+        return self.value
+
+
+class OrientationCharacteristic(Characteristic):
+    """
+    Orientation from the fusion stage (see fusion.py), every sample while
+    notifying, as a quaternion or Euler angles (see wireformat.py).
+    """
+
+    uuid = "42673824-33e5-4aeb-ae5c-38dc66250006"
+    description = b"Orientation"
+    acquire_notify = True
+
+    def __init__(self, bus, index, service, ring, mode, epoch, rate=10.0):
+        Characteristic.__init__(self, bus, index, self.uuid, ["read", "notify"], service)
+        self.ring = ring
+        self.position = 0
+        self.encoder = OrientationEncoder(mode, epoch=epoch, packet_type=dbus.ByteArray)
+        self.notify_rate = rate
+
+    def read_value(self, options):
+        latest = self.ring.latest()
+        if latest is None:
+            raise FailedException("no orientation yet")
+        sequence, timestamp, frame = latest
+        mtu = int(options.get("mtu", ATT_DEFAULT_MTU))
+        return self.encoder.encode(sequence, (timestamp,), frame, mtu)[0]
+
+    def notify_tick(self):
+        sequence, timestamps, frames = self.ring.read_from(self.position)
+        self.position = sequence + len(timestamps)
+        for packet in self.encoder.encode(sequence, timestamps, frames, self.notify_mtu):
+            self.notify_value(packet)
 
     def StartNotify(self):
+        if not self.notifying:
+            self.position = self.ring.written
+            self.start_notifying()
+
+    def StopNotify(self):
         if self.notifying:
-            print('Already notifying, nothing to do')
-            return
+            self.stop_notifying()
 
-        self.notifying = True
-        self.StartNotifyTimer()
 
-    def StopNotify(self):
-        if not self.notifying:
-            print('Not notifying, nothing to do')
+class HistoryControlCharacteristic(Characteristic):
+    """
+    Write a history request (seconds, resolution in ms, mode; see wireformat.py)
+    to query the history store; the buckets are then served by the result
+    characteristic. Read returns the status of the last request.
+    """
+
+    uuid = "42673824-33e5-4aeb-ae5c-38dc66250004"
+    max_buckets = 4096
+
+    def __init__(self, bus, index, service, history, result):
+        Characteristic.__init__(self, bus, index, self.uuid, ["read", "write"], service)
+        self.history = history
+        self.result = result
+        self.request = (0, 0, 0)
+
+    def read_value(self, options):
+        return HISTORY_STATUS.pack(*(self.request + (len(self.result.buckets), self.result.state())))
+
+    def write_value(self, value, options):
+        if len(value) != HISTORY_REQUEST.size:
+            raise InvalidValueLengthException()
+        seconds, resolution_ms, mode = HISTORY_REQUEST.unpack(bytes(value))
+        if not seconds or mode not in HISTORY_BUCKETS:
+            raise InvalidArgsException("bad history request")
+        # keep the answer bounded, coarser if needed
+        resolution_ms = max(resolution_ms, -(-seconds * 1000 // self.max_buckets))
+        buckets = self.history.query(seconds, resolution_ms / 1000.0)
+        self.request = (seconds, resolution_ms, mode)
+        self.result.set_result(buckets, mode)
+
+
+class HistoryResultCharacteristic(Characteristic):
+    """
+    Buckets of the last history request in history packets. While subscribed
+    they are notified a few packets per tick, each read returns the next
+    packets up to 512 bytes; an empty value means the result is complete.
+    """
+
+    uuid = "42673824-33e5-4aeb-ae5c-38dc66250005"
+    packets_per_tick = 4
+    max_read_size = 512
+
+    def __init__(self, bus, index, service, epoch, rate=50.0):
+        Characteristic.__init__(self, bus, index, self.uuid, ["read", "notify"], service)
+        self.encoder = HistoryEncoder(epoch, packet_type=dbus.ByteArray)
+        self.notify_rate = rate
+        self.buckets = []
+        self.mode = 0
+        self.read_cursor = 0
+        self.notify_cursor = 0
+
+    def set_result(self, buckets, mode):
+        self.buckets = buckets
+        self.mode = mode
+        self.read_cursor = 0
+        self.notify_cursor = 0
+
+    def state(self):
+        """0: no result, 1: being sent, 2: sent"""
+        if not self.buckets:
+            return 0
+        cursor = self.notify_cursor if self.notifying else self.read_cursor
+        return 1 if cursor < len(self.buckets) else 2
+
+    def read_value(self, options):
+        if self.read_cursor >= len(self.buckets):
+            return b""
+        end = self.read_cursor + self.encoder.per_packet(self.mode, self.max_read_size)
+        packet = self.encoder.encode(self.buckets[self.read_cursor:end], self.mode, self.read_cursor,
+                                     self.max_read_size)[0]
+        self.read_cursor = min(end, len(self.buckets))
+        return packet
+
+    def notify_tick(self):
+        size = self.notify_mtu - ATT_NOTIFY_OVERHEAD
+        end = min(len(self.buckets),
+                  self.notify_cursor + self.encoder.per_packet(self.mode, size) * self.packets_per_tick)
+        if self.notify_cursor >= end:
             return
+        for packet in self.encoder.encode(self.buckets[self.notify_cursor:end], self.mode,
+                                          self.notify_cursor, size):
+            self.notify_value(packet)
+        self.notify_cursor = end
 
-        self.notifying = False
-        self.StartNotifyTimer()
+    def StartNotify(self):
+        if not self.notifying:
+            self.start_notifying()
+
+    def StopNotify(self):
+        if self.notifying:
+            self.stop_notifying()
 
 
 class BLEAdvertisement(Advertisement):
-    def __init__(self, bus, index):
+    def __init__(self, bus, index, service_uuids=(BLEService.service_UUID,)):
         Advertisement.__init__(self, bus, index, "peripheral")
         self.add_manufacturer_data(
             0xFFFF, [0x70, 0x74],
         )
-        self.add_service_uuid(BLEService.service_UUID)
+        for uuid in service_uuids:
+            self.add_service_uuid(uuid)
 
         self.add_local_name("MotionSensor")
         self.include_tx_power = True
 
 
-def register_ad_cb():
-    print("Advertisement registered")
-
-
-def register_ad_error_cb(error):
-    print("Failed to register advertisement: " + str(error))
-    mainloop.quit()
-
-
-def register_app_cb():
-    print("GATT application registered")
-
-
-def register_app_error_cb(error):
-    print("Failed to register application: " + str(error))
-    mainloop.quit()
+def register_adapter_error_cb(adapters):
+    def error_cb(adapter, error):
+        # the other adapters keep serving, give up when none can
+        if all(a.error is not None for a in adapters):
+            mainloop.quit()
+    return error_cb
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="MPU6050 BLE GATT server")
+    parser.add_argument("--backend", choices=("smbus", "synthetic"), default="smbus",
+                        help="sensor backend (default: smbus, the MPU6050 on I2C bus 1)")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="replay frames recorded with `sensors.py record` instead")
+    parser.add_argument("--replay-rate", type=float, metavar="HZ",
+                        help="replay pace, default: as fast as the sampler reads")
+    parser.add_argument("--verbose", action="store_true", help="log debug messages")
+    parser.add_argument("--diagnostics", action="store_true",
+                        help="record call latencies and add the diagnostics GATT service")
+    parser.add_argument("--metrics-textfile", metavar="FILE",
+                        help="write metrics in the Prometheus text format to FILE every 10 s")
+    parser.add_argument("--metrics-socket", metavar="PATH",
+                        help="serve metrics in the Prometheus text format on a UNIX socket")
+    parser.add_argument("--fusion", choices=("none",) + tuple(sorted(fusion.FUSION_FILTERS)),
+                        default="complementary",
+                        help="orientation fusion for the orientation characteristic (needs NumPy)")
+    parser.add_argument("--orientation", choices=("quaternion", "euler"), default="quaternion",
+                        help="values sent by the orientation characteristic")
+    parser.add_argument("--delta", action="store_true",
+                        help="delta encode motion notifications, with keyframes and a deadband")
+    parser.add_argument("--keyframe-interval", type=int, default=100, metavar="N",
+                        help="samples between keyframes of the delta encoding (default: 100)")
+    parser.add_argument("--deadband", type=int, default=0, metavar="LSB",
+                        help="changes of an axis up to LSB raw units are not sent (default: 0)")
+    parser.add_argument("--adapters", default=None, metavar="all|hci0,hci1",
+                        help="adapters to serve on, all of them or a comma separated list "
+                             "(default: the first adapter)")
+    parser.add_argument("--adapter-mode", choices=("replicate", "shard"), default="replicate",
+                        help="every adapter serves every service, or the services (the motion "
+                             "service and one per other --sensors sensor) are split between the "
+                             "adapters (default: replicate)")
+    parser.add_argument("--broadcast", action="store_true",
+                        help="also broadcast the newest samples in a non-connectable advertisement")
+    parser.add_argument("--broadcast-rate", type=float, default=10.0, metavar="HZ",
+                        help="advertising data refreshes per second (default: 10)")
+    parser.add_argument("--broadcast-data", choices=("manufacturer", "service"), default="manufacturer",
+                        help="carry the samples as manufacturer data or as service data "
+                             "(service data only fits an extended advertisement)")
+    parser.add_argument("--broadcast-extended", action="store_true",
+                        help="extended advertising, about 20 samples per advertisement instead of 1")
+    parser.add_argument("--broadcast-refresh", choices=REFRESH_MODES, default="signal",
+                        help="update the advertisement with PropertiesChanged or by registering "
+                             "it again (default: signal)")
+    parser.add_argument("--sensors", metavar="BUS:ADDR,...",
+                        help="several MPU6050s, e.g. 1:0x68,1:0x69,3:0x68, one sampling thread per "
+                             "I2C bus; emulated with --backend synthetic")
+    return parser.parse_args()
 
 
 def main():
-    MPU_Init()  # init MPU6050
     global mainloop
+    args = parse_args()
+    setup_logging(logging.DEBUG if args.verbose else logging.INFO)
+
+    # the MPU6050 is only opened and initialized by the sampler's first read,
+    # so the GATT application is registered without waiting on the I2C bus
+    if args.replay:
+        backend = open_backend("replay", args.replay, args.replay_rate)
+    else:
+        backend = open_backend(args.backend)
+
+    # sample the sensor on its own thread, D-Bus handlers only read the ring buffer
+    history = HistoryStore(SAMPLE_RATE)
+    sensors = None
+    if args.sensors:
+        if args.replay:
+            print("--sensors reads I2C buses, it does not replay recordings")
+            return
+        try:
+            sensors = SensorManager(parse_sensors(args.sensors), SAMPLE_RATE,
+                                    fake_bus if args.backend == "synthetic" else open_bus)
+        except ValueError as e:
+            print(e)
+            return
+        # one thread per bus samples every sensor, the first one feeds the
+        # characteristics, history and fusion of a single sensor
+        sampler = sensors
+        ring = sensors.channels[0].ring
+        sensors.channels[0].history = history
+    else:
+        ring = FrameRing()
+        sampler = Sampler(backend.read_frame, ring, SAMPLE_RATE, history)
+
+    # filter and fuse batches of frames on another thread into a ring of orientations
+    stage = None
+    if args.fusion != "none":
+        if fusion.np is None:
+            logger.warning("NumPy not found, the orientation characteristic is disabled")
+        else:
+            processor = fusion.Processor(SAMPLE_RATE, ACCEL_LSB_PER_G, GYRO_LSB_PER_DPS, args.fusion)
+            stage = fusion.ProcessingStage(processor, ring, FrameRing())
 
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     # get the system bus
     bus = dbus.SystemBus()
-    # get the ble controller
-    adapter = find_adapter(bus)
+    # get the ble controllers
+    names = args.adapters.split(",") if args.adapters not in (None, "all") else None
+    try:
+        adapters = AdapterSet(bus, names, 1 if args.adapters is None else None)
+    except ValueError as e:
+        print(e)
+        return
 
-    if not adapter:
+    if not len(adapters):
         print("GattManager1 interface not found")
         return
 
-    adapter_obj = bus.get_object(BLUEZ_SERVICE_NAME, adapter)
-
-    adapter_props = dbus.Interface(adapter_obj, "org.freedesktop.DBus.Properties")
-
-    # powered property on the controller to on
-    adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-
-    # Get manager objs
-    service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
-    ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
+    # powered property on the controllers to on
+    adapters.power_on()
+    if all(adapter.error is not None for adapter in adapters):
+        print("No adapter could be powered on")
+        return
 
-    advertisement = BLEAdvertisement(bus, 0)
-    obj = bus.get_object(BLUEZ_SERVICE_NAME, "/org/bluez")
+    broadcaster = None
+    if args.broadcast:
+        if args.broadcast_data == "service":
+            key = BLEService.service_UUID
+        else:
+            key = 0xFFFF
+        try:
+            broadcaster = Broadcaster(
+                BroadcastAdvertisement(bus, 100, key, args.broadcast_data == "service", args.broadcast_extended),
+                ring, BroadcastEncoder(scale_code(ACCEL_FS_SEL, GYRO_FS_SEL)),
+                args.broadcast_rate, args.broadcast_refresh,
+            )
+        except ValueError as e:
+            print(e)
+            return
 
-    app = Application(bus)
-    app.add_service(BLEService(bus, 2))
+    orientation = stage.output if stage is not None else None
+    orientation_mode = ORIENTATION_EULER if args.orientation == "euler" else ORIENTATION_QUATERNION
+    delta = (args.keyframe_interval, (args.deadband,) * 6) if args.delta else None
+
+    def sensor_service(index, path_base=None, sensor_characteristics=True):
+        return BLEService(bus, index, ring, history, orientation, orientation_mode, delta, path_base, sensors,
+                          sensor_characteristics)
+
+    def other_sensor_service(channel):
+        return lambda index, path_base=None: SensorService(bus, index, channel, delta, path_base)
+
+    # one application per adapter, with its own characteristics: a characteristic
+    # has one acquired notification socket and MTU, bluetoothd of each adapter
+    # needs its own. replicate puts every service on each adapter, shard gives
+    # each adapter a round-robin share of the motion service and one service
+    # per other sensor.
+    apps = [Application(bus, "/app%d" % i) for i in range(len(adapters))]
+    if args.adapter_mode == "shard":
+        factories = [lambda index, path_base=None: sensor_service(index, path_base, False)]
+        if sensors is not None:
+            factories.extend(other_sensor_service(channel) for channel in sensors.channels[1:])
+        if len(factories) < len(apps):
+            logger.warning("%d services to shard over %d adapters, %d adapters stay unused "
+                           "(one service per sensor, see --sensors)",
+                           len(factories), len(apps), len(apps) - len(factories))
+        shares = shard(factories, len(apps))
+    else:
+        shares = [[sensor_service]] * len(apps)
+    for app, share in zip(apps, shares):
+        for index, factory in enumerate(share):
+            app.add_service(factory(2 + index, app.path + "/service"))
+    exporter = None
+    if args.diagnostics or args.metrics_textfile or args.metrics_socket:
+        metrics.enable()
+        if args.diagnostics:
+            for app in apps:
+                if not app.services:
+                    continue
+                diagnostics = DiagnosticsService(bus, 2 + len(app.services), app.path + "/service")
+                diagnostics.add_characteristic(AdapterStatsCharacteristic(bus, 3, diagnostics, adapters))
+                app.add_service(diagnostics)
+        exporter = MetricsExporter(args.metrics_textfile, args.metrics_socket)
+        exporter.start()
+
+    def application_for(adapter):
+        app = apps[adapters.adapters.index(adapter)]
+        return app if app.services else None
+
+    def advertisement_for(adapter):
+        app = application_for(adapter)
+        if app is None:
+            return None
+        # one 128 bit UUID fits into a legacy advertisement next to the rest
+        uuids = [service.uuid for service in app.services if isinstance(service, (BLEService, SensorService))]
+        advertisement = BLEAdvertisement(bus, adapters.adapters.index(adapter), uuids[:1])
+        advertisement.check_length()
+        return advertisement
+
+    # a sensor that cannot be read at all stops startup before anything is registered
+    sampler.start()
+    failure = sampler.wait_started()
+    if failure is not None:
+        print("Sampling failed: %s" % failure)
+        backend.close()
+        if exporter is not None:
+            exporter.stop()
+        return
 
     mainloop = MainLoop()
 
-    ad_manager.RegisterAdvertisement(
-        advertisement.get_path(),
-        {},
-        reply_handler=register_ad_cb,
-        error_handler=register_ad_error_cb,
-    )
-
-    print("Registering GATT application...")
+    print("Registering GATT application on %s..." % ", ".join(adapter.name for adapter in adapters))
 
-    service_manager.RegisterApplication(
-        app.get_path(),
-        {},
-        reply_handler=register_app_cb,
-        error_handler=[register_app_error_cb],
-    )
+    adapters.register(application_for, advertisement_for, register_adapter_error_cb(adapters))
+    if broadcaster is not None:
+        broadcaster.register([adapter.ad_manager for adapter in adapters if adapter.ad_manager is not None])
 
+    if stage is not None:
+        stage.start()
+    if broadcaster is not None:
+        broadcaster.start()
     mainloop.run()
-    # ad_manager.UnregisterAdvertisement(advertisement)
-    # dbus.service.Object.remove_from_connection(advertisement)
+    if broadcaster is not None:
+        broadcaster.unregister()
+    if stage is not None:
+        stage.stop()
+    sampler.stop()
+    backend.close()
+    if exporter is not None:
+        exporter.stop()
+    adapters.unregister()
 
 
 if __name__ == "__main__":
@@ -2,39 +2,103 @@
         Read Gyro and Accelerometer by Interfacing Raspberry Pi with MPU6050 using Python
 	http://www.electronicwings.com
 '''
-from time import sleep  # import
-
-import smbus  # import SMBus module of I2C
+import struct
+import sys
+from array import array
+from collections import namedtuple
+from time import monotonic, sleep  # import
 
 # some MPU6050 Registers and their Address
 PWR_MGMT_1 = 0x6B
 SMPLRT_DIV = 0x19
 CONFIG = 0x1A
 GYRO_CONFIG = 0x1B
+ACCEL_CONFIG = 0x1C
+FIFO_EN = 0x23
 INT_ENABLE = 0x38
+INT_STATUS = 0x3A
 ACCEL_XOUT_H = 0x3B
 ACCEL_YOUT_H = 0x3D
 ACCEL_ZOUT_H = 0x3F
+TEMP_OUT_H = 0x41
 GYRO_XOUT_H = 0x43
 GYRO_YOUT_H = 0x45
 GYRO_ZOUT_H = 0x47
+USER_CTRL = 0x6A
+FIFO_COUNTH = 0x72
+FIFO_R_W = 0x74
+
+# register bits used for FIFO mode
+FIFO_EN_XG_YG_ZG_ACCEL = 0x78
+USER_CTRL_FIFO_EN = 0x40
+USER_CTRL_FIFO_RESET = 0x04
+INT_DATA_RDY = 0x01
+INT_FIFO_OFLOW = 0x10
+
+FIFO_SIZE = 1024
+# with FIFO_EN_XG_YG_ZG_ACCEL each FIFO sample is accel xyz followed by gyro xyz
+FIFO_SAMPLE_LENGTH = 12
+FIFO_SAMPLE_STRUCT = struct.Struct(">6h")
+# SMBus block reads are limited to 32 bytes, read whole samples per transaction
+FIFO_READ_CHUNK = (32 // FIFO_SAMPLE_LENGTH) * FIFO_SAMPLE_LENGTH
+
+# gyro output rate is 8kHz with the DLPF disabled (CONFIG = 0)
+GYRO_OUTPUT_RATE = 8000.0
+SAMPLE_RATE_DIVIDER = 7
+SAMPLE_RATE = GYRO_OUTPUT_RATE / (1 + SAMPLE_RATE_DIVIDER)
+
+# ACCEL_XOUT_H .. GYRO_ZOUT_L are contiguous: 3 accel, 1 temp and 3 gyro words
+FRAME_LENGTH = 14
+FRAME_STRUCT = struct.Struct(">7h")
+
+# sensitivity scale factors for the full scale ranges set in MPU_Init()
+# AFS_SEL 0 is +/- 2g, FS_SEL 0 is +/- 250 degree/s; each step doubles the range
+ACCEL_FS_SEL = 0
+GYRO_FS_SEL = 0
+# the selectors are bits 4:3 of ACCEL_CONFIG and GYRO_CONFIG
+FS_SEL_SHIFT = 3
+ACCEL_LSB_PER_G = 16384.0 / (1 << ACCEL_FS_SEL)
+GYRO_LSB_PER_DPS = 131.0 / (1 << GYRO_FS_SEL)
+
+
+class MotionFrame(namedtuple("MotionFrame", "acc_x acc_y acc_z temp gyro_x gyro_y gyro_z")):
+    """
+    One sample of raw signed 16-bit register values, all latched at the same instant
+    """
+    __slots__ = ()
+
+    def accel_g(self):
+        return (self.acc_x / ACCEL_LSB_PER_G, self.acc_y / ACCEL_LSB_PER_G, self.acc_z / ACCEL_LSB_PER_G)
+
+    def gyro_dps(self):
+        return (self.gyro_x / GYRO_LSB_PER_DPS, self.gyro_y / GYRO_LSB_PER_DPS, self.gyro_z / GYRO_LSB_PER_DPS)
+
+    def temperature_c(self):
+        # formula from the MPU6050 register map, section 4.18
+        return self.temp / 340.0 + 36.53
 
 
 def MPU_Init():
+    init_device(bus, Device_Address)
+
+
+def init_device(smbus, address):
     # write to sample rate register
-    bus.write_byte_data(Device_Address, SMPLRT_DIV, 7)
+    smbus.write_byte_data(address, SMPLRT_DIV, SAMPLE_RATE_DIVIDER)
 
     # Write to power management register
-    bus.write_byte_data(Device_Address, PWR_MGMT_1, 1)
+    smbus.write_byte_data(address, PWR_MGMT_1, 1)
 
     # Write to Configuration register
-    bus.write_byte_data(Device_Address, CONFIG, 0)
+    smbus.write_byte_data(address, CONFIG, 0)
 
-    # Write to Gyro configuration register
-    bus.write_byte_data(Device_Address, GYRO_CONFIG, 24)
+    # Write to Gyro and Accelerometer configuration registers, the full scale
+    # ranges the scale factors above and the packet scale codes assume
+    smbus.write_byte_data(address, GYRO_CONFIG, GYRO_FS_SEL << FS_SEL_SHIFT)
+    smbus.write_byte_data(address, ACCEL_CONFIG, ACCEL_FS_SEL << FS_SEL_SHIFT)
 
     # Write to interrupt enable register
-    bus.write_byte_data(Device_Address, INT_ENABLE, 1)
+    smbus.write_byte_data(address, INT_ENABLE, INT_DATA_RDY)
 
 
 def read_raw_data(addr):
@@ -51,35 +115,201 @@ def read_raw_data(addr):
     return value
 
 
-bus = smbus.SMBus(1)  # or bus = smbus.SMBus(0) for older version boards
+def decode_frame(data):
+    """Decode the 14 bytes starting at ACCEL_XOUT_H into a MotionFrame"""
+    return MotionFrame._make(FRAME_STRUCT.unpack(bytes(data)))
+
+
+def read_frame():
+    """
+    Read accelerometer, temperature and gyroscope in a single I2C block read.
+
+    The sensor updates the output registers atomically while a burst read is in
+    progress, so all axes come from the same sample.
+    """
+    return decode_frame(bus.read_i2c_block_data(Device_Address, ACCEL_XOUT_H, FRAME_LENGTH))
+
+
+class MPU6050(object):
+    """
+    One MPU6050 at `address` (0x68, or 0x69 with AD0 high) on `smbus`, a bus
+    number or an smbus.SMBus like object shared by the sensors of that bus.
+    The module functions drive the one at `Device_Address` on `bus`.
+    """
+
+    def __init__(self, smbus=1, address=0x68):
+        self.bus = LazySMBus(smbus) if isinstance(smbus, int) else smbus
+        self.address = address
+
+    def init(self):
+        """
+        Configure the sensor and read the full scale ranges back, so a sensor
+        left at another range is not sampled with the wrong scale factors.
+        """
+        init_device(self.bus, self.address)
+        for register, fs_sel in ((GYRO_CONFIG, GYRO_FS_SEL), (ACCEL_CONFIG, ACCEL_FS_SEL)):
+            value = self.bus.read_byte_data(self.address, register)
+            if (value >> FS_SEL_SHIFT) & 0x03 != fs_sel:
+                raise OSError("MPU6050 0x%02x: register 0x%02x reads 0x%02x, full scale selector %d expected"
+                              % (self.address, register, value, fs_sel))
+
+    def read_frame(self):
+        return decode_frame(self.bus.read_i2c_block_data(self.address, ACCEL_XOUT_H, FRAME_LENGTH))
+
+
+# AD0 low, AD0 high: at most two sensors per bus
+MPU6050_ADDRESSES = (0x68, 0x69)
+
+
+def measure_sample_rate(duration=1.0):
+    """Burst read frames for `duration` seconds and return the achieved samples per second"""
+    count = 0
+    start = monotonic()
+    deadline = start + duration
+    now = start
+    while now < deadline:
+        read_frame()
+        count += 1
+        now = monotonic()
+    return count / (now - start)
+
+
+class FifoBatch(namedtuple("FifoBatch", "timestamp period count data overflow")):
+    """
+    Samples drained from the FIFO in one call.
+
+    `data` is a flat array of `count` * 6 raw values (acc_x, acc_y, acc_z, gyro_x,
+    gyro_y, gyro_z per sample), `timestamp` is the monotonic time of the first
+    sample and `period` the time between samples. `overflow` is set when the FIFO
+    overflowed since the previous drain and had to be reset, i.e. samples were lost.
+    """
+    __slots__ = ()
+
+    def samples(self):
+        data = self.data
+        for i in range(0, self.count * 6, 6):
+            yield tuple(data[i:i + 6])
+
+    def timestamps(self):
+        for i in range(self.count):
+            yield self.timestamp + i * self.period
+
+
+_fifo_next_timestamp = None
+
+
+def FIFO_Init():
+    """Enable the FIFO for accelerometer and gyroscope samples at SAMPLE_RATE"""
+    bus.write_byte_data(Device_Address, FIFO_EN, FIFO_EN_XG_YG_ZG_ACCEL)
+    bus.write_byte_data(Device_Address, INT_ENABLE, INT_DATA_RDY | INT_FIFO_OFLOW)
+    reset_fifo()
+
+
+def reset_fifo():
+    """Discard the FIFO content and restart it aligned to a sample boundary"""
+    global _fifo_next_timestamp
+    bus.write_byte_data(Device_Address, USER_CTRL, USER_CTRL_FIFO_RESET)
+    bus.write_byte_data(Device_Address, USER_CTRL, USER_CTRL_FIFO_EN)
+    # reading INT_STATUS clears a stale overflow flag
+    bus.read_byte_data(Device_Address, INT_STATUS)
+    _fifo_next_timestamp = None
+
+
+def read_fifo_count():
+    high, low = bus.read_i2c_block_data(Device_Address, FIFO_COUNTH, 2)
+    return (high << 8) | low
+
+
+def read_fifo_batch(max_samples=None):
+    """
+    Drain all complete samples from the FIFO with block reads and return a FifoBatch.
+
+    Timestamps are derived from the sample clock: the first batch after a reset is
+    anchored to the time of the drain, following batches continue where the previous
+    one ended so they do not jitter with the wakeup time of the caller.
+    On overflow, or if the byte count is not a whole number of samples, the FIFO has
+    lost its alignment; it is reset and an empty batch with `overflow` set is returned.
+    """
+    global _fifo_next_timestamp
+    period = 1.0 / SAMPLE_RATE
+
+    status = bus.read_byte_data(Device_Address, INT_STATUS)
+    available = read_fifo_count()
+    if status & INT_FIFO_OFLOW or available >= FIFO_SIZE or available % FIFO_SAMPLE_LENGTH:
+        reset_fifo()
+        return FifoBatch(monotonic(), period, 0, array("h"), True)
+
+    count = available // FIFO_SAMPLE_LENGTH
+    if max_samples is not None:
+        count = min(count, max_samples)
+    now = monotonic()
+
+    raw = bytearray()
+    remaining = count * FIFO_SAMPLE_LENGTH
+    while remaining:
+        length = min(remaining, FIFO_READ_CHUNK)
+        raw += bytes(bus.read_i2c_block_data(Device_Address, FIFO_R_W, length))
+        remaining -= length
+
+    data = array("h", raw)
+    if sys.byteorder == "little":
+        data.byteswap()
+
+    timestamp = _fifo_next_timestamp
+    if timestamp is None or timestamp + (count - 1) * period > now:
+        # (re)anchor: the newest sample in the FIFO was taken just before the drain
+        timestamp = now - (count - 1) * period if count else now
+    if count:
+        _fifo_next_timestamp = timestamp + count * period
+    return FifoBatch(timestamp, period, count, data, False)
+
+
+class LazySMBus(object):
+    """
+    smbus.SMBus(number) opened on first use, so importing this module needs
+    neither the smbus package nor an I2C device
+    """
+
+    def __init__(self, number):
+        self.number = number
+        self.smbus = None
+
+    def __getattr__(self, name):
+        if self.smbus is None:
+            import smbus  # import SMBus module of I2C
+            self.smbus = smbus.SMBus(self.number)
+        attr = getattr(self.smbus, name)
+        # cache the bound method, later calls don't come through here
+        setattr(self, name, attr)
+        return attr
+
+
+bus = LazySMBus(1)  # or bus = LazySMBus(0) for older version boards
 Device_Address = 0x68  # MPU6050 device address
 
 if __name__ == "__main__":
     MPU_Init()
 
+    if "--fifo" in sys.argv:
+        FIFO_Init()
+        while True:
+            sleep(0.5)
+            batch = read_fifo_batch()
+            print(" %d samples, overflow: %s" % (batch.count, batch.overflow))
+
+    if "--bench" in sys.argv:
+        print(" I2C burst read rate: %.1f samples/s" % measure_sample_rate(5.0))
+        sys.exit(0)
+
     print(" Reading Data of Gyroscope and Accelerometer")
 
     while True:
-        # Read Accelerometer raw value
-        acc_x = read_raw_data(ACCEL_XOUT_H)
-        acc_y = read_raw_data(ACCEL_YOUT_H)
-        acc_z = read_raw_data(ACCEL_ZOUT_H)
-
-        # Read Gyroscope raw value
-        gyro_x = read_raw_data(GYRO_XOUT_H)
-        gyro_y = read_raw_data(GYRO_YOUT_H)
-        gyro_z = read_raw_data(GYRO_ZOUT_H)
+        frame = read_frame()
 
         # Full scale range +/- 250 degree/C as per sensitivity scale factor
-        Ax = acc_x / 16384.0
-        Ay = acc_y / 16384.0
-        Az = acc_z / 16384.0
-
-        Gx = gyro_x / 131.0
-        Gy = gyro_y / 131.0
-        Gz = gyro_z / 131.0
+        Ax, Ay, Az = frame.accel_g()
+        Gx, Gy, Gz = frame.gyro_dps()
 
         print("Gx=%.2f" % Gx, u'\u00b0' + "/s", "\tGy=%.2f" % Gy, u'\u00b0' + "/s", "\tGz=%.2f" % Gz, u'\u00b0' + "/s",
-              "\tAx=%.2f g" % Ax, "\tAy=%.2f g" % Ay, "\tAz=%.2f g" % Az)
+              "\tAx=%.2f g" % Ax, "\tAy=%.2f g" % Ay, "\tAz=%.2f g" % Az, "\tT=%.1f" % frame.temperature_c(), u'\u00b0' + "C")
         sleep(1)
-
@@ -0,0 +1,223 @@
+'''
+        Several MPU6050s on several I2C buses, sampled concurrently
+
+        A SensorManager gives each sensor (bus number, address) its own FrameRing
+        and reads the sensors of a bus from one BusWorker thread, in turn every
+        period: a bus carries one transaction at a time anyway, while the
+        workers of different buses overlap (the smbus ioctl releases the GIL).
+        fake_bus() emulates a bus with an MPU6050 at each address (fakesmbus.py).
+
+        python3 multisensor.py 1:0x68,1:0x69,3:0x68 [fake] [seconds]
+
+        prints the samples per second of each sensor and in total
+'''
+import json
+import logging
+import sys
+import threading
+from functools import partial
+from time import monotonic, sleep
+
+import fakesmbus
+from metrics import metrics
+from mpu6050 import MPU6050, MPU6050_ADDRESSES, LazySMBus
+from sampler import FrameRing
+
+logger = logging.getLogger(__name__)
+
+
+def parse_sensors(spec):
+    """"1:0x68,1:0x69,3" -> [(1, 0x68), (1, 0x69), (3, 0x68)], the address defaults to 0x68"""
+    sensors = []
+    for item in spec.split(","):
+        number, _, address = item.strip().partition(":")
+        address = int(address, 0) if address else MPU6050_ADDRESSES[0]
+        if address not in MPU6050_ADDRESSES:
+            raise ValueError("%s: an MPU6050 answers at 0x68 or 0x69" % item)
+        sensor = (int(number), address)
+        if sensor in sensors:
+            raise ValueError("%s: given twice" % item)
+        sensors.append(sensor)
+    return sensors
+
+
+def open_bus(number, addresses):
+    return LazySMBus(number)
+
+
+def _shifted_sample(offset, n, rate):
+    return fakesmbus.synthetic_sample(n + offset, rate)
+
+
+def fake_bus(number, addresses, transaction_time=0.0004):
+    """fakesmbus.SMBus with an emulated MPU6050 at each address, each one out of phase"""
+    devices = {}
+    for address in addresses:
+        generator = partial(_shifted_sample, number * 1000 + (address - MPU6050_ADDRESSES[0]) * 250)
+        devices[address] = fakesmbus.FakeMPU6050(generator=generator)
+    return fakesmbus.SMBus(number, devices, transaction_time=transaction_time)
+
+
+class SensorChannel(object):
+    """One sensor: its device, its ring of frames, an optional history and counters"""
+
+    def __init__(self, index, number, address, device, ring=None, history=None):
+        self.index = index
+        self.bus = number
+        self.address = address
+        self.name = "%d:0x%02x" % (number, address)
+        self.device = device
+        self.ring = FrameRing() if ring is None else ring
+        self.history = history
+        # initialized on the first read, again after a failed one
+        self.initialized = False
+        self.errors = 0
+        self.read_time_max = 0.0
+
+    def read(self):
+        if not self.initialized:
+            self.device.init()
+            self.initialized = True
+        return self.device.read_frame()
+
+
+class BusWorker(threading.Thread):
+    """
+    Daemon thread reading each sensor of one bus in turn at `rate` Hz, with
+    absolute deadlines like sampler.Sampler; missed periods are counted in `late`.
+    An exception other than OSError is logged, kept in `failure` and stops it.
+    """
+
+    def __init__(self, number, channels, rate=100.0):
+        threading.Thread.__init__(self, name="i2c-%d" % number, daemon=True)
+        self.bus = number
+        self.channels = channels
+        self.period = 1.0 / rate
+        self.late = 0
+        self.failure = None
+        self._stop_event = threading.Event()
+        self._first_read = threading.Event()
+
+    def run(self):
+        deadline = monotonic()
+        while not self._stop_event.is_set():
+            for channel in self.channels:
+                start = monotonic()
+                try:
+                    frame = channel.read()
+                except OSError:
+                    # a NACK or a missing sensor loses one sample of that sensor
+                    channel.errors += 1
+                    channel.initialized = False
+                    if metrics.enabled:
+                        metrics.error("sensor_read", channel.name)
+                    continue
+                except Exception as e:
+                    logger.exception("%s: sampling stopped at sensor %s" % (self.name, channel.name))
+                    self.failure = e
+                    if metrics.enabled:
+                        metrics.error("sensor_read", channel.name)
+                    self._first_read.set()
+                    return
+                now = monotonic()
+                channel.ring.push(frame, now)
+                if channel.history is not None:
+                    channel.history.push(frame, now)
+                if now - start > channel.read_time_max:
+                    channel.read_time_max = now - start
+                if metrics.enabled:
+                    metrics.observe("sensor_read", channel.name, now - start)
+            self._first_read.set()
+
+            deadline += self.period
+            now = monotonic()
+            if now - deadline > self.period:
+                missed = int((now - deadline) / self.period)
+                self.late += missed
+                deadline += missed * self.period
+            self._stop_event.wait(max(0.0, deadline - now))
+
+    def wait_started(self, timeout=1.0):
+        self._first_read.wait(timeout)
+        return self.failure
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class SensorManager(object):
+    """
+    Samples `sensors` [(bus number, address)] at `rate` Hz each, one BusWorker
+    per bus. `bus_opener(number, addresses)` returns the smbus.SMBus like object
+    of a bus, the real one by default; fake_bus emulates it. Start and stop it
+    like a Sampler.
+    """
+
+    def __init__(self, sensors, rate=100.0, bus_opener=open_bus):
+        addresses = {}
+        for number, address in sensors:
+            addresses.setdefault(number, []).append(address)
+        self.buses = dict((number, bus_opener(number, addresses[number])) for number in addresses)
+        self.channels = [SensorChannel(index, number, address, MPU6050(self.buses[number], address))
+                         for index, (number, address) in enumerate(sensors)]
+        self.workers = [BusWorker(number, [channel for channel in self.channels if channel.bus == number], rate)
+                        for number in sorted(addresses)]
+        self.started = None
+
+    def start(self):
+        self.started = monotonic()
+        for worker in self.workers:
+            worker.start()
+
+    def wait_started(self, timeout=1.0):
+        """Like Sampler.wait_started: the first exception that stopped a worker, or None"""
+        for worker in self.workers:
+            failure = worker.wait_started(timeout)
+            if failure is not None:
+                return failure
+        return None
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for bus in self.buses.values():
+            # a LazySMBus never opened has nothing to close
+            if getattr(bus, "smbus", bus) is not None:
+                bus.close()
+
+    def stats(self):
+        """Samples per second since start() of each sensor and of all of them"""
+        elapsed = monotonic() - self.started if self.started is not None else 0.0
+        sensors = {}
+        total = 0
+        for channel in self.channels:
+            written = channel.ring.written
+            total += written
+            sensors[channel.name] = {
+                "samples": written,
+                "samples_per_s": written / elapsed if elapsed > 0 else 0.0,
+                "errors": channel.errors,
+                "read_time_max": channel.read_time_max,
+            }
+        return {
+            "samples": total,
+            "samples_per_s": total / elapsed if elapsed > 0 else 0.0,
+            "late": dict(("i2c-%d" % worker.bus, worker.late) for worker in self.workers),
+            "failures": dict(("i2c-%d" % worker.bus, str(worker.failure)) for worker in self.workers
+                             if worker.failure is not None),
+            "sensors": sensors,
+        }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python3 multisensor.py 1:0x68,1:0x69,3:0x68 [fake] [seconds]")
+        sys.exit(2)
+    manager = SensorManager(parse_sensors(sys.argv[1]),
+                            bus_opener=fake_bus if "fake" in sys.argv[2:] else open_bus)
+    seconds = float(sys.argv[-1]) if len(sys.argv) > 2 and sys.argv[-1] != "fake" else 5.0
+    manager.start()
+    sleep(seconds)
+    manager.stop()
+    print(json.dumps(manager.stats(), indent=2, sort_keys=True))
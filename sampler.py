@@ -0,0 +1,233 @@
+'''
+        Background sensor sampling into a preallocated ring buffer, so the GLib
+        main loop never waits on the I2C bus
+'''
+import logging
+import struct
+import threading
+from array import array
+from time import monotonic
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+FRAME_FIELDS = 7  # acc_x, acc_y, acc_z, temp, gyro_x, gyro_y, gyro_z
+FRAME_STRUCT = struct.Struct("=%dh" % FRAME_FIELDS)
+
+
+class FrameRing(object):
+    """
+    Fixed-size ring of int16 frames and their timestamps.
+
+    Storage is allocated once; pushing a frame packs it in place and reading
+    returns the raw values, so no Python object is kept per sample. One writer
+    (the sampler thread) and any number of readers are synchronized by a lock
+    that is only held for the copy.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.frames = array("h", bytes(FRAME_STRUCT.size * capacity))
+        self.timestamps = array("d", bytes(8 * capacity))
+        self.written = 0
+        self.lock = threading.Lock()
+        # frames overwritten before read_new() consumed them
+        self.overruns = 0
+        self._cursor = 0
+        # age of the newest frame when it was served to a reader
+        self.latency_last = 0.0
+        self.latency_max = 0.0
+        self._latency_total = 0.0
+        self._latency_count = 0
+
+    def push(self, frame, timestamp):
+        with self.lock:
+            index = self.written % self.capacity
+            FRAME_STRUCT.pack_into(self.frames, index * FRAME_STRUCT.size, *frame)
+            self.timestamps[index] = timestamp
+            self.written += 1
+
+    def _record_latency(self, timestamp):
+        latency = monotonic() - timestamp
+        self.latency_last = latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+        self._latency_total += latency
+        self._latency_count += 1
+
+    def latest(self):
+        """
+        Return (sequence, timestamp, frame values) of the newest frame, or None if empty.
+        The sequence number of a frame is its absolute index since the ring was created.
+        """
+        with self.lock:
+            if not self.written:
+                return None
+            sequence = self.written - 1
+            index = sequence % self.capacity
+            timestamp = self.timestamps[index]
+            frame = FRAME_STRUCT.unpack_from(self.frames, index * FRAME_STRUCT.size)
+        self._record_latency(timestamp)
+        return sequence, timestamp, frame
+
+    def _copy(self, start, count):
+        # caller holds the lock; copies `count` frames starting at absolute index `start`
+        frames = array("h")
+        timestamps = array("d")
+        index = start % self.capacity
+        while count:
+            n = min(count, self.capacity - index)
+            frames += self.frames[index * FRAME_FIELDS:(index + n) * FRAME_FIELDS]
+            timestamps += self.timestamps[index:index + n]
+            count -= n
+            index = 0
+        return timestamps, frames
+
+    def window(self, count):
+        """
+        Return (sequence, timestamps, frames) of the newest `count` frames, oldest first.
+        `sequence` is the sequence number of the first frame and `frames` a flat array
+        with FRAME_FIELDS values per frame.
+        """
+        with self.lock:
+            count = min(count, self.written, self.capacity)
+            sequence = self.written - count
+            timestamps, frames = self._copy(sequence, count)
+        if count:
+            self._record_latency(timestamps[-1])
+        return sequence, timestamps, frames
+
+    def read_new(self, max_count=None):
+        """
+        Return (sequence, timestamps, frames) written since the previous read_new() call.
+        Frames that were overwritten in the meantime are counted in `overruns`.
+        """
+        with self.lock:
+            start = self._cursor
+            if self.written - start > self.capacity:
+                self.overruns += self.written - start - self.capacity
+                start = self.written - self.capacity
+            count = self.written - start
+            if max_count is not None:
+                count = min(count, max_count)
+            timestamps, frames = self._copy(start, count)
+            self._cursor = start + count
+        if count:
+            self._record_latency(timestamps[-1])
+        return start, timestamps, frames
+
+    def read_from(self, start, max_count=None):
+        """
+        Return (sequence, timestamps, frames) from sequence number `start` on, for
+        readers keeping their own position. Frames already overwritten are left
+        out, the returned sequence is then past `start`.
+        """
+        with self.lock:
+            start = max(start, self.written - self.capacity)
+            count = self.written - start
+            if max_count is not None:
+                count = min(count, max_count)
+            timestamps, frames = self._copy(start, count)
+        return start, timestamps, frames
+
+    def skip(self):
+        """Make the next read_new() start at the next frame written"""
+        with self.lock:
+            self._cursor = self.written
+
+    def stats(self):
+        return {
+            "written": self.written,
+            "capacity": self.capacity,
+            "overruns": self.overruns,
+            "latency_last": self.latency_last,
+            "latency_max": self.latency_max,
+            "latency_mean": self._latency_total / self._latency_count if self._latency_count else 0.0,
+        }
+
+
+class Sampler(threading.Thread):
+    """
+    Daemon thread calling `read()` at `rate` Hz and pushing the result into `ring`.
+
+    Deadlines are absolute so the rate does not drift with read time; when reads
+    fall more than a period behind the missed slots are skipped and counted in `late`.
+    Frames are also pushed to `history` (e.g. a history.HistoryStore) if given.
+
+    An OSError loses one sample; any other exception (a missing smbus module, a
+    bad replay file) is logged, kept in `failure` and stops the thread, so
+    wait_started() reports it instead of the ring silently staying empty.
+    """
+
+    def __init__(self, read, ring, rate=100.0, history=None):
+        threading.Thread.__init__(self, name="sampler", daemon=True)
+        self.read = read
+        self.ring = ring
+        self.history = history
+        self.period = 1.0 / rate
+        self.errors = 0
+        self.late = 0
+        self.read_time_last = 0.0
+        self.read_time_max = 0.0
+        self.failure = None
+        self._stop_event = threading.Event()
+        self._first_read = threading.Event()
+
+    def run(self):
+        deadline = monotonic()
+        while not self._stop_event.is_set():
+            start = monotonic()
+            try:
+                frame = self.read()
+            except OSError:
+                # a NACK or bus glitch loses one sample, keep sampling
+                self.errors += 1
+                if metrics.enabled:
+                    metrics.error("sensor_read", self.name)
+            except Exception as e:
+                logger.exception("%s: sampling stopped" % self.name)
+                self.failure = e
+                if metrics.enabled:
+                    metrics.error("sensor_read", self.name)
+                self._first_read.set()
+                return
+            else:
+                now = monotonic()
+                self.ring.push(frame, now)
+                if self.history is not None:
+                    self.history.push(frame, now)
+                self.read_time_last = now - start
+                if self.read_time_last > self.read_time_max:
+                    self.read_time_max = self.read_time_last
+                if metrics.enabled:
+                    metrics.observe("sensor_read", self.name, self.read_time_last)
+            self._first_read.set()
+
+            deadline += self.period
+            now = monotonic()
+            if now - deadline > self.period:
+                missed = int((now - deadline) / self.period)
+                self.late += missed
+                deadline += missed * self.period
+            self._stop_event.wait(max(0.0, deadline - now))
+
+    def wait_started(self, timeout=1.0):
+        """Wait for the first read after start(); the exception that stopped the thread, or None"""
+        self._first_read.wait(timeout)
+        return self.failure
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def stats(self):
+        stats = self.ring.stats()
+        stats.update({
+            "failure": None if self.failure is None else str(self.failure),
+            "errors": self.errors,
+            "late": self.late,
+            "read_time_last": self.read_time_last,
+            "read_time_max": self.read_time_max,
+        })
+        return stats
@@ -0,0 +1,159 @@
+'''
+        Sensor backends producing MotionFrame samples for the sampler
+
+        smbus       MPU6050 on I2C bus 1, opened and initialized on the first read
+        synthetic   generated motion, no hardware needed
+        replay      frames recorded to a file, paced at a given rate or unbounded
+
+        python3 sensors.py record out.rec [count] [backend]    record frames
+'''
+import struct
+import sys
+from array import array
+from time import monotonic, sleep
+
+import mpu6050
+from fakesmbus import synthetic_sample
+from mpu6050 import MotionFrame, SAMPLE_RATE
+
+# recording file: magic, then one record per frame
+RECORDING_MAGIC = b"MPUREC1\n"
+RECORD_STRUCT = struct.Struct("<d7h")  # timestamp, acc xyz, temp, gyro xyz
+
+
+class SensorBackend(object):
+    """Source of motion frames; read_frame() is called from the sampler thread"""
+
+    name = None
+
+    def read_frame(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class SMBusBackend(SensorBackend):
+    """
+    MPU6050 through mpu6050.py. Nothing touches the bus until the first read,
+    which opens it and runs MPU_Init(), so startup does not wait on hardware.
+    """
+
+    name = "smbus"
+
+    def __init__(self):
+        self.initialized = False
+
+    def read_frame(self):
+        if not self.initialized:
+            mpu6050.MPU_Init()
+            self.initialized = True
+        return mpu6050.read_frame()
+
+
+class SyntheticBackend(SensorBackend):
+    """Generated frames following the clock, as if sampled at `rate` Hz"""
+
+    name = "synthetic"
+
+    def __init__(self, rate=SAMPLE_RATE):
+        self.rate = rate
+        self.start = None
+
+    def read_frame(self):
+        now = monotonic()
+        if self.start is None:
+            self.start = now
+        return MotionFrame._make(synthetic_sample(int((now - self.start) * self.rate), self.rate))
+
+
+class ReplayBackend(SensorBackend):
+    """
+    Frames from a recording made with record().
+
+    With `rate` None frames are returned back to back, one per read, as fast as
+    the caller asks (for throughput benchmarks). With a rate in Hz the frame
+    returned is the one due at the current time, like the output registers of
+    a sensor sampling at that rate. The recording restarts when `loop` is set,
+    otherwise EOFError is raised at its end. The file is read on the first read.
+    """
+
+    name = "replay"
+
+    def __init__(self, path, rate=None, loop=True):
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+        self.frames = None
+        self.count = 0
+        self.position = 0
+        self.start = None
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            data = f.read()
+        if not data.startswith(RECORDING_MAGIC):
+            raise ValueError("%s is not a frame recording" % self.path)
+        data = memoryview(data)[len(RECORDING_MAGIC):]
+        self.count = len(data) // RECORD_STRUCT.size
+        if not self.count:
+            raise ValueError("%s contains no frames" % self.path)
+        # keep only the int16 values, 7 per frame, in one flat array
+        self.frames = array("h")
+        for offset in range(0, self.count * RECORD_STRUCT.size, RECORD_STRUCT.size):
+            self.frames.extend(RECORD_STRUCT.unpack_from(data, offset)[1:])
+
+    def read_frame(self):
+        if self.frames is None:
+            self.load()
+        if self.rate is None:
+            index = self.position
+            self.position += 1
+        else:
+            now = monotonic()
+            if self.start is None:
+                self.start = now
+            index = int((now - self.start) * self.rate)
+        if index >= self.count:
+            if not self.loop:
+                raise EOFError("end of recording %s" % self.path)
+            index %= self.count
+        return MotionFrame._make(self.frames[index * 7:index * 7 + 7])
+
+
+def open_backend(name, path=None, rate=None):
+    """Backend by name: "smbus", "synthetic" or "replay" (which needs `path`)"""
+    if name == "smbus":
+        return SMBusBackend()
+    if name == "synthetic":
+        return SyntheticBackend(rate or SAMPLE_RATE)
+    if name == "replay":
+        if path is None:
+            raise ValueError("the replay backend needs a recording file")
+        return ReplayBackend(path, rate)
+    raise ValueError("unknown sensor backend %r" % name)
+
+
+def record(backend, path, count, rate=SAMPLE_RATE):
+    """Write `count` frames read from `backend` at `rate` Hz to a recording file"""
+    period = 1.0 / rate
+    with open(path, "wb") as f:
+        f.write(RECORDING_MAGIC)
+        deadline = monotonic()
+        for _ in range(count):
+            frame = backend.read_frame()
+            f.write(RECORD_STRUCT.pack(monotonic(), *frame))
+            deadline += period
+            delay = deadline - monotonic()
+            if delay > 0:
+                sleep(delay)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] != "record":
+        print("usage: python3 sensors.py record out.rec [count] [smbus|synthetic]")
+        sys.exit(2)
+    count = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    backend = open_backend(sys.argv[4] if len(sys.argv) > 4 else "smbus")
+    record(backend, sys.argv[2], count)
+    print(" recorded %d frames to %s" % (count, sys.argv[2]))
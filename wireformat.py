@@ -0,0 +1,442 @@
+'''
+        Compact binary encoding of motion frames for GATT notifications
+
+        Each packet is a header followed by `count` samples of raw int16 axes:
+
+        header  <BBHI   count, scale, sequence number of the first sample,
+                        timestamp of the first sample in ms
+        sample  <6h     acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z
+
+        `scale` holds the accelerometer full scale selector (AFS_SEL) in the low
+        nibble and the gyroscope one (FS_SEL) in the high nibble, so a sample
+        converts with acc / (16384 >> AFS_SEL) g and gyro / (131 / 2**FS_SEL) degree/s.
+
+        History query results use the same header, with the mode instead of the
+        scale and the index of the first bucket of the result as sequence number:
+
+        history request  <IIB     seconds, resolution in ms (0 for every sample), mode
+        history status   <IIBHB   the request as served, bucket count, state
+        bucket           <6h      mode 0: mean of each axis
+                         <18h     mode 1: min, max and mean of each axis
+
+        Orientation packets (see fusion.py) use the header too, with the mode
+        instead of the scale:
+
+        sample  <4h     mode 0: quaternion w, x, y, z in Q14 (16384 is 1.0)
+                <3h     mode 1: roll, pitch, yaw in centidegrees
+
+        Delta encoded notifications (DeltaFrameEncoder) carry samples as changes
+        to the previous sample sent:
+
+        header    <BBHI   packet number, flags, sequence number of the first
+                          sample, timestamp of the first sample in ms
+        keyframe  <6h     first sample of a packet flagged DELTA_KEYFRAME: absolute axes
+        delta     6 zigzag varints of the change of each axis; the first sample of
+                  a packet has the header sequence number, the following ones are
+                  each preceded by a varint of the sequence number difference
+
+        Samples are left out while no axis moved more than its deadband since the
+        last sample sent. The packet number counts packets, a client that sees a gap
+        has lost deltas and writes DELTA_REQUEST_KEYFRAME to get a keyframe.
+
+        Broadcast payloads (advertising data, see broadcast.py) carry the newest
+        samples that fit, with a shorter header:
+
+        header  <BBH    count, scale, sequence number of the first sample
+        sample  <6h     as above
+'''
+import struct
+from time import monotonic
+
+HEADER = struct.Struct("<BBHI")
+SAMPLE = struct.Struct("<6h")
+
+ATT_DEFAULT_MTU = 23
+# a notification carries MTU - 3 bytes (opcode and attribute handle)
+ATT_NOTIFY_OVERHEAD = 3
+
+# offsets of the six axes in a sampler frame (acc xyz, temp, gyro xyz)
+AXES = (0, 1, 2, 4, 5, 6)
+
+
+def scale_code(accel_fs_sel, gyro_fs_sel):
+    return (accel_fs_sel & 0x0F) | ((gyro_fs_sel & 0x0F) << 4)
+
+
+def describe(sample_rate, scale):
+    """Value of the format descriptor: the layout and constants a client needs to decode packets"""
+    return ("v1;header=<BBHI:count,scale,seq,ts_ms;sample=<6h:ax,ay,az,gx,gy,gz;"
+            "rate=%g;afs_sel=%d;fs_sel=%d" % (sample_rate, scale & 0x0F, scale >> 4)).encode("ascii")
+
+
+def describe_delta(sample_rate, scale, keyframe_interval):
+    """Format descriptor value for delta encoded notifications"""
+    return ("v1;delta;header=<BBHI:packet,flags,seq,ts_ms;keyframe=<6h:ax,ay,az,gx,gy,gz;"
+            "delta=varint:gap,zigzag_varint*6;keyframe_interval=%d;rate=%g;afs_sel=%d;fs_sel=%d"
+            % (keyframe_interval, sample_rate, scale & 0x0F, scale >> 4)).encode("ascii")
+
+
+class PackedFrameEncoder(object):
+    """
+    Packs frames from the sampler ring into MTU sized packets.
+
+    The sequence number counts samples (it is the ring sequence number of the
+    first sample), so a client detects lost samples from a gap between the
+    sequence number it expects and the one it receives.
+    """
+
+    def __init__(self, scale, fields=7, epoch=None, packet_type=bytes):
+        self.scale = scale
+        self.fields = fields
+        # e.g. dbus.ByteArray, so packets need no further conversion
+        self.packet_type = packet_type
+        self._buffer = bytearray()
+        self.epoch = monotonic() if epoch is None else epoch
+
+    @staticmethod
+    def samples_per_packet(mtu=ATT_DEFAULT_MTU):
+        return max(1, (mtu - ATT_NOTIFY_OVERHEAD - HEADER.size) // SAMPLE.size)
+
+    def encode(self, sequence, timestamps, frames, mtu=ATT_DEFAULT_MTU):
+        """
+        Encode `timestamps` and the flat `frames` array, the first of which has
+        sequence number `sequence`, into a list of packets each filled with as
+        many samples as fit into one notification at `mtu`.
+        """
+        packets = []
+        per_packet = self.samples_per_packet(mtu)
+        fields = self.fields
+        ax, ay, az, gx, gy, gz = AXES
+        total = len(timestamps)
+        for first in range(0, total, per_packet):
+            count = min(per_packet, total - first)
+            size = HEADER.size + count * SAMPLE.size
+            if len(self._buffer) < size:
+                self._buffer = bytearray(size)
+            packet = self._buffer
+            timestamp_ms = int((timestamps[first] - self.epoch) * 1000) & 0xFFFFFFFF
+            HEADER.pack_into(packet, 0, count, self.scale, (sequence + first) & 0xFFFF, timestamp_ms)
+            offset = HEADER.size
+            for i in range(first * fields, (first + count) * fields, fields):
+                SAMPLE.pack_into(packet, offset, frames[i + ax], frames[i + ay], frames[i + az],
+                                 frames[i + gx], frames[i + gy], frames[i + gz])
+                offset += SAMPLE.size
+            packets.append(self.packet_type(memoryview(packet)[:size]))
+        return packets
+
+
+BROADCAST_HEADER = struct.Struct("<BBH")
+
+
+class BroadcastEncoder(object):
+    """Packs the newest samples into a payload of at most a given size, for advertisements"""
+
+    def __init__(self, scale, fields=7):
+        self.scale = scale
+        self.fields = fields
+
+    @staticmethod
+    def samples_per_payload(size):
+        return max(0, min(255, (size - BROADCAST_HEADER.size) // SAMPLE.size))
+
+    def encode(self, sequence, frames):
+        """Encode the flat `frames` array, the first of which has sequence number `sequence`"""
+        fields = self.fields
+        ax, ay, az, gx, gy, gz = AXES
+        count = len(frames) // fields
+        payload = bytearray(BROADCAST_HEADER.size + count * SAMPLE.size)
+        BROADCAST_HEADER.pack_into(payload, 0, count, self.scale, sequence & 0xFFFF)
+        offset = BROADCAST_HEADER.size
+        for i in range(0, count * fields, fields):
+            SAMPLE.pack_into(payload, offset, frames[i + ax], frames[i + ay], frames[i + az],
+                             frames[i + gx], frames[i + gy], frames[i + gz])
+            offset += SAMPLE.size
+        return bytes(payload)
+
+
+HISTORY_REQUEST = struct.Struct("<IIB")
+HISTORY_STATUS = struct.Struct("<IIBHB")
+HISTORY_MEAN = 0
+HISTORY_MIN_MAX_MEAN = 1
+HISTORY_BUCKETS = {
+    HISTORY_MEAN: struct.Struct("<6h"),
+    HISTORY_MIN_MAX_MEAN: struct.Struct("<18h"),
+}
+
+
+class HistoryEncoder(object):
+    """Packs history buckets (see history.Bucket) into packets of at most a given size"""
+
+    def __init__(self, epoch, packet_type=bytes):
+        self.epoch = epoch
+        self.packet_type = packet_type
+
+    def per_packet(self, mode, size=ATT_DEFAULT_MTU - ATT_NOTIFY_OVERHEAD):
+        return max(1, min(255, (size - HEADER.size) // HISTORY_BUCKETS[mode].size))
+
+    def encode(self, buckets, mode, first_index=0, size=ATT_DEFAULT_MTU - ATT_NOTIFY_OVERHEAD):
+        bucket_struct = HISTORY_BUCKETS[mode]
+        per_packet = self.per_packet(mode, size)
+        packets = []
+        for first in range(0, len(buckets), per_packet):
+            chunk = buckets[first:first + per_packet]
+            packet = bytearray(HEADER.size + len(chunk) * bucket_struct.size)
+            timestamp_ms = int((chunk[0].timestamp - self.epoch) * 1000) & 0xFFFFFFFF
+            HEADER.pack_into(packet, 0, len(chunk), mode, (first_index + first) & 0xFFFF, timestamp_ms)
+            offset = HEADER.size
+            for bucket in chunk:
+                if mode == HISTORY_MEAN:
+                    bucket_struct.pack_into(packet, offset, *bucket.means)
+                else:
+                    bucket_struct.pack_into(packet, offset, *(bucket.mins + bucket.maxs + bucket.means))
+                offset += bucket_struct.size
+            packets.append(self.packet_type(packet))
+        return packets
+
+
+ORIENTATION_QUATERNION = 0
+ORIENTATION_EULER = 1
+ORIENTATION_SAMPLES = {
+    ORIENTATION_QUATERNION: struct.Struct("<4h"),
+    ORIENTATION_EULER: struct.Struct("<3h"),
+}
+# offsets of the values of each mode in a fusion output frame
+ORIENTATION_FIELDS = {
+    ORIENTATION_QUATERNION: (0, 1, 2, 3),
+    ORIENTATION_EULER: (4, 5, 6),
+}
+
+
+class OrientationEncoder(object):
+    """Packs fusion output frames into MTU sized packets, as PackedFrameEncoder does raw frames"""
+
+    def __init__(self, mode=ORIENTATION_QUATERNION, fields=7, epoch=None, packet_type=bytes):
+        self.mode = mode
+        self.fields = fields
+        self.packet_type = packet_type
+        self.epoch = monotonic() if epoch is None else epoch
+
+    def samples_per_packet(self, mtu=ATT_DEFAULT_MTU):
+        return max(1, (mtu - ATT_NOTIFY_OVERHEAD - HEADER.size) // ORIENTATION_SAMPLES[self.mode].size)
+
+    def encode(self, sequence, timestamps, frames, mtu=ATT_DEFAULT_MTU):
+        sample = ORIENTATION_SAMPLES[self.mode]
+        offsets = ORIENTATION_FIELDS[self.mode]
+        per_packet = self.samples_per_packet(mtu)
+        fields = self.fields
+        packets = []
+        total = len(timestamps)
+        for first in range(0, total, per_packet):
+            count = min(per_packet, total - first)
+            packet = bytearray(HEADER.size + count * sample.size)
+            timestamp_ms = int((timestamps[first] - self.epoch) * 1000) & 0xFFFFFFFF
+            HEADER.pack_into(packet, 0, count, self.mode, (sequence + first) & 0xFFFF, timestamp_ms)
+            offset = HEADER.size
+            for i in range(first * fields, (first + count) * fields, fields):
+                sample.pack_into(packet, offset, *[frames[i + field] for field in offsets])
+                offset += sample.size
+            packets.append(self.packet_type(packet))
+        return packets
+
+
+DELTA_KEYFRAME = 0x01
+# commands written to a delta encoded characteristic
+DELTA_REQUEST_KEYFRAME = 0x01
+DELTA_SET_DEADBAND = 0x02  # followed by <6H, the deadband of each axis
+DEADBAND = struct.Struct("<6H")
+
+
+def append_varint(buffer, value):
+    """Append the unsigned LEB128 encoding of `value` to the bytearray `buffer`"""
+    while value > 0x7F:
+        buffer.append((value & 0x7F) | 0x80)
+        value >>= 7
+    buffer.append(value)
+
+
+class DeltaFrameEncoder(object):
+    """
+    Encodes sampler frames as a keyframe every `keyframe_interval` samples and
+    varint deltas in between, with the same encode() as PackedFrameEncoder.
+
+    A change of an axis within its `deadband` (raw units) is sent as 0, and a
+    sample with no change left is not sent at all, so a still sensor only sends
+    keyframes. The state carries over between encode() calls: the deltas of a
+    stream are relative to the values the client last received.
+    """
+
+    def __init__(self, scale, keyframe_interval=100, deadband=(0,) * 6, fields=7, epoch=None,
+                 packet_type=bytes):
+        self.scale = scale
+        self.keyframe_interval = keyframe_interval
+        self.deadband = tuple(deadband)
+        self.fields = fields
+        self.packet_type = packet_type
+        self.epoch = monotonic() if epoch is None else epoch
+        self.reference = None  # axes as last sent
+        self.last_sequence = None
+        self.since_keyframe = 0
+        self.packet_number = 0
+        self.keyframe_requested = False
+        self.samples = 0
+        self.suppressed = 0
+        self.keyframes = 0
+        self.packets = 0
+        self.bytes = 0
+
+    def request_keyframe(self):
+        """Send the next sample as a keyframe"""
+        self.keyframe_requested = True
+
+    def reset(self):
+        """Start a new stream, beginning with a keyframe"""
+        self.reference = None
+        self.last_sequence = None
+
+    def encode(self, sequence, timestamps, frames, mtu=ATT_DEFAULT_MTU):
+        size = mtu - ATT_NOTIFY_OVERHEAD
+        fields = self.fields
+        deadband = self.deadband
+        packets = []
+        packet = None
+        gap = bytearray()
+        for n in range(len(timestamps)):
+            base = n * fields
+            values = [frames[base + axis] for axis in AXES]
+            current = sequence + n
+            self.samples += 1
+            self.since_keyframe += 1
+            reference = self.reference
+            if (reference is None or self.keyframe_requested
+                    or self.since_keyframe > self.keyframe_interval):
+                packet = self._keyframe(packets, packet, current, timestamps[n], values)
+                continue
+
+            body = bytearray()
+            changed = False
+            for i in range(6):
+                delta = values[i] - reference[i]
+                if -deadband[i] <= delta <= deadband[i]:
+                    # the client keeps the value it has
+                    values[i] = reference[i]
+                    body.append(0)
+                else:
+                    changed = True
+                    append_varint(body, delta << 1 if delta >= 0 else ((-delta) << 1) - 1)
+            if not changed:
+                self.suppressed += 1
+                continue
+            if HEADER.size + len(body) > size:
+                # a change too large for one packet at this MTU goes as a keyframe
+                packet = self._keyframe(packets, packet, current, timestamps[n], values)
+                continue
+
+            self.reference = values
+            if packet is not None:
+                del gap[:]
+                append_varint(gap, current - self.last_sequence)
+                if len(packet) + len(gap) + len(body) <= size:
+                    packet += gap
+                    packet += body
+                    self.last_sequence = current
+                    continue
+                packets.append(self._finish(packet))
+            packet = self._start(0, current, timestamps[n])
+            packet += body
+            self.last_sequence = current
+        if packet is not None:
+            packets.append(self._finish(packet))
+        return packets
+
+    def _keyframe(self, packets, packet, sequence, timestamp, values):
+        # a keyframe always starts a packet
+        if packet is not None:
+            packets.append(self._finish(packet))
+        packet = self._start(DELTA_KEYFRAME, sequence, timestamp)
+        packet += SAMPLE.pack(*values)
+        self.reference = values
+        self.last_sequence = sequence
+        self.keyframe_requested = False
+        self.since_keyframe = 1
+        self.keyframes += 1
+        return packet
+
+    def _start(self, flags, sequence, timestamp):
+        packet = bytearray(HEADER.size)
+        timestamp_ms = int((timestamp - self.epoch) * 1000) & 0xFFFFFFFF
+        HEADER.pack_into(packet, 0, self.packet_number, flags, sequence & 0xFFFF, timestamp_ms)
+        self.packet_number = (self.packet_number + 1) & 0xFF
+        return packet
+
+    def _finish(self, packet):
+        self.packets += 1
+        self.bytes += len(packet)
+        return self.packet_type(packet)
+
+    def stats(self):
+        return {
+            "samples": self.samples,
+            "suppressed": self.suppressed,
+            "keyframes": self.keyframes,
+            "packets": self.packets,
+            "bytes": self.bytes,
+        }
+
+
+class DeltaFrameDecoder(object):
+    """
+    Client side of DeltaFrameEncoder. decode() returns the (sequence, axes)
+    samples of a packet. After a lost packet it returns nothing until the next
+    keyframe and `need_keyframe` is set, telling the client to write
+    DELTA_REQUEST_KEYFRAME.
+    """
+
+    def __init__(self):
+        self.reference = None
+        self.packet_number = None
+        self.need_keyframe = True
+        self.lost_packets = 0
+
+    def decode(self, packet):
+        packet = bytes(packet)
+        number, flags, sequence, timestamp_ms = HEADER.unpack_from(packet)
+        if self.packet_number is not None and number != (self.packet_number + 1) & 0xFF:
+            self.lost_packets += (number - self.packet_number - 1) & 0xFF
+            self.need_keyframe = True
+        self.packet_number = number
+        offset = HEADER.size
+        if flags & DELTA_KEYFRAME:
+            self.reference = list(SAMPLE.unpack_from(packet, offset))
+            self.need_keyframe = False
+            offset += SAMPLE.size
+        elif self.need_keyframe:
+            return []
+        else:
+            offset = self._apply(packet, offset)
+        samples = [(sequence, tuple(self.reference))]
+        while offset < len(packet):
+            gap, offset = read_varint(packet, offset)
+            sequence = (sequence + gap) & 0xFFFF
+            offset = self._apply(packet, offset)
+            samples.append((sequence, tuple(self.reference)))
+        return samples
+
+    def _apply(self, packet, offset):
+        reference = self.reference
+        for i in range(6):
+            value, offset = read_varint(packet, offset)
+            reference[i] += (value >> 1) ^ -(value & 1)
+        return offset
+
+
+def read_varint(buffer, offset):
+    """Unsigned LEB128 value at `offset` in `buffer`, and the offset after it"""
+    value = 0
+    shift = 0
+    while True:
+        byte = buffer[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return value, offset
+        shift += 7